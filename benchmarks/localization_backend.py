@@ -0,0 +1,127 @@
+"""
+Benchmark the NumPy and dask localization backends of the postprocess stages.
+
+Times emulandice_postprocess_GrIS and emulandice_postprocess_glaciers, including
+fingerprint interpolation and writing the output file, on synthetic fingerprints and
+location lists of increasing size. The crossover point is where dask starts to win, and
+sets NUMPY_BACKEND_MAX_ELEMENTS in emulandice.execution.
+
+Run from the repository root with
+
+    uv run python benchmarks/localization_backend.py
+"""
+
+from pathlib import Path
+import tempfile
+import time
+
+from netCDF4 import Dataset
+import numpy as np
+
+from emulandice.emulandice_GrIS_postprocess import emulandice_postprocess_GrIS
+from emulandice.emulandice_glaciers_postprocess import emulandice_postprocess_glaciers
+
+NSAMPS = 2237
+TARGYEARS = np.arange(2020, 2101, 10)
+NSITES = (1, 10, 50, 100, 250, 500, 1000)
+NREPEAT = 3
+
+
+def write_fingerprint(path, rng):
+    lats = np.linspace(90, -90, 361)
+    lons = np.arange(0, 360, 0.5)
+    with Dataset(path, "w") as nc:
+        nc.createDimension("lat", len(lats))
+        nc.createDimension("lon", len(lons))
+        nc.createVariable("lat", "f8", ("lat",))[:] = lats
+        nc.createVariable("lon", "f8", ("lon",))[:] = lons
+        nc.createVariable("fp", "f8", ("lat", "lon"))[:] = rng.normal(
+            1e-3, 2e-4, (len(lats), len(lons))
+        )
+
+
+def write_locations(path, nsites, rng):
+    with open(path, "w") as f:
+        for i in range(nsites):
+            lat = rng.uniform(-80, 80)
+            lon = rng.uniform(-180, 180)
+            f.write(f"site_{i}\t{i}\t{lat:.2f}\t{lon:.2f}\n")
+
+
+def best_time(func, **kwargs):
+    times = []
+    for _ in range(NREPEAT):
+        t0 = time.perf_counter()
+        func(**kwargs)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+
+        write_fingerprint(tmpdir / "fprint_gis.nc", rng)
+        with open(tmpdir / "fingerprint_region_map.csv", "w") as f:
+            f.write("IceID,FPID\n")
+            for i in range(1, 20):
+                write_fingerprint(tmpdir / f"fprint_region{i}.nc", rng)
+                f.write(f"{i},region{i}\n")
+
+        common = {
+            "targyears": TARGYEARS,
+            "scenario": "benchmark",
+            "baseyear": 2005,
+            "preprocess_infile": "benchmark",
+        }
+        gris_data = {
+            "gissamps": rng.normal(50, 10, (NSAMPS, len(TARGYEARS))),
+            **common,
+        }
+        glaciers_data = {
+            "gic_samps": rng.normal(5, 1, (19, NSAMPS, len(TARGYEARS))),
+            **common,
+        }
+
+        print("source    sites   values   numpy (s)   dask (s)")
+        for nsites in NSITES:
+            locationfile = tmpdir / "location.lst"
+            write_locations(locationfile, nsites, rng)
+            nvalues = NSAMPS * len(TARGYEARS) * nsites
+
+            for source, func, kwargs in (
+                (
+                    "gris",
+                    emulandice_postprocess_GrIS,
+                    {"my_data": gris_data, "fprint_gis_file": tmpdir / "fprint_gis.nc"},
+                ),
+                (
+                    "glaciers",
+                    emulandice_postprocess_glaciers,
+                    {
+                        "my_data": glaciers_data,
+                        "fprint_map_file": tmpdir / "fingerprint_region_map.csv",
+                        "fprint_glacier_dir": tmpdir,
+                    },
+                ),
+            ):
+                timings = [
+                    best_time(
+                        func,
+                        locationfile=locationfile,
+                        chunksize=50,
+                        pipeline_id="benchmark",
+                        output_lslr_file=tmpdir / "lslr.nc",
+                        backend=backend,
+                        **kwargs,
+                    )
+                    for backend in ("numpy", "dask")
+                ]
+                print(
+                    f"{source:<9} {nsites:>5} {nvalues:>8.1e} {timings[0]:>11.3f} {timings[1]:>10.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark concatenating location shards of local SLR files.
+
+Writes synthetic local SLR blocks for location shards aligned on the chunksize, then times
+emulandice.shard.concat_locations, which copies their compressed chunks, against
+decompressing and recompressing them with xarray.
+
+Run from the repository root with
+
+    uv run python benchmarks/lslr_concat.py
+"""
+
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+from emulandice.io import lslr_encoding
+from emulandice.shard import concat_locations, split
+
+NSAMPS = 2000
+TARGYEARS = np.arange(2020, 2101, 10)
+CHUNKSIZE = 50
+NSITES = (1000, 4000, 16000)
+NSHARDS = 8
+
+
+def write_block(path, start, stop, rng):
+    values = rng.normal(0, 100, (NSAMPS, len(TARGYEARS), stop - start)).astype("f4")
+    ds = xr.Dataset(
+        {
+            "sea_level_change": (("samples", "years", "locations"), values),
+            "lat": (("locations"), rng.uniform(-80, 80, stop - start)),
+            "lon": (("locations"), rng.uniform(-180, 180, stop - start)),
+        },
+        coords={
+            "years": TARGYEARS,
+            "locations": np.arange(start, stop),
+            "samples": np.arange(NSAMPS),
+        },
+    )
+    ds.to_netcdf(path, encoding=lslr_encoding(values.shape, CHUNKSIZE))
+
+
+def recompress(files, output_file):
+    blocks = [xr.open_dataset(f, chunks={}) for f in files]
+    merged = xr.concat(
+        blocks, "locations", data_vars="minimal", coords="minimal", compat="override"
+    )
+    merged.to_netcdf(
+        output_file,
+        encoding=lslr_encoding(merged["sea_level_change"].shape, CHUNKSIZE),
+    )
+    for block in blocks:
+        block.close()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+
+        print("sites   chunk copy (s)   recompress (s)")
+        for nsites in NSITES:
+            files = []
+            for i, (start, stop) in enumerate(split(nsites, NSHARDS, align=CHUNKSIZE)):
+                files.append(tmpdir / f"block{i}.nc")
+                write_block(files[-1], start, stop, rng)
+
+            timings = []
+            for func in (concat_locations, recompress):
+                t0 = time.perf_counter()
+                func(files, tmpdir / "lslr.nc")
+                timings.append(time.perf_counter() - t0)
+            print(f"{nsites:>5} {timings[0]:>16.3f} {timings[1]:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Measure how long R takes to load the emulandice package, against a startup budget.
+
+Times `R -q --no-save -e "library(emulandice)"` and a bare `R -q --no-save -e "NULL"`.
+The difference is the cost of attaching emulandice and its Depends, which every
+projection stage pays once per R subprocess. Exits non-zero if the median cost is over
+STARTUP_BUDGET_SECONDS, so it can run as a check in the container:
+
+    docker run --rm --entrypoint uv emulandice run python benchmarks/r_startup.py
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+# Budget for attaching dplyr, tidyr and readr. Plotting uses base graphics, and the
+# optional emulator, dummy-variable and model-comparison packages load on demand.
+STARTUP_BUDGET_SECONDS = 1.0
+NREPEAT = 5
+
+
+def time_r(expr: str) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        ["R", "-q", "--no-save", "-e", expr],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    bare = statistics.median(time_r("NULL") for _ in range(NREPEAT))
+    loaded = statistics.median(time_r("library(emulandice)") for _ in range(NREPEAT))
+    cost = loaded - bare
+    print(f"R startup: {bare:.2f} s")
+    print(f"R startup with library(emulandice): {loaded:.2f} s")
+    print(f"library(emulandice): {cost:.2f} s (budget {STARTUP_BUDGET_SECONDS:.2f} s)")
+    return 0 if cost <= STARTUP_BUDGET_SECONDS else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,8 @@ Parameters:
 fp_filename = Fingerprint file passed to ReadFingerprint
 qlats = Vector of latitudes of sites of interest [-90, 90]
 qlons = Vector of longitudes of sites of interest [-180, 180]
+pack = Optional FingerprintPack to read the fingerprint from instead of fp_filename
+masked = If True, sites interpolated from any masked grid point are NaN
 
 Return:
 fp_sites = Vector of fingerprint coefficients for the sites of interest
@@ -19,11 +21,14 @@ fp_sites = Vector of fingerprint coefficients for the sites of interest
 """
 
 
-def AssignFP(fp_filename, qlats, qlons):
+def AssignFP(fp_filename, qlats, qlons, pack=None, masked=False):
     ## Read in the fitted parameters from parfile
-    # Open the file
+    # Open the file, or read only the rows around the sites from the pack
     try:
-        (fp, fp_lats, fp_lons) = readfp(fp_filename)
+        if pack is not None:
+            (fp, fp_lats, fp_lons) = pack.read(fp_filename, qlats, masked=masked)
+        else:
+            (fp, fp_lats, fp_lons) = readfp(fp_filename)
     except Exception:
         print("Cannot open fingerprint file\n")
         raise
@@ -35,4 +40,16 @@ def AssignFP(fp_filename, qlats, qlons):
     )
     fp_sites = fp_interp.ev(qlats, np.mod(qlons, 360)) * 1000
 
+    # The values under the mask are fill values, so interpolate the mask the same way and
+    # drop the sites that any masked point contributes to
+    if masked:
+        mask_interp = interp.RectBivariateSpline(
+            fp_lats[lat_sort],
+            fp_lons,
+            np.ma.getmaskarray(fp)[lat_sort, :].astype(float),
+            kx=1,
+            ky=1,
+        )
+        fp_sites[mask_interp.ev(qlats, np.mod(qlons, 360)) > 0] = np.nan
+
     return fp_sites
@@ -1,5 +1,7 @@
 from netCDF4 import Dataset
 
+from emulandice.io import netcdf_lock
+
 """ ReadFingerprint.py
 
 Provides a function that reads in a fingerprint data file from the netCDF files created
@@ -17,16 +19,18 @@ lon = Vector of longitudes
 
 
 def ReadFingerprint(fname):
-    # Open the fingerprint file
-    try:
-        nc_fid = Dataset(fname, "r")
-    except:
-        print("Cannot open fingerprint file: {0}\n".format(fname))
-        raise
-
-    # Read in the fingerprint data
-    fp = nc_fid.variables["fp"][:, :]
-    fp_lats = nc_fid.variables["lat"][:]
-    fp_lons = nc_fid.variables["lon"][:]
+    with netcdf_lock():
+        # Open the fingerprint file
+        try:
+            nc_fid = Dataset(fname, "r")
+        except:
+            print("Cannot open fingerprint file: {0}\n".format(fname))
+            raise
+
+        # Read in the fingerprint data
+        fp = nc_fid.variables["fp"][:, :]
+        fp_lats = nc_fid.variables["lat"][:]
+        fp_lons = nc_fid.variables["lon"][:]
+        nc_fid.close()
 
     return (fp, fp_lats, fp_lons)
@@ -0,0 +1,167 @@
+"""
+Project ice sources from GSAT samples held in memory to xarray Datasets.
+
+`project` takes the GSAT samples as an xarray object and the sites as coordinate arrays,
+so the only file written on the way is the forcing CSV that R reads, in a temporary
+directory. It returns the global and local projections as Datasets, the local ones lazy,
+and nothing is written to disk unless `Projections.write` is called.
+"""
+
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import xarray as xr
+
+from emulandice import pipeline
+from emulandice.emulandice_preprocess import emulandice_preprocess_gsat
+from emulandice.emulator import check_realizations
+from emulandice.execution import execution_backend
+from emulandice.io import GSLR_ENCODING, to_netcdf
+from emulandice.sites import Grid, Sites, check_fingerprints, load_grid, make_sites
+
+
+@dataclass
+class Projections:
+    """
+    Global and local SLR datasets of one ice source, keyed by component.
+
+    Components are "ais", "eais" and "wais" (and "pen" for global SLR) for AIS, "gris" for
+    GrIS and "glaciers" for glaciers, with glacier SLR by region under "regions". Local SLR
+    is dask-backed and computed when used.
+    """
+
+    gslr: dict[str, xr.Dataset]
+    lslr: dict[str, xr.Dataset]
+    sites: Sites | Grid
+    chunksize: int
+
+    def write(self, gslr_files: dict | None = None, lslr_files: dict | None = None):
+        """
+        Write the components named in `gslr_files` and `lslr_files` to the files they map to.
+
+        Files are written with the encodings of the command outputs, and local SLR is
+        computed chunk by chunk as it is written.
+        """
+        for name, path in (gslr_files or {}).items():
+            to_netcdf(self.gslr[name], path, encoding=GSLR_ENCODING)
+        for name, path in (lslr_files or {}).items():
+            shape = self.lslr[name]["sea_level_change"].shape
+            to_netcdf(
+                self.lslr[name],
+                path,
+                encoding=self.sites.encoding(shape, self.chunksize),
+            )
+
+
+def project(
+    ice_source: str,
+    gsat: xr.Dataset | xr.DataArray,
+    forcing_head_path,
+    *,
+    lats=None,
+    lons=None,
+    ids=None,
+    grid: bool = False,
+    grid_box=None,
+    grid_stride: int = 1,
+    baseyear: int = 2005,
+    target_years=None,
+    scenario: str | None = None,
+    pipeline_id: str = "emulandice",
+    chunksize: int = 50,
+    precision: str = "float64",
+    predictor: str = "r",
+    response_table_file=None,
+    realizations: int = 1,
+    fingerprint_pack=None,
+    fprint_wais_file=None,
+    fprint_eais_file=None,
+    fprint_gis_file=None,
+    fprint_map_file=None,
+    fprint_glacier_dir=None,
+    num_workers: int | None = None,
+    memory_limit: str | None = None,
+) -> Projections:
+    """
+    Project `ice_source` ("ais", "gris" or "glaciers") for the GSAT samples `gsat`.
+
+    `gsat` is laid out like the input file of the commands: a Dataset with a
+    "surface_temperature" variable over samples and years, or that DataArray. Local SLR is
+    localized to the sites at `lats` and `lons`, with optional `ids`, or with `grid` to the
+    cells of the fingerprint grid. `target_years` limits the projections to those years.
+    The other arguments are those of the commands; `num_workers` and `memory_limit` only
+    apply to R here, as the caller computes the local SLR with its own dask scheduler.
+    """
+    if ice_source not in pipeline.ICE_SOURCES:
+        raise ValueError(
+            f"ice_source must be one of {', '.join(pipeline.ICE_SOURCES)}, got {ice_source!r}"
+        )
+    if grid and lats is not None:
+        raise ValueError("Give either site lats and lons or grid, not both")
+    check_realizations(predictor, realizations)
+    if not grid and (lats is None or lons is None):
+        raise ValueError("Give the site lats and lons, or localize on the grid")
+
+    params = pipeline.fingerprint_params(
+        ice_source,
+        {
+            "pipeline_id": pipeline_id,
+            "location_file": None,
+            "chunksize": chunksize,
+            "precision": precision,
+            "predictor": predictor,
+            "response_table_file": response_table_file,
+            "realizations": realizations,
+            "fingerprint_pack": fingerprint_pack,
+            "fprint_wais_file": fprint_wais_file,
+            "fprint_eais_file": fprint_eais_file,
+            "fprint_gis_file": fprint_gis_file,
+            "fprint_map_file": fprint_map_file,
+            "fprint_glacier_dir": fprint_glacier_dir,
+        },
+    )
+    files = pipeline.fingerprint_files(ice_source, params)
+    check_fingerprints(files, fingerprint_pack)
+
+    # Interpolate the fingerprints while R runs
+    with (
+        execution_backend("threads", num_workers, memory_limit),
+        ThreadPoolExecutor(max_workers=1) as pool,
+    ):
+        if grid:
+            sites = pool.submit(
+                load_grid, files, grid_box, grid_stride, fingerprint_pack
+            )
+        else:
+            sites = pool.submit(make_sites, lats, lons, ids, files, fingerprint_pack)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            preprocessed = emulandice_preprocess_gsat(
+                gsat,
+                baseyear,
+                pipeline_id,
+                headfile=forcing_head_path,
+                outfile=tmpdir / "facts_climate_forcing.csv",
+                scenario=scenario,
+                target_years=target_years,
+            )
+            projected = pipeline.project(
+                ice_source,
+                params,
+                preprocessed,
+                dict.fromkeys(pipeline.GSLR_OUTPUTS[ice_source]),
+                tmpdir,
+            )
+        sites = sites.result()
+
+    lslr = pipeline.postprocess(
+        ice_source,
+        params,
+        projected,
+        dict.fromkeys(pipeline.LSLR_OUTPUTS[ice_source]),
+        sites=sites,
+        backend="dask",
+    )
+    return Projections(projected["gslr"], lslr, sites, chunksize)
@@ -2,13 +2,28 @@
 Logic for the CLI.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
+import shlex
 import tempfile
 
 import click
 
 from emulandice.emulandice_preprocess import emulandice_preprocess
+from emulandice.emulator import PREDICTORS
+from emulandice.execution import SCHEDULERS, execution_backend
+from emulandice.r_helper import FIRST_YEAR, LAST_YEAR
+from emulandice.pipeline import run_pipeline
+from emulandice import serve as serving
+from emulandice import shard as sharding
+from emulandice.fingerprints import fingerprint_options, pack_fingerprints
+from emulandice.sites import (
+    check_fingerprints,
+    check_paths,
+    glacier_fingerprint_files,
+    load_locations,
+)
 from emulandice.emulandice_AIS_fit import emulandice_fit_AIS
 from emulandice.emulandice_AIS_project import emulandice_project_AIS
 from emulandice.emulandice_AIS_postprocess import emulandice_postprocess_AIS
@@ -36,6 +51,77 @@ def main(debug):
         logging.root.setLevel(logging.INFO)
 
 
+def _parse_location_shard(ctx, param, value):
+    # Parse "I/N" into (I, N)
+    if value is None:
+        return None
+    try:
+        index, nshards = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("must be given as I/N, like 0/8") from None
+    if not 0 <= index < nshards:
+        raise click.BadParameter(f"index must be between 0 and {nshards - 1}")
+    return index, nshards
+
+
+def _parse_grid_box(ctx, param, value):
+    # Parse "S,N,W,E" into a tuple of floats
+    if value is None:
+        return None
+    try:
+        south, north, west, east = (float(x) for x in value.split(","))
+    except ValueError:
+        raise click.BadParameter(
+            "must be given as S,N,W,E, like -60,0,-80,20"
+        ) from None
+    if not -90 <= south <= north <= 90 or west > east:
+        raise click.BadParameter("must have S <= N within [-90, 90] and W <= E")
+    return south, north, west, east
+
+
+def _parse_target_years(ctx, param, value):
+    # Parse "Y1,Y2,..." into a sorted tuple of years
+    if value is None:
+        return None
+    try:
+        years = sorted({int(x) for x in value.split(",")})
+    except ValueError:
+        raise click.BadParameter("must be given as Y1,Y2,..., like 2050,2100") from None
+    if not FIRST_YEAR <= years[0] <= years[-1] <= LAST_YEAR:
+        raise click.BadParameter(f"years must be between {FIRST_YEAR} and {LAST_YEAR}")
+    return tuple(years)
+
+
+def _check_locations(location_file, location_shard, grid, region_weights_file=None):
+    # Localize either at the sites of a location file, or their regions, or on the
+    # fingerprint grid
+    if grid and location_shard is not None:
+        raise click.UsageError("--location-shard cannot be used with --grid")
+    if region_weights_file is not None and grid:
+        raise click.UsageError("--region-weights-file cannot be used with --grid")
+    if region_weights_file is not None and location_shard is not None:
+        raise click.UsageError(
+            "--location-shard cannot be used with --region-weights-file"
+        )
+    if not grid and location_file is None:
+        raise click.UsageError(
+            "Give --location-file, or --grid to localize on the grid"
+        )
+
+
+def _check_realizations(predictor, realizations):
+    # Only R's moments can be sampled several times per temperature sample
+    if realizations > 1 and predictor != "moments":
+        raise click.UsageError("--realizations needs --predictor moments")
+
+
+def _locations(location_file, chunksize, location_shard):
+    # Locations to localize, all of them unless a location shard is given
+    if location_shard is None:
+        return slice(None)
+    return sharding.location_slice(location_file, chunksize, *location_shard)
+
+
 @main.command
 @click.option(
     "--input-data-file",
@@ -68,8 +154,15 @@ def main(debug):
     "--output-lslr-file",
     envvar="EMULANDICE_OUTPUT_LSLR_FILE",
     help="Path to write output local SLR file.",
-    required=True,
     type=str,
+    default=None,
+)
+@click.option(
+    "--output-lslr-factors-file",
+    envvar="EMULANDICE_OUTPUT_LSLR_FACTORS_FILE",
+    help="Path to write local SLR factorized into the global SLR of each component and its fingerprint at each location, read with emulandice.io.open_lslr_factors [default=None].",
+    type=str,
+    default=None,
 )
 @click.option(
     "--baseyear",
@@ -77,32 +170,139 @@ def main(debug):
     help="Base year to which projections should be referenced.",
     default=2005,
 )
+@click.option(
+    "--target-years",
+    envvar="EMULANDICE_TARGET_YEARS",
+    help="Years to project, given as Y1,Y2,..., like 2050,2100, between 2016 and 2100 [default=every decade from 2020 to 2100].",
+    type=str,
+    default=None,
+    callback=_parse_target_years,
+)
 @click.option(
     "--chunksize",
     envvar="EMULANDICE_CHUNKSIZE",
     help="Number of locations to process at a time [default=50].",
     default=50,
 )
+@click.option(
+    "--precision",
+    envvar="EMULANDICE_PRECISION",
+    help="Floating point precision used to compute projections and localized sea-level change [default=float64].",
+    type=click.Choice(["float64", "float32"]),
+    default="float64",
+)
+@click.option(
+    "--scheduler",
+    envvar="EMULANDICE_SCHEDULER",
+    help="Dask scheduler used for localization and writing output [default=threads].",
+    type=click.Choice(SCHEDULERS),
+    default="threads",
+)
+@click.option(
+    "--num-workers",
+    envvar="EMULANDICE_NUM_WORKERS",
+    help="Number of dask workers, also used as the thread count for R [default=all cores].",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--memory-limit",
+    envvar="EMULANDICE_MEMORY_LIMIT",
+    help="Total memory limit, like '8GB', for R and the processes or distributed schedulers [default=no limit].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--predictor",
+    envvar="EMULANDICE_PREDICTOR",
+    help="Predict and sample projections in R; fit and export emulators in R and predict them with NumPy in full ('numpy') or from response tables ('table'); or predict in R and sample with NumPy ('moments') [default=r].",
+    type=click.Choice(PREDICTORS),
+    default="r",
+)
+@click.option(
+    "--response-table-file",
+    envvar="EMULANDICE_RESPONSE_TABLE_FILE",
+    help="netCDF file of response tables for the 'table' predictor, reused if built from the same emulators and covering the sampled inputs, and written otherwise [default=tabulate each run].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--realizations",
+    envvar="EMULANDICE_REALIZATIONS",
+    help="Number of projections drawn per temperature sample by the 'moments' predictor, realization r of sample i being sample r * nsamps + i [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--output-report-file",
+    envvar="EMULANDICE_OUTPUT_REPORT_FILE",
+    help="Path to write a JSON run report with the emulator fit, prediction and total seconds and rows written of each R region [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--location-file",
     envvar="EMULANDICE_LOCATION_FILE",
-    help="File containing name, id, lat, and lon of points for localization.",
+    help="File containing name, id, lat, and lon of points for localization, required without --grid.",
     type=str,
-    required=True,
+    default=None,
+)
+@click.option(
+    "--location-shard",
+    envvar="EMULANDICE_LOCATION_SHARD",
+    help="Localize only block I of N of the locations, given as I/N, for merging with 'emulandice shard concat' [default=all locations].",
+    type=str,
+    default=None,
+    callback=_parse_location_shard,
+)
+@click.option(
+    "--fingerprint-pack",
+    envvar="EMULANDICE_FINGERPRINT_PACK",
+    help="Fingerprint pack written by 'emulandice pack-fingerprints' to read fingerprints from, by file name [default=read the netCDF files].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--grid/--no-grid",
+    envvar="EMULANDICE_GRID",
+    help="Localize on the cells of the fingerprint grid, using fingerprint values without interpolation, instead of at the locations in --location-file [default=no-grid].",
+    default=False,
+)
+@click.option(
+    "--grid-box",
+    envvar="EMULANDICE_GRID_BOX",
+    help="Box of grid cells to localize with --grid, given as S,N,W,E in degrees, like -60,0,-80,20 [default=whole grid].",
+    type=str,
+    default=None,
+    callback=_parse_grid_box,
+)
+@click.option(
+    "--grid-stride",
+    envvar="EMULANDICE_GRID_STRIDE",
+    help="Localize every Nth grid row and column with --grid [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--region-weights-file",
+    envvar="EMULANDICE_REGION_WEIGHTS_FILE",
+    help="CSV of region, location and optional weight columns; localize the weighted average of the locations in --location-file of each region instead of each location [default=None].",
+    type=str,
+    default=None,
 )
 @click.option(
     "--fprint-wais-file",
     envvar="EMULANDICE_FPRINT_WAIS_FILE",
-    help="File containing WAIS fingerprint data.",
+    help="File containing WAIS fingerprint data [default=fprint_wais.nc in --fingerprint-pack].",
     type=str,
-    required=True,
+    default=None,
 )
 @click.option(
     "--fprint-eais-file",
     envvar="EMULANDICE_FPRINT_EAIS_FILE",
-    help="File containing EAIS fingerprint data.",
+    help="File containing EAIS fingerprint data [default=fprint_eais.nc in --fingerprint-pack].",
     type=str,
-    required=True,
+    default=None,
 )
 @click.option(
     "--output-gslr-eais-file",
@@ -145,9 +345,25 @@ def ais(
     pipeline_id,
     output_gslr_file,
     output_lslr_file,
+    output_lslr_factors_file,
     baseyear,
+    target_years,
     chunksize,
+    precision,
+    scheduler,
+    num_workers,
+    memory_limit,
+    predictor,
+    response_table_file,
+    realizations,
+    output_report_file,
     location_file,
+    location_shard,
+    fingerprint_pack,
+    grid,
+    grid_box,
+    grid_stride,
+    region_weights_file,
     fprint_wais_file,
     fprint_eais_file,
     output_gslr_eais_file,
@@ -161,45 +377,94 @@ def ais(
     """
     logger.info("Starting emulandice ais")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        forcing_path = tmpdir / "facts_climate_forcing.csv"
-        emulandice_r_output_dir = tmpdir / "results"
-        emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
-
-        preprocessed = emulandice_preprocess(
-            input_data_file,
-            baseyear,
-            pipeline_id,
-            headfile=forcing_head_path,
-            outfile=forcing_path,
-        )
-
-        fitted = emulandice_fit_AIS(pipeline_id)
-
-        projected = emulandice_project_AIS(
-            pipeline_id,
-            preprocess_data=preprocessed,
-            fit_data=fitted,
-            output_dir=str(emulandice_r_output_dir),
-            output_gslr_file=output_gslr_file,
-            output_eais_file=output_gslr_eais_file,
-            output_wais_file=output_gslr_wais_file,
-            output_pen_file=output_gslr_pen_file,
-        )
-
-    emulandice_postprocess_AIS(
-        my_data=projected,
-        locationfile=location_file,
-        chunksize=chunksize,
-        pipeline_id=pipeline_id,
+    # Check paths up front, and load the sites and fingerprints while R runs
+    _check_locations(location_file, location_shard, grid, region_weights_file)
+    _check_realizations(predictor, realizations)
+    fprint_wais_file, fprint_eais_file = fingerprint_options(
+        fingerprint_pack,
         fprint_wais_file=fprint_wais_file,
         fprint_eais_file=fprint_eais_file,
-        output_lslr_file=output_lslr_file,
-        output_eais_file=output_lslr_eais_file,
-        output_wais_file=output_lslr_wais_file,
+    ).values()
+    fingerprint_files = [fprint_wais_file, fprint_eais_file]
+    check_fingerprints(fingerprint_files, fingerprint_pack)
+    check_paths(
+        [input_data_file, forcing_head_path, location_file, region_weights_file],
+        [
+            output_gslr_file,
+            output_lslr_file,
+            output_lslr_factors_file,
+            output_gslr_eais_file,
+            output_gslr_wais_file,
+            output_gslr_pen_file,
+            output_lslr_eais_file,
+            output_lslr_wais_file,
+            output_report_file,
+        ],
     )
 
+    with (
+        execution_backend(scheduler, num_workers, memory_limit),
+        ThreadPoolExecutor(max_workers=1) as pool,
+    ):
+        sites = pool.submit(
+            load_locations,
+            location_file,
+            fingerprint_files,
+            pack_file=fingerprint_pack,
+            grid=grid,
+            grid_box=grid_box,
+            grid_stride=grid_stride,
+            region_weights_file=region_weights_file,
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            forcing_path = tmpdir / "facts_climate_forcing.csv"
+            emulandice_r_output_dir = tmpdir / "results"
+            emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
+
+            preprocessed = emulandice_preprocess(
+                input_data_file,
+                baseyear,
+                pipeline_id,
+                headfile=forcing_head_path,
+                outfile=forcing_path,
+                target_years=target_years,
+            )
+
+            fitted = emulandice_fit_AIS(pipeline_id)
+
+            projected = emulandice_project_AIS(
+                pipeline_id,
+                preprocess_data=preprocessed,
+                fit_data=fitted,
+                output_dir=str(emulandice_r_output_dir),
+                output_gslr_file=output_gslr_file,
+                output_eais_file=output_gslr_eais_file,
+                output_wais_file=output_gslr_wais_file,
+                output_pen_file=output_gslr_pen_file,
+                dtype=precision,
+                predictor=predictor,
+                response_table_file=response_table_file,
+                realizations=realizations,
+                output_report_file=output_report_file,
+            )
+
+        emulandice_postprocess_AIS(
+            my_data=projected,
+            locationfile=location_file,
+            chunksize=chunksize,
+            locations=_locations(location_file, chunksize, location_shard),
+            sites=sites.result(),
+            fingerprint_pack=fingerprint_pack,
+            pipeline_id=pipeline_id,
+            fprint_wais_file=fprint_wais_file,
+            fprint_eais_file=fprint_eais_file,
+            output_lslr_file=output_lslr_file,
+            output_factors_file=output_lslr_factors_file,
+            output_eais_file=output_lslr_eais_file,
+            output_wais_file=output_lslr_wais_file,
+        )
+
     logger.info("emulandice ais complete")
 
 
@@ -238,6 +503,13 @@ def ais(
     type=str,
     default=None,
 )
+@click.option(
+    "--output-lslr-factors-file",
+    envvar="EMULANDICE_OUTPUT_LSLR_FACTORS_FILE",
+    help="Path to write local SLR factorized into the global SLR of each component and its fingerprint at each location, read with emulandice.io.open_lslr_factors [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--forcing-head-path",
     envvar="EMULANDICE_FORCING_HEAD_PATH",
@@ -251,25 +523,132 @@ def ais(
     help="Base year to which projections should be referenced.",
     default=2005,
 )
+@click.option(
+    "--target-years",
+    envvar="EMULANDICE_TARGET_YEARS",
+    help="Years to project, given as Y1,Y2,..., like 2050,2100, between 2016 and 2100 [default=every decade from 2020 to 2100].",
+    type=str,
+    default=None,
+    callback=_parse_target_years,
+)
 @click.option(
     "--chunksize",
     envvar="EMULANDICE_CHUNKSIZE",
     help="Number of locations to process at a time [default=50].",
     default=50,
 )
+@click.option(
+    "--precision",
+    envvar="EMULANDICE_PRECISION",
+    help="Floating point precision used to compute projections and localized sea-level change [default=float64].",
+    type=click.Choice(["float64", "float32"]),
+    default="float64",
+)
+@click.option(
+    "--scheduler",
+    envvar="EMULANDICE_SCHEDULER",
+    help="Dask scheduler used for localization and writing output [default=threads].",
+    type=click.Choice(SCHEDULERS),
+    default="threads",
+)
+@click.option(
+    "--num-workers",
+    envvar="EMULANDICE_NUM_WORKERS",
+    help="Number of dask workers, also used as the thread count for R [default=all cores].",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--memory-limit",
+    envvar="EMULANDICE_MEMORY_LIMIT",
+    help="Total memory limit, like '8GB', for R and the processes or distributed schedulers [default=no limit].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--predictor",
+    envvar="EMULANDICE_PREDICTOR",
+    help="Predict and sample projections in R; fit and export emulators in R and predict them with NumPy in full ('numpy') or from response tables ('table'); or predict in R and sample with NumPy ('moments') [default=r].",
+    type=click.Choice(PREDICTORS),
+    default="r",
+)
+@click.option(
+    "--response-table-file",
+    envvar="EMULANDICE_RESPONSE_TABLE_FILE",
+    help="netCDF file of response tables for the 'table' predictor, reused if built from the same emulators and covering the sampled inputs, and written otherwise [default=tabulate each run].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--realizations",
+    envvar="EMULANDICE_REALIZATIONS",
+    help="Number of projections drawn per temperature sample by the 'moments' predictor, realization r of sample i being sample r * nsamps + i [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--output-report-file",
+    envvar="EMULANDICE_OUTPUT_REPORT_FILE",
+    help="Path to write a JSON run report with the emulator fit, prediction and total seconds and rows written of each R region [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--location-file",
     envvar="EMULANDICE_LOCATION_FILE",
-    help="File containing name, id, lat, and lon of points for localization.",
+    help="File containing name, id, lat, and lon of points for localization, required without --grid.",
     type=str,
-    required=True,
+    default=None,
+)
+@click.option(
+    "--location-shard",
+    envvar="EMULANDICE_LOCATION_SHARD",
+    help="Localize only block I of N of the locations, given as I/N, for merging with 'emulandice shard concat' [default=all locations].",
+    type=str,
+    default=None,
+    callback=_parse_location_shard,
+)
+@click.option(
+    "--fingerprint-pack",
+    envvar="EMULANDICE_FINGERPRINT_PACK",
+    help="Fingerprint pack written by 'emulandice pack-fingerprints' to read fingerprints from, by file name [default=read the netCDF files].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--grid/--no-grid",
+    envvar="EMULANDICE_GRID",
+    help="Localize on the cells of the fingerprint grid, using fingerprint values without interpolation, instead of at the locations in --location-file [default=no-grid].",
+    default=False,
+)
+@click.option(
+    "--grid-box",
+    envvar="EMULANDICE_GRID_BOX",
+    help="Box of grid cells to localize with --grid, given as S,N,W,E in degrees, like -60,0,-80,20 [default=whole grid].",
+    type=str,
+    default=None,
+    callback=_parse_grid_box,
+)
+@click.option(
+    "--grid-stride",
+    envvar="EMULANDICE_GRID_STRIDE",
+    help="Localize every Nth grid row and column with --grid [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--region-weights-file",
+    envvar="EMULANDICE_REGION_WEIGHTS_FILE",
+    help="CSV of region, location and optional weight columns; localize the weighted average of the locations in --location-file of each region instead of each location [default=None].",
+    type=str,
+    default=None,
 )
 @click.option(
     "--fprint-gis-file",
     envvar="EMULANDICE_FPRINT_GIS_FILE",
-    help="File containing GIS fingerprint data.",
+    help="File containing GIS fingerprint data [default=fprint_gis.nc in --fingerprint-pack].",
     type=str,
-    required=True,
+    default=None,
 )
 def gris(
     input_data_file,
@@ -277,9 +656,25 @@ def gris(
     pipeline_id,
     output_gslr_file,
     output_lslr_file,
+    output_lslr_factors_file,
     baseyear,
+    target_years,
     chunksize,
+    precision,
+    scheduler,
+    num_workers,
+    memory_limit,
+    predictor,
+    response_table_file,
+    realizations,
+    output_report_file,
     location_file,
+    location_shard,
+    fingerprint_pack,
+    grid,
+    grid_box,
+    grid_stride,
+    region_weights_file,
     fprint_gis_file,
 ):
     """
@@ -287,39 +682,81 @@ def gris(
     """
     logger.info("Starting emulandice gris")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        forcing_path = tmpdir / "facts_climate_forcing.csv"
-        emulandice_r_output_dir = tmpdir / "results"
-        emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
-
-        preprocessed = emulandice_preprocess(
-            input_data_file,
-            baseyear,
-            pipeline_id,
-            headfile=forcing_head_path,
-            outfile=forcing_path,
+    # Check paths up front, and load the sites and fingerprints while R runs
+    _check_locations(location_file, location_shard, grid, region_weights_file)
+    _check_realizations(predictor, realizations)
+    (fprint_gis_file,) = fingerprint_options(
+        fingerprint_pack, fprint_gis_file=fprint_gis_file
+    ).values()
+    fingerprint_files = [fprint_gis_file]
+    check_fingerprints(fingerprint_files, fingerprint_pack)
+    check_paths(
+        [input_data_file, forcing_head_path, location_file, region_weights_file],
+        [
+            output_gslr_file,
+            output_lslr_file,
+            output_lslr_factors_file,
+            output_report_file,
+        ],
+    )
+
+    with (
+        execution_backend(scheduler, num_workers, memory_limit),
+        ThreadPoolExecutor(max_workers=1) as pool,
+    ):
+        sites = pool.submit(
+            load_locations,
+            location_file,
+            fingerprint_files,
+            pack_file=fingerprint_pack,
+            grid=grid,
+            grid_box=grid_box,
+            grid_stride=grid_stride,
+            region_weights_file=region_weights_file,
         )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            forcing_path = tmpdir / "facts_climate_forcing.csv"
+            emulandice_r_output_dir = tmpdir / "results"
+            emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
+
+            preprocessed = emulandice_preprocess(
+                input_data_file,
+                baseyear,
+                pipeline_id,
+                headfile=forcing_head_path,
+                outfile=forcing_path,
+                target_years=target_years,
+            )
 
-        fitted = emulandice_fit_GrIS(pipeline_id)
+            fitted = emulandice_fit_GrIS(pipeline_id)
 
-        projected = emulandice_project_GrIS(
+            projected = emulandice_project_GrIS(
+                pipeline_id=pipeline_id,
+                preprocess_data=preprocessed,
+                fit_data=fitted,
+                output_dir=str(emulandice_r_output_dir),
+                output_gslr_file=output_gslr_file,
+                dtype=precision,
+                predictor=predictor,
+                response_table_file=response_table_file,
+                realizations=realizations,
+                output_report_file=output_report_file,
+            )
+
+        emulandice_postprocess_GrIS(
+            my_data=projected,
+            locationfile=location_file,
+            chunksize=chunksize,
+            locations=_locations(location_file, chunksize, location_shard),
+            sites=sites.result(),
+            fingerprint_pack=fingerprint_pack,
             pipeline_id=pipeline_id,
-            preprocess_data=preprocessed,
-            fit_data=fitted,
-            output_dir=str(emulandice_r_output_dir),
-            output_gslr_file=output_gslr_file,
+            fprint_gis_file=fprint_gis_file,
+            output_lslr_file=output_lslr_file,
+            output_factors_file=output_lslr_factors_file,
         )
 
-    emulandice_postprocess_GrIS(
-        my_data=projected,
-        locationfile=location_file,
-        chunksize=chunksize,
-        pipeline_id=pipeline_id,
-        fprint_gis_file=fprint_gis_file,
-        output_lslr_file=output_lslr_file,
-    )
-
     logger.info("emulandice gris complete")
 
 
@@ -347,9 +784,9 @@ def gris(
 @click.option(
     "--fprint-glacier-dir",
     envvar="EMULANDICE_FPRINT_GLACIER_DIR",
-    help="Path to directory containing glacier fprint files.",
+    help="Path to directory containing glacier fprint files [default=files in --fingerprint-pack].",
     type=str,
-    required=True,
+    default=None,
 )
 @click.option(
     "--output-lslr-file",
@@ -358,6 +795,13 @@ def gris(
     type=str,
     default=None,
 )
+@click.option(
+    "--output-lslr-factors-file",
+    envvar="EMULANDICE_OUTPUT_LSLR_FACTORS_FILE",
+    help="Path to write local SLR factorized into the global SLR of each component and its fingerprint at each location, read with emulandice.io.open_lslr_factors [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--forcing-head-path",
     envvar="EMULANDICE_FORCING_HEAD_PATH",
@@ -368,9 +812,9 @@ def gris(
 @click.option(
     "--fprint-map-file",
     envvar="EMULANDICE_FPRINT_MAP_FILE",
-    help="Path to the fingerprint region map CSV file.",
+    help="Path to the fingerprint region map CSV file [default=map in --fingerprint-pack].",
     type=str,
-    required=True,
+    default=None,
 )
 @click.option(
     "--output-glacier-dir",
@@ -379,24 +823,145 @@ def gris(
     type=str,
     default=None,
 )
+@click.option(
+    "--output-gslr-regions-file",
+    envvar="EMULANDICE_OUTPUT_GSLR_REGIONS_FILE",
+    help="Path to write the global SLR of every glacier region to one file, with a region dimension and one region per chunk [default=None].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--output-lslr-regions-file",
+    envvar="EMULANDICE_OUTPUT_LSLR_REGIONS_FILE",
+    help="Path to write the local SLR of every glacier region to one file, localized in the same pass as --output-lslr-file, with a region dimension and one region per chunk [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--baseyear",
     envvar="EMULANDICE_BASEYEAR",
     help="Base year to which projections should be referenced.",
     default=2005,
 )
+@click.option(
+    "--target-years",
+    envvar="EMULANDICE_TARGET_YEARS",
+    help="Years to project, given as Y1,Y2,..., like 2050,2100, between 2016 and 2100 [default=every decade from 2020 to 2100].",
+    type=str,
+    default=None,
+    callback=_parse_target_years,
+)
 @click.option(
     "--chunksize",
     envvar="EMULANDICE_CHUNKSIZE",
     help="Number of locations to process at a time [default=50].",
     default=50,
 )
+@click.option(
+    "--precision",
+    envvar="EMULANDICE_PRECISION",
+    help="Floating point precision used to compute projections and localized sea-level change [default=float64].",
+    type=click.Choice(["float64", "float32"]),
+    default="float64",
+)
+@click.option(
+    "--scheduler",
+    envvar="EMULANDICE_SCHEDULER",
+    help="Dask scheduler used for localization and writing output [default=threads].",
+    type=click.Choice(SCHEDULERS),
+    default="threads",
+)
+@click.option(
+    "--num-workers",
+    envvar="EMULANDICE_NUM_WORKERS",
+    help="Number of dask workers, also used as the thread count for R [default=all cores].",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--memory-limit",
+    envvar="EMULANDICE_MEMORY_LIMIT",
+    help="Total memory limit, like '8GB', for R and the processes or distributed schedulers [default=no limit].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--predictor",
+    envvar="EMULANDICE_PREDICTOR",
+    help="Predict and sample projections in R; fit and export emulators in R and predict them with NumPy in full ('numpy') or from response tables ('table'); or predict in R and sample with NumPy ('moments') [default=r].",
+    type=click.Choice(PREDICTORS),
+    default="r",
+)
+@click.option(
+    "--response-table-file",
+    envvar="EMULANDICE_RESPONSE_TABLE_FILE",
+    help="netCDF file of response tables for the 'table' predictor, reused if built from the same emulators and covering the sampled inputs, and written otherwise [default=tabulate each run].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--realizations",
+    envvar="EMULANDICE_REALIZATIONS",
+    help="Number of projections drawn per temperature sample by the 'moments' predictor, realization r of sample i being sample r * nsamps + i [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--output-report-file",
+    envvar="EMULANDICE_OUTPUT_REPORT_FILE",
+    help="Path to write a JSON run report with the emulator fit, prediction and total seconds and rows written of each R region [default=None].",
+    type=str,
+    default=None,
+)
 @click.option(
     "--location-file",
     envvar="EMULANDICE_LOCATION_FILE",
-    help="File containing name, id, lat, and lon of points for localization.",
+    help="File containing name, id, lat, and lon of points for localization, required without --grid.",
     type=str,
-    required=True,
+    default=None,
+)
+@click.option(
+    "--location-shard",
+    envvar="EMULANDICE_LOCATION_SHARD",
+    help="Localize only block I of N of the locations, given as I/N, for merging with 'emulandice shard concat' [default=all locations].",
+    type=str,
+    default=None,
+    callback=_parse_location_shard,
+)
+@click.option(
+    "--fingerprint-pack",
+    envvar="EMULANDICE_FINGERPRINT_PACK",
+    help="Fingerprint pack written by 'emulandice pack-fingerprints' to read fingerprints from, by file name [default=read the netCDF files].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--grid/--no-grid",
+    envvar="EMULANDICE_GRID",
+    help="Localize on the cells of the fingerprint grid, using fingerprint values without interpolation, instead of at the locations in --location-file [default=no-grid].",
+    default=False,
+)
+@click.option(
+    "--grid-box",
+    envvar="EMULANDICE_GRID_BOX",
+    help="Box of grid cells to localize with --grid, given as S,N,W,E in degrees, like -60,0,-80,20 [default=whole grid].",
+    type=str,
+    default=None,
+    callback=_parse_grid_box,
+)
+@click.option(
+    "--grid-stride",
+    envvar="EMULANDICE_GRID_STRIDE",
+    help="Localize every Nth grid row and column with --grid [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--region-weights-file",
+    envvar="EMULANDICE_REGION_WEIGHTS_FILE",
+    help="CSV of region, location and optional weight columns; localize the weighted average of the locations in --location-file of each region instead of each location [default=None].",
+    type=str,
+    default=None,
 )
 def glaciers(
     input_data_file,
@@ -405,50 +970,472 @@ def glaciers(
     fprint_map_file,
     output_gslr_file,
     output_lslr_file,
+    output_lslr_factors_file,
     fprint_glacier_dir,
     output_glacier_dir,
+    output_gslr_regions_file,
+    output_lslr_regions_file,
     baseyear,
+    target_years,
     chunksize,
+    precision,
+    scheduler,
+    num_workers,
+    memory_limit,
+    predictor,
+    response_table_file,
+    realizations,
+    output_report_file,
     location_file,
+    location_shard,
+    fingerprint_pack,
+    grid,
+    grid_box,
+    grid_stride,
+    region_weights_file,
 ):
     """
     Project sealevel rise from glaciers
     """
     logging.info("Starting emulandice glaciers")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        forcing_path = tmpdir / "facts_climate_forcing.csv"
-        emulandice_r_output_dir = tmpdir / "results"
-        emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
-
-        preprocessed = emulandice_preprocess(
-            input_data_file,
-            baseyear,
-            pipeline_id,
-            headfile=forcing_head_path,
-            outfile=forcing_path,
+    # Check paths up front, and load the sites and fingerprints while R runs
+    _check_locations(location_file, location_shard, grid, region_weights_file)
+    _check_realizations(predictor, realizations)
+    fprint_glacier_dir, fprint_map_file = fingerprint_options(
+        fingerprint_pack,
+        fprint_glacier_dir=fprint_glacier_dir,
+        fprint_map_file=fprint_map_file,
+    ).values()
+    if fprint_map_file is not None:
+        check_paths([fprint_map_file])
+    fingerprint_files = glacier_fingerprint_files(
+        fprint_map_file, fprint_glacier_dir, fingerprint_pack
+    )
+    check_fingerprints(fingerprint_files, fingerprint_pack)
+    check_paths(
+        [input_data_file, forcing_head_path, location_file, region_weights_file],
+        [
+            output_gslr_file,
+            output_lslr_file,
+            output_lslr_factors_file,
+            output_glacier_dir,
+            output_gslr_regions_file,
+            output_lslr_regions_file,
+            output_report_file,
+        ],
+    )
+
+    with (
+        execution_backend(scheduler, num_workers, memory_limit),
+        ThreadPoolExecutor(max_workers=1) as pool,
+    ):
+        sites = pool.submit(
+            load_locations,
+            location_file,
+            fingerprint_files,
+            pack_file=fingerprint_pack,
+            grid=grid,
+            grid_box=grid_box,
+            grid_stride=grid_stride,
+            region_weights_file=region_weights_file,
         )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            forcing_path = tmpdir / "facts_climate_forcing.csv"
+            emulandice_r_output_dir = tmpdir / "results"
+            emulandice_r_output_dir.mkdir(parents=True, exist_ok=True)
+
+            preprocessed = emulandice_preprocess(
+                input_data_file,
+                baseyear,
+                pipeline_id,
+                headfile=forcing_head_path,
+                outfile=forcing_path,
+                target_years=target_years,
+            )
 
-        fitted = emulandice_fit_glaciers(pipeline_id)
+            fitted = emulandice_fit_glaciers(pipeline_id)
 
-        projected = emulandice_project_glaciers(
+            projected = emulandice_project_glaciers(
+                pipeline_id=pipeline_id,
+                preprocess_data=preprocessed,
+                fit_data=fitted,
+                output_dir=str(emulandice_r_output_dir),
+                output_gslr_file=output_gslr_file,
+                output_glacier_dir=output_glacier_dir,
+                output_regions_file=output_gslr_regions_file,
+                dtype=precision,
+                predictor=predictor,
+                response_table_file=response_table_file,
+                realizations=realizations,
+                output_report_file=output_report_file,
+            )
+
+        emulandice_postprocess_glaciers(
+            my_data=projected,
+            locationfile=location_file,
+            chunksize=chunksize,
+            locations=_locations(location_file, chunksize, location_shard),
+            sites=sites.result(),
+            fingerprint_pack=fingerprint_pack,
             pipeline_id=pipeline_id,
-            preprocess_data=preprocessed,
-            fit_data=fitted,
-            output_dir=str(emulandice_r_output_dir),
-            output_gslr_file=output_gslr_file,
-            output_glacier_dir=output_glacier_dir,
+            fprint_map_file=fprint_map_file,
+            fprint_glacier_dir=fprint_glacier_dir,
+            output_lslr_file=output_lslr_file,
+            output_factors_file=output_lslr_factors_file,
+            output_regions_file=output_lslr_regions_file,
         )
 
-    emulandice_postprocess_glaciers(
-        my_data=projected,
-        locationfile=location_file,
-        chunksize=chunksize,
-        pipeline_id=pipeline_id,
-        fprint_map_file=fprint_map_file,
-        fprint_glacier_dir=fprint_glacier_dir,
-        output_lslr_file=output_lslr_file,
+    logging.info("emulandice glaciers complete")
+
+
+@main.command("pack-fingerprints")
+@click.option(
+    "--output-file",
+    envvar="EMULANDICE_FINGERPRINT_PACK",
+    help="Path to write the fingerprint pack.",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--fprint-wais-file",
+    envvar="EMULANDICE_FPRINT_WAIS_FILE",
+    help="File containing WAIS fingerprint data [default=not packed].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--fprint-eais-file",
+    envvar="EMULANDICE_FPRINT_EAIS_FILE",
+    help="File containing EAIS fingerprint data [default=not packed].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--fprint-gis-file",
+    envvar="EMULANDICE_FPRINT_GIS_FILE",
+    help="File containing GIS fingerprint data [default=not packed].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--fprint-map-file",
+    envvar="EMULANDICE_FPRINT_MAP_FILE",
+    help="Path to the fingerprint region map CSV file, whose glacier fingerprints are packed with the map [default=not packed].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--fprint-glacier-dir",
+    envvar="EMULANDICE_FPRINT_GLACIER_DIR",
+    help="Path to directory containing glacier fprint files, needed with --fprint-map-file.",
+    type=str,
+    default=None,
+)
+def pack_fingerprints_command(
+    output_file,
+    fprint_wais_file,
+    fprint_eais_file,
+    fprint_gis_file,
+    fprint_map_file,
+    fprint_glacier_dir,
+):
+    """
+    Pack fingerprint grids into one memory-mapped file for --fingerprint-pack
+    """
+    fingerprint_files = [
+        f for f in (fprint_wais_file, fprint_eais_file, fprint_gis_file) if f
+    ]
+    if fprint_map_file is not None:
+        if fprint_glacier_dir is None:
+            raise click.UsageError("--fprint-map-file needs --fprint-glacier-dir")
+        check_paths([fprint_map_file])
+        fingerprint_files += glacier_fingerprint_files(
+            fprint_map_file, fprint_glacier_dir
+        )
+    if not fingerprint_files:
+        raise click.UsageError("Give at least one fingerprint file or map to pack")
+    check_paths(fingerprint_files, [output_file])
+
+    logger.info("Packing %d fingerprints", len(fingerprint_files))
+    pack_fingerprints(output_file, fingerprint_files, fprint_map_file)
+    logger.info("Wrote fingerprint pack %s", output_file)
+
+
+@main.command("all")
+@click.option(
+    "--ais",
+    "ais_args",
+    envvar="EMULANDICE_AIS_ARGS",
+    help="Options of the ais command, quoted as one string [default=skip AIS].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--gris",
+    "gris_args",
+    envvar="EMULANDICE_GRIS_ARGS",
+    help="Options of the gris command, quoted as one string [default=skip GrIS].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--glaciers",
+    "glaciers_args",
+    envvar="EMULANDICE_GLACIERS_ARGS",
+    help="Options of the glaciers command, quoted as one string [default=skip glaciers].",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--r-slots",
+    envvar="EMULANDICE_R_SLOTS",
+    help="Number of R emulator runs at a time [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--cpu-slots",
+    envvar="EMULANDICE_CPU_SLOTS",
+    help="Number of preprocess and localization stages at a time [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--io-slots",
+    envvar="EMULANDICE_IO_SLOTS",
+    help="Number of site and fingerprint loading stages at a time [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--scheduler",
+    envvar="EMULANDICE_SCHEDULER",
+    help="Dask scheduler used for localization and writing output [default=threads].",
+    type=click.Choice(SCHEDULERS),
+    default="threads",
+)
+@click.option(
+    "--num-workers",
+    envvar="EMULANDICE_NUM_WORKERS",
+    help="Number of dask workers, also used as the thread count for R [default=all cores].",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--memory-limit",
+    envvar="EMULANDICE_MEMORY_LIMIT",
+    help="Total memory limit, like '8GB', for R and the processes or distributed schedulers [default=no limit].",
+    type=str,
+    default=None,
+)
+@click.pass_context
+def all_sources(
+    ctx,
+    ais_args,
+    gris_args,
+    glaciers_args,
+    r_slots,
+    cpu_slots,
+    io_slots,
+    scheduler,
+    num_workers,
+    memory_limit,
+):
+    """
+    Project sealevel rise from several ice sources at once, overlapping their stages
+    """
+    sources = {}
+    for ice_source, args in (
+        ("ais", ais_args),
+        ("gris", gris_args),
+        ("glaciers", glaciers_args),
+    ):
+        if args is not None:
+            command = main.get_command(ctx, ice_source)
+            sources[ice_source] = command.make_context(
+                ice_source, shlex.split(args), parent=ctx.parent
+            ).params
+    if not sources:
+        raise click.UsageError("Give the options of at least one ice source")
+
+    logger.info("Starting emulandice all for %s", ", ".join(sources))
+    run_pipeline(
+        sources,
+        slots={"r": r_slots, "cpu": cpu_slots, "io": io_slots},
+        scheduler=scheduler,
+        num_workers=num_workers,
+        memory_limit=memory_limit,
     )
+    logger.info("emulandice all complete")
 
-    logging.info("emulandice glaciers complete")
+
+@main.command
+@click.option(
+    "--socket",
+    "socket_path",
+    envvar="EMULANDICE_SOCKET",
+    help="Path of the Unix socket to listen on.",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--max-jobs",
+    envvar="EMULANDICE_MAX_JOBS",
+    help="Number of jobs run at a time, each with its own R session; others wait in a queue [default=1].",
+    type=click.IntRange(min=1),
+    default=1,
+)
+@click.option(
+    "--scheduler",
+    envvar="EMULANDICE_SCHEDULER",
+    help="Dask scheduler used for localization and writing output [default=threads].",
+    type=click.Choice(SCHEDULERS),
+    default="threads",
+)
+@click.option(
+    "--num-workers",
+    envvar="EMULANDICE_NUM_WORKERS",
+    help="Number of dask workers, also used as the thread count for R [default=all cores].",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--memory-limit",
+    envvar="EMULANDICE_MEMORY_LIMIT",
+    help="Total memory limit, like '8GB', for R and the processes or distributed schedulers [default=no limit].",
+    type=str,
+    default=None,
+)
+@click.pass_context
+def serve(ctx, socket_path, max_jobs, scheduler, num_workers, memory_limit):
+    """
+    Serve ice source jobs on a Unix socket, keeping sites, fingerprints and R warm
+    """
+
+    def parse_job(ice_source, args):
+        command = main.get_command(ctx, ice_source)
+        try:
+            return command.make_context(ice_source, args, parent=ctx.parent).params
+        except click.ClickException as err:
+            raise ValueError(err.format_message()) from None
+
+    serving.serve(
+        socket_path,
+        parse_job,
+        max_jobs=max_jobs,
+        scheduler=scheduler,
+        num_workers=num_workers,
+        memory_limit=memory_limit,
+    )
+
+
+@main.group
+def shard():
+    """
+    Split one run over batch nodes that share a filesystem
+    """
+
+
+@shard.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "--workdir",
+    envvar="EMULANDICE_SHARD_WORKDIR",
+    help="Shared directory for the manifest and shard outputs.",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--sample-shards",
+    envvar="EMULANDICE_SAMPLE_SHARDS",
+    help="Number of blocks to split the samples into [default=1].",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--location-shards",
+    envvar="EMULANDICE_LOCATION_SHARDS",
+    help="Number of blocks to split the locations into [default=1].",
+    type=int,
+    default=1,
+)
+@click.argument("ice_source", type=click.Choice(sharding.ICE_SOURCES))
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def plan(ctx, workdir, sample_shards, location_shards, ice_source, args):
+    """
+    Plan the shards of an ice source command, given with its options as ARGS
+    """
+    command = main.get_command(ctx, ice_source)
+    params = command.make_context(ice_source, list(args), parent=ctx.parent).params
+    manifest = sharding.plan(
+        workdir, ice_source, params, sample_shards, location_shards
+    )
+    click.echo(len(manifest["shards"]))
+
+
+@shard.command
+@click.option(
+    "--workdir",
+    envvar="EMULANDICE_SHARD_WORKDIR",
+    help="Shared directory for the manifest and shard outputs.",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--index",
+    envvar="EMULANDICE_SHARD_INDEX",
+    help="Index of the shard to run, from 0.",
+    type=int,
+    required=True,
+)
+def run(workdir, index):
+    """
+    Run one shard of a planned run
+    """
+    logger.info("Starting emulandice shard %d", index)
+    sharding.run(workdir, index)
+    logger.info("emulandice shard %d complete", index)
+
+
+@shard.command
+@click.option(
+    "--workdir",
+    envvar="EMULANDICE_SHARD_WORKDIR",
+    help="Shared directory for the manifest and shard outputs.",
+    type=str,
+    required=True,
+)
+def merge(workdir):
+    """
+    Merge the shards of a finished run into its output files
+    """
+    logger.info("Starting emulandice shard merge")
+    sharding.merge(workdir)
+    logger.info("emulandice shard merge complete")
+
+
+@shard.command
+@click.option(
+    "--output-lslr-file",
+    envvar="EMULANDICE_OUTPUT_LSLR_FILE",
+    help="Path to write the concatenated local SLR file.",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--chunksize",
+    envvar="EMULANDICE_CHUNKSIZE",
+    help="Number of locations per chunk of the output, as given to the shards [default=as the first file].",
+    type=int,
+    default=None,
+)
+@click.argument("lslr_files", nargs=-1, required=True)
+def concat(output_lslr_file, chunksize, lslr_files):
+    """
+    Concatenate local SLR files from --location-shard runs, given in shard order
+    """
+    logger.info("Starting emulandice shard concat")
+    sharding.concat_locations(list(lslr_files), output_lslr_file, chunksize)
+    logger.info("emulandice shard concat complete")
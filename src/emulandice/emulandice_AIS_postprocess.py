@@ -1,10 +1,11 @@
+import math
 import numpy as np
 import time
 import argparse
-from emulandice.read_locationfile import ReadLocationFile
-from emulandice.AssignFP import AssignFP
+from emulandice.execution import localization_backend
+from emulandice.io import factors_dataset, factors_encoding, lslr_dataset, to_netcdf
+from emulandice.sites import Grid, Regions, Sites, load_sites
 
-import xarray as xr
 import dask.array as da
 
 """ emulandice_postprocess_AIS.py
@@ -20,9 +21,15 @@ def emulandice_postprocess_AIS(
     pipeline_id,
     fprint_wais_file,
     fprint_eais_file,
-    output_lslr_file: str,
+    output_lslr_file: str | None,
     output_eais_file: str | None = None,
     output_wais_file: str | None = None,
+    output_factors_file: str | None = None,
+    backend: str = "auto",
+    samples: slice = slice(None),
+    locations: slice = slice(None),
+    sites: Sites | Grid | Regions | None = None,
+    fingerprint_pack: str | None = None,
 ):
     waissamps = my_data["waissamps"]
     eaissamps = my_data["eaissamps"]
@@ -31,19 +38,35 @@ def emulandice_postprocess_AIS(
     baseyear = my_data["baseyear"]
     preprocess_infile = my_data["preprocess_infile"]
 
-    # Load the site locations
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
-
+    # Load the site locations and fingerprints, unless prepared while projecting
+    if sites is None:
+        sites = load_sites(
+            locationfile,
+            [fprint_wais_file, fprint_eais_file],
+            locations,
+            pack_file=fingerprint_pack,
+        )
+    else:
+        sites = sites[locations]
     # Get some dimension data from the loaded data structures
     nsamps = waissamps.shape[0]
 
-    # Get the fingerprints for all sites from all ice sheets
-    waisfp = da.array(AssignFP(fprint_wais_file, site_lats, site_lons))
-    eaisfp = da.array(AssignFP(fprint_eais_file, site_lats, site_lons))
+    # Keep only this shard's samples; sample ids still count from the full ensemble
+    sample_ids = np.arange(nsamps)[samples]
+    waissamps = waissamps[samples]
+    eaissamps = eaissamps[samples]
 
-    # Rechunk the fingerprints for memory
-    waisfp = waisfp.rechunk(chunksize)
-    eaisfp = eaisfp.rechunk(chunksize)
+    # Get the fingerprints for all sites from all ice sheets, matching the
+    # precision of the projections
+    waisfp = sites.fingerprint(fprint_wais_file, waissamps.dtype)
+    eaisfp = sites.fingerprint(fprint_eais_file, eaissamps.dtype)
+
+    # Small outputs are localized in memory, larger ones as chunked dask arrays
+    backend = localization_backend(backend, waissamps.size * math.prod(sites.shape))
+    if backend == "dask":
+        # Rechunk the fingerprints for memory
+        waisfp = da.array(waisfp).rechunk(chunksize)
+        eaisfp = da.array(eaisfp).rechunk(chunksize)
 
     # Apply the fingerprints to the projections
     waissl = np.multiply.outer(waissamps, waisfp)
@@ -52,9 +75,6 @@ def emulandice_postprocess_AIS(
     # Add up the east and west components for AIS total
     aissl = waissl + eaissl
 
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
-
     # Create the xarray data structures for the localized projections
     ncvar_attributes = {
         "description": "Local SLR contributions from icesheet according to emulandice AIS workflow",
@@ -65,98 +85,46 @@ def emulandice_postprocess_AIS(
         "preprocess_infile": preprocess_infile,
     }
 
-    ais_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                aissl,
-                {"units": "mm", "missing_value": nc_missing_value},
+    # Write the global SLR of each component with its fingerprints, from which
+    # open_lslr_factors reconstructs the local SLR
+    if output_factors_file is not None:
+        fingerprints = np.stack([waisfp, eaisfp])
+        to_netcdf(
+            factors_dataset(
+                np.stack([waissamps, eaissamps]),
+                fingerprints,
+                ["wais", "eais"],
+                sites,
+                targyears,
+                sample_ids,
+                ncvar_attributes,
             ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
-        attrs=ncvar_attributes,
-    )
-
-    # Write the netcdf output files
-    ais_out.to_netcdf(
-        output_lslr_file,
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
-
-    if output_wais_file is not None:
-        wais_out = xr.Dataset(
-            {
-                "sea_level_change": (
-                    ("samples", "years", "locations"),
-                    waissl,
-                    {"units": "mm", "missing_value": nc_missing_value},
-                ),
-                "lat": (("locations"), site_lats),
-                "lon": (("locations"), site_lons),
-            },
-            coords={
-                "years": targyears,
-                "locations": site_ids,
-                "samples": np.arange(nsamps),
-            },
-            attrs=ncvar_attributes,
-        )
-        wais_out.to_netcdf(
-            output_wais_file,
-            encoding={
-                "sea_level_change": {
-                    "dtype": "f4",
-                    "zlib": True,
-                    "complevel": 4,
-                    "_FillValue": nc_missing_value,
-                }
-            },
+            output_factors_file,
+            encoding=factors_encoding(fingerprints.shape, chunksize),
         )
 
-    if output_eais_file is not None:
-        eais_out = xr.Dataset(
-            {
-                "sea_level_change": (
-                    ("samples", "years", "locations"),
-                    eaissl,
-                    {"units": "mm", "missing_value": nc_missing_value},
+    local_slr = {
+        "ais": lslr_dataset(aissl, sites, targyears, sample_ids, ncvar_attributes),
+        "eais": lslr_dataset(eaissl, sites, targyears, sample_ids, ncvar_attributes),
+        "wais": lslr_dataset(waissl, sites, targyears, sample_ids, ncvar_attributes),
+    }
+
+    # Write the netcdf output files
+    for name, output_file in (
+        ("ais", output_lslr_file),
+        ("eais", output_eais_file),
+        ("wais", output_wais_file),
+    ):
+        if output_file is not None:
+            to_netcdf(
+                local_slr[name],
+                output_file,
+                encoding=sites.encoding(
+                    local_slr[name]["sea_level_change"].shape, chunksize
                 ),
-                "lat": (("locations"), site_lats),
-                "lon": (("locations"), site_lons),
-            },
-            coords={
-                "years": targyears,
-                "locations": site_ids,
-                "samples": np.arange(nsamps),
-            },
-            attrs=ncvar_attributes,
-        )
-        eais_out.to_netcdf(
-            "{0}_{1}_localsl.nc".format(pipeline_id, "EAIS"),
-            encoding={
-                "sea_level_change": {
-                    "dtype": "f4",
-                    "zlib": True,
-                    "complevel": 4,
-                    "_FillValue": nc_missing_value,
-                }
-            },
-        )
+            )
 
-    return None
+    return local_slr
 
 
 if __name__ == "__main__":
@@ -1,79 +1,26 @@
 import numpy as np
-import os
 import sys
 import argparse
-import re
 from scipy.stats import truncnorm
 
-from emulandice.r_helper import run_emulandice
-from emulandice.io import WriteNetCDF
+from emulandice.emulator import predict_projections
+from emulandice.r_helper import prediction_years, run_emulandice
+from emulandice.io import ProjectionReader, WriteNetCDF, gslr_dataset
 
 
 # For AIS, there are three regions (WAIS, EAIS, and PEN)
-def ExtractProjections(emulandice_file):
-    # Initialize
-    ice_sources = []
-    regions = []
-    years = []
-    samples = []
-    sles = []
-
-    # Open the emulandice_file for reading
+def ExtractProjections(emulandice_file, dtype="float64"):
+    reader = ProjectionReader("AIS")
     with open(emulandice_file, "r") as f:
-        # Skip the header line
-        _ = f.readline()
-
-        # Load the rest of the data
-        for line in f:
-            lp = re.split(",", line)
-            ice_sources.append(lp[0])
-            regions.append(lp[1])
-            years.append(int(lp[2]))
-            samples.append(int(lp[3]))
-            sles.append(float(lp[7]))
-
-    # Convert to numpy arrays
-    ice_sources = np.array(ice_sources)
-    regions = np.array(regions)
-    years = np.array(years)
-    samples = np.array(samples)
-    sles = np.array(sles)
-
-    # Extract the target years
-    targyears = np.unique(years)
-    unique_samples = np.unique(samples)
-
-    # Initialize the return data structure
-    wais_data = np.full((len(unique_samples), len(targyears)), np.nan)
-    eais_data = np.full((len(unique_samples), len(targyears)), np.nan)
-    pen_data = np.full((len(unique_samples), len(targyears)), np.nan)
-
-    # Loop over all the entries
-    for i in np.arange(len(sles)):
-        # This sample
-        this_icesource = ice_sources[i]
-        this_region = regions[i]
-        this_year = years[i]
-        this_sample = samples[i]
-        this_sle = sles[i]
-
-        # Skip this entry if it's not for AIS
-        if this_icesource != "AIS":
-            continue
-
-        # Which index will this entry be filling?
-        year_idx = np.flatnonzero(targyears == this_year)
-        sample_idx = this_sample - 1
-
-        # Put the data into the return data structure
-        if this_region == "WAIS":
-            wais_data[sample_idx, year_idx] = this_sle * 10.0  # Convert cm to mm
-        elif this_region == "EAIS":
-            eais_data[sample_idx, year_idx] = this_sle * 10.0  # Convert cm to mm
-        else:
-            pen_data[sample_idx, year_idx] = this_sle * 10.0  # Convert cm to mm
+        reader.feed(f.read())
+    return _ais_samples(reader, dtype)
 
-    # Done
+
+def _ais_samples(reader, dtype):
+    # WAIS, EAIS and PEN samples and target years from the emulandice output
+    (wais_data, eais_data, pen_data), targyears = reader.cube(
+        ["WAIS", "EAIS", "PEN"], dtype=dtype
+    )
     return (wais_data, eais_data, pen_data, targyears)
 
 
@@ -82,48 +29,73 @@ def emulandice_project_AIS(
     preprocess_data: dict,
     fit_data: dict,
     output_dir,
-    output_gslr_file: str,
+    output_gslr_file: str | None,
     output_eais_file: str | None = None,
     output_wais_file: str | None = None,
     output_pen_file: str | None = None,
     icesource: str = "AIS",
+    dtype: str = "float64",
+    predictor: str = "r",
+    response_table_file: str | None = None,
+    output_report_file: str | None = None,
+    realizations: int = 1,
 ) -> dict:
     preprocess_infile = preprocess_data["infile"]
     baseyear = preprocess_data["baseyear"]
     scenario = preprocess_data["scenario"]
     nsamps = preprocess_data["nsamps"]
+    target_years = preprocess_data.get("target_years")
 
     trend_mean = fit_data["trend_mean"]
     trend_sd = fit_data["trend_sd"]
 
-    # Run the module using the FACTS forcing data
+    # Run the module using the FACTS forcing data, parsing R's sample projections as
+    # they are written
 
     emulandice_dataset = preprocess_data["facts_data_file"]
-    run_emulandice(
+    reader = ProjectionReader(icesource)
+    progress = run_emulandice(
         emulandice_dataset=emulandice_dataset,
         nsamps=nsamps,
         icesource=icesource,
         outdir=output_dir,
+        export_emulators=predictor in ("numpy", "table"),
+        output_moments=predictor == "moments",
+        on_projections=reader.feed if predictor == "r" else None,
+        years=prediction_years(icesource, target_years) if target_years else None,
     )
-
-    # Get the output from the emulandice run
-    emulandice_file = os.path.join(output_dir, "projections_FAIR_FACTS.csv")
-    wais_samples, eais_samples, pen_samples, targyears = ExtractProjections(
-        emulandice_file
-    )
-
-    # Make sure we get the number of samples we expected
-    if nsamps != wais_samples.shape[0]:
+    if output_report_file is not None:
+        progress.write_report(output_report_file)
+
+    # Get the output from the emulandice run, or sample it from exported emulators or moments
+    if predictor != "r":
+        region_samples, targyears = predict_projections(
+            output_dir,
+            icesource,
+            dtype=dtype,
+            predictor=predictor,
+            table_file=response_table_file,
+            realizations=realizations,
+        )
+        wais_samples = region_samples["WAIS"]
+        eais_samples = region_samples["EAIS"]
+        pen_samples = region_samples["PEN"]
+    else:
+        wais_samples, eais_samples, pen_samples, targyears = _ais_samples(reader, dtype)
+
+    # Make sure we get the number of samples we expected, for each realization
+    if realizations * nsamps != wais_samples.shape[0]:
         raise Exception(
             "Number of SLC projections does not match number of temperature trajectories: {} != {}".format(
-                wais_samples.shape[0], nsamps
+                wais_samples.shape[0], realizations * nsamps
             )
         )
 
     # Generate samples for trends correlated among ice sheets
     # Note: Keep seed hard-coded and matched with GrIS module within emulandice module set
+    # Every realization of a sample shares its trends
     rng = np.random.default_rng(8071)
-    trend_q = rng.random(nsamps)
+    trend_q = np.tile(rng.random(nsamps), realizations)
 
     # Calculate the trend contributions over time for each ice sheet component
     eais_trend = (
@@ -160,52 +132,44 @@ def emulandice_project_AIS(
         "preprocess_infile": preprocess_infile,
     }
 
-    # Write the global projections to netcdf files
-    WriteNetCDF(
-        eais_samples + wais_samples + pen_samples,
-        targyears,
-        baseyear,
-        scenario,
-        nsamps,
-        pipeline_id,
-        nc_filename=output_gslr_file,
-        nc_description="Global SLR contribution from Antarctica using the emulandice module",
-    )
-
-    if output_eais_file is not None:
-        WriteNetCDF(
+    # Keep the global projections as datasets, and write those given files to netcdf
+    global_slr = {
+        "ais": (
+            eais_samples + wais_samples + pen_samples,
+            output_gslr_file,
+            "Global SLR contribution from Antarctica using the emulandice module",
+        ),
+        "eais": (
             eais_samples,
-            targyears,
-            baseyear,
-            scenario,
-            nsamps,
-            pipeline_id,
-            nc_filename=output_eais_file,
-            nc_description="Global SLR contribution from Antarctica (EAIS) using the emulandice module",
-        )
-
-    if output_wais_file is not None:
-        WriteNetCDF(
+            output_eais_file,
+            "Global SLR contribution from Antarctica (EAIS) using the emulandice module",
+        ),
+        "wais": (
             wais_samples,
-            targyears,
-            baseyear,
-            scenario,
-            nsamps,
-            pipeline_id,
-            nc_filename=output_wais_file,
-            nc_description="Global SLR contribution from Antarctica (WAIS) using the emulandice module",
-        )
-
-    if output_pen_file is not None:
-        WriteNetCDF(
+            output_wais_file,
+            "Global SLR contribution from Antarctica (WAIS) using the emulandice module",
+        ),
+        "pen": (
             pen_samples,
-            targyears,
-            baseyear,
-            scenario,
-            nsamps,
-            pipeline_id,
-            nc_filename=output_pen_file,
-            nc_description="Global SLR contribution from Antarctica (PEN) using the emulandice module",
+            output_pen_file,
+            "Global SLR contribution from Antarctica (PEN) using the emulandice module",
+        ),
+    }
+    output["gslr"] = {}
+    for name, (slr, nc_filename, nc_description) in global_slr.items():
+        if nc_filename is not None:
+            WriteNetCDF(
+                slr,
+                targyears,
+                baseyear,
+                scenario,
+                realizations * nsamps,
+                pipeline_id,
+                nc_filename=nc_filename,
+                nc_description=nc_description,
+            )
+        output["gslr"][name] = gslr_dataset(
+            slr, targyears, baseyear, scenario, pipeline_id, nc_description
         )
 
     return output
@@ -1,10 +1,11 @@
+import math
 import numpy as np
 import time
 import argparse
-from emulandice.read_locationfile import ReadLocationFile
-from emulandice.AssignFP import AssignFP
+from emulandice.execution import localization_backend
+from emulandice.io import factors_dataset, factors_encoding, lslr_dataset, to_netcdf
+from emulandice.sites import Grid, Regions, Sites, load_sites
 
-import xarray as xr
 import dask.array as da
 
 """ emulandice_postprocess_GrIS.py
@@ -19,7 +20,13 @@ def emulandice_postprocess_GrIS(
     chunksize,
     pipeline_id,
     fprint_gis_file,
-    output_lslr_file: str,
+    output_lslr_file: str | None,
+    output_factors_file: str | None = None,
+    backend: str = "auto",
+    samples: slice = slice(None),
+    locations: slice = slice(None),
+    sites: Sites | Grid | Regions | None = None,
+    fingerprint_pack: str | None = None,
 ):
     gissamps = my_data["gissamps"]
     targyears = my_data["targyears"]
@@ -27,24 +34,33 @@ def emulandice_postprocess_GrIS(
     baseyear = my_data["baseyear"]
     preprocess_infile = my_data["preprocess_infile"]
 
-    # Load the site locations
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
-
+    # Load the site locations and fingerprints, unless prepared while projecting
+    if sites is None:
+        sites = load_sites(
+            locationfile, [fprint_gis_file], locations, pack_file=fingerprint_pack
+        )
+    else:
+        sites = sites[locations]
     # Get some dimension data from the loaded data structures
     nsamps = gissamps.shape[0]
 
-    # Get the fingerprints for all sites from all ice sheets
-    gisfp = da.array(AssignFP(fprint_gis_file, site_lats, site_lons))
+    # Keep only this shard's samples; sample ids still count from the full ensemble
+    sample_ids = np.arange(nsamps)[samples]
+    gissamps = gissamps[samples]
+
+    # Get the fingerprints for all sites from all ice sheets, matching the
+    # precision of the projections
+    gisfp = sites.fingerprint(fprint_gis_file, gissamps.dtype)
 
-    # Rechunk the fingerprints for memory
-    gisfp = gisfp.rechunk(chunksize)
+    # Small outputs are localized in memory, larger ones as chunked dask arrays
+    backend = localization_backend(backend, gissamps.size * math.prod(sites.shape))
+    if backend == "dask":
+        # Rechunk the fingerprints for memory
+        gisfp = da.array(gisfp).rechunk(chunksize)
 
     # Apply the fingerprints to the projections
     gissl = np.multiply.outer(gissamps, gisfp)
 
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
-
     # Create the xarray data structures for the localized projections
     ncvar_attributes = {
         "description": "Local SLR contributions from icesheet according to emulandice GrIS workflow",
@@ -55,36 +71,35 @@ def emulandice_postprocess_GrIS(
         "preprocess_infile": preprocess_infile,
     }
 
-    gis_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                gissl,
-                {"units": "mm", "missing_value": nc_missing_value},
+    # Write the global SLR of each component with its fingerprints, from which
+    # open_lslr_factors reconstructs the local SLR
+    if output_factors_file is not None:
+        fingerprints = gisfp[np.newaxis]
+        to_netcdf(
+            factors_dataset(
+                gissamps[np.newaxis],
+                fingerprints,
+                ["gris"],
+                sites,
+                targyears,
+                sample_ids,
+                ncvar_attributes,
             ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
-        attrs=ncvar_attributes,
-    )
+            output_factors_file,
+            encoding=factors_encoding(fingerprints.shape, chunksize),
+        )
+
+    gis_out = lslr_dataset(gissl, sites, targyears, sample_ids, ncvar_attributes)
 
     # Write the netcdf output files
-    gis_out.to_netcdf(
-        output_lslr_file,
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
+    if output_lslr_file is not None:
+        to_netcdf(
+            gis_out,
+            output_lslr_file,
+            encoding=sites.encoding(gissl.shape, chunksize),
+        )
+
+    return {"gris": gis_out}
 
 
 if __name__ == "__main__":
@@ -1,66 +1,24 @@
 import numpy as np
-import os
 import sys
 import argparse
-import re
 from scipy.stats import truncnorm
 
-from emulandice.r_helper import run_emulandice
-from emulandice.io import WriteNetCDF
+from emulandice.emulator import predict_projections
+from emulandice.r_helper import prediction_years, run_emulandice
+from emulandice.io import ProjectionReader, WriteNetCDF, gslr_dataset
 
 
-def ExtractProjections(emulandice_file):
-    # Initialize
-    # ice_sources = []
-    # regions = []
-    years = []
-    samples = []
-    sles = []
-
-    # Open the emulandice_file for reading
+def ExtractProjections(emulandice_file, dtype="float64"):
+    reader = ProjectionReader("GrIS")
     with open(emulandice_file, "r") as f:
-        # Skip the header line
-        _ = f.readline()
-
-        # Load the rest of the data
-        for line in f:
-            lp = re.split(",", line)
-            # ice_sources.append(lp[0])
-            # regions.append(lp[1])
-            years.append(int(lp[2]))
-            samples.append(int(lp[3]))
-            sles.append(float(lp[7]))
-
-    # Convert to numpy arrays
-    # ice_sources = np.array(ice_sources)
-    # regions = np.array(regions)
-    years = np.array(years)
-    samples = np.array(samples)
-    sles = np.array(sles)
-
-    # Extract the target years
-    targyears = np.unique(years)
-    unique_samples = np.unique(samples)
-
-    # Initialize the return data structure
-    ret_data = np.full((len(unique_samples), len(targyears)), np.nan)
-
-    # Loop over all the entries
-    for i in np.arange(len(sles)):
-        # This sample
-        this_year = years[i]
-        this_sample = samples[i]
-        this_sle = sles[i]
-
-        # Which index will this entry be filling?
-        year_idx = np.flatnonzero(targyears == this_year)
-        sample_idx = this_sample - 1
-
-        # Put the data into the return data structure
-        ret_data[sample_idx, year_idx] = this_sle * 10.0  # Convert cm to mm
+        reader.feed(f.read())
+    return _gris_samples(reader, dtype)
 
-    # Done
-    return (ret_data, targyears)
+
+def _gris_samples(reader, dtype):
+    # Samples and target years of the single GrIS region from the emulandice output
+    ret_data, targyears = reader.cube(dtype=dtype)
+    return (ret_data[0], targyears)
 
 
 def emulandice_project_GrIS(
@@ -68,43 +26,68 @@ def emulandice_project_GrIS(
     preprocess_data: dict,
     fit_data: dict,
     output_dir,
-    output_gslr_file: str,
+    output_gslr_file: str | None,
     icesource="GrIS",
+    dtype="float64",
+    predictor="r",
+    response_table_file=None,
+    output_report_file=None,
+    realizations=1,
 ):
     preprocess_infile = preprocess_data["infile"]
     baseyear = preprocess_data["baseyear"]
     scenario = preprocess_data["scenario"]
     nsamps = preprocess_data["nsamps"]
+    target_years = preprocess_data.get("target_years")
 
     trend_mean = fit_data["trend_mean"]
     trend_sd = fit_data["trend_sd"]
 
-    # Run the module using the FACTS forcing data
+    # Run the module using the FACTS forcing data, parsing R's sample projections as
+    # they are written
 
     emulandice_dataset = preprocess_data["facts_data_file"]
-    run_emulandice(
+    reader = ProjectionReader(icesource)
+    progress = run_emulandice(
         emulandice_dataset=emulandice_dataset,
         nsamps=nsamps,
         icesource=icesource,
         outdir=output_dir,
+        export_emulators=predictor in ("numpy", "table"),
+        output_moments=predictor == "moments",
+        on_projections=reader.feed if predictor == "r" else None,
+        years=prediction_years(icesource, target_years) if target_years else None,
     )
+    if output_report_file is not None:
+        progress.write_report(output_report_file)
+
+    # Get the output from the emulandice run, or sample it from exported emulators or moments
+    if predictor != "r":
+        region_samples, targyears = predict_projections(
+            output_dir,
+            icesource,
+            dtype=dtype,
+            predictor=predictor,
+            table_file=response_table_file,
+            realizations=realizations,
+        )
+        samples = region_samples["ALL"]
+    else:
+        samples, targyears = _gris_samples(reader, dtype)
 
-    # Get the output from the emulandice run
-    emulandice_file = os.path.join(output_dir, "projections_FAIR_FACTS.csv")
-    samples, targyears = ExtractProjections(emulandice_file)
-
-    # Make sure we get the number of samples we expected
-    if nsamps != samples.shape[0]:
+    # Make sure we get the number of samples we expected, for each realization
+    if realizations * nsamps != samples.shape[0]:
         raise Exception(
             "Number of SLC projections does not match number of temperature trajectories: {} != {}".format(
-                samples.shape[0], nsamps
+                samples.shape[0], realizations * nsamps
             )
         )
 
     # Generate samples for trends correlated among ice sheets
     # Note: Keep seed hard-coded and matched with AIS module within emulandice module set
+    # Every realization of a sample shares its trends
     rng = np.random.default_rng(8071)
-    trend_q = rng.random(nsamps)
+    trend_q = np.tile(rng.random(nsamps), realizations)
 
     # Calculate the trend contributions over time for each ice sheet component
     gis_trend = (
@@ -126,17 +109,26 @@ def emulandice_project_GrIS(
         "preprocess_infile": preprocess_infile,
     }
 
-    # Write the global projections to netcdf files
-    WriteNetCDF(
-        samples,
-        targyears,
-        baseyear,
-        scenario,
-        nsamps,
-        pipeline_id,
-        nc_filename=output_gslr_file,
-        nc_description="Global SLR contribution from Greenland using the emulandice module",
+    # Keep the global projections as a dataset, and write them to netcdf if given a file
+    nc_description = (
+        "Global SLR contribution from Greenland using the emulandice module"
     )
+    if output_gslr_file is not None:
+        WriteNetCDF(
+            samples,
+            targyears,
+            baseyear,
+            scenario,
+            realizations * nsamps,
+            pipeline_id,
+            nc_filename=output_gslr_file,
+            nc_description=nc_description,
+        )
+    output["gslr"] = {
+        "gris": gslr_dataset(
+            samples, targyears, baseyear, scenario, pipeline_id, nc_description
+        )
+    }
 
     return output
 
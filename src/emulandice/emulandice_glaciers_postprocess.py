@@ -1,11 +1,20 @@
+import math
 import numpy as np
 import os
 import time
 import argparse
-from emulandice.read_locationfile import ReadLocationFile
-from emulandice.AssignFP import AssignFP
-
-import xarray as xr
+from emulandice.execution import localization_backend
+from emulandice.fingerprints import read_glacier_map
+from emulandice.io import (
+    factors_dataset,
+    factors_encoding,
+    lslr_dataset,
+    regions_encoding,
+    to_netcdf,
+)
+from emulandice.sites import Grid, Regions, Sites, glacier_fingerprint_files, load_sites
+
+import dask
 import dask.array as da
 
 """ emulandice_postprocess_glaciers.py
@@ -21,7 +30,14 @@ def emulandice_postprocess_glaciers(
     pipeline_id,
     fprint_map_file,
     fprint_glacier_dir,
-    output_lslr_file: str,
+    output_lslr_file: str | None,
+    output_regions_file: str | None = None,
+    output_factors_file: str | None = None,
+    backend: str = "auto",
+    samples: slice = slice(None),
+    locations: slice = slice(None),
+    sites: Sites | Grid | Regions | None = None,
+    fingerprint_pack: str | None = None,
 ):
     gicsamps = my_data["gic_samps"]
     targyears = my_data["targyears"]
@@ -29,26 +45,45 @@ def emulandice_postprocess_glaciers(
     baseyear = my_data["baseyear"]
     preprocess_infile = my_data["preprocess_infile"]
 
-    # Load the fingerprint metadata
-    fpmap_data = np.genfromtxt(
-        fprint_map_file,
-        dtype=None,
-        names=True,
-        delimiter=",",
-    )
-
-    # Extract the data
-    fpmapperids = fpmap_data["IceID"]
-    fpmaps = fpmap_data["FPID"]
+    # Load the fingerprint metadata, from the pack if no map file is given
+    fpmapperids, fpmaps = read_glacier_map(fprint_map_file, fingerprint_pack)
 
-    # Load the site locations
-    _, site_ids, site_lats, site_lons = ReadLocationFile(locationfile)
+    # Load the site locations and fingerprints, unless prepared while projecting
+    if sites is None:
+        sites = load_sites(
+            locationfile,
+            glacier_fingerprint_files(
+                fprint_map_file, fprint_glacier_dir, fingerprint_pack
+            ),
+            locations,
+            pack_file=fingerprint_pack,
+        )
+    else:
+        sites = sites[locations]
 
     # Initialize variable to hold the localized projections
     gicsamps = np.transpose(gicsamps, (1, 0, 2))
+
+    # Keep only this shard's samples; sample ids still count from the full ensemble
+    sample_ids = np.arange(gicsamps.shape[0])[samples]
+    gicsamps = gicsamps[samples]
     (nsamps, nregions, nyears) = gicsamps.shape
-    nsites = len(site_ids)
-    local_sl = da.zeros((nsamps, nyears, nsites), chunks=(-1, -1, chunksize))
+
+    # Small outputs are localized in memory, larger ones as chunked dask arrays
+    shape = (nsamps, nyears, *sites.shape)
+    backend = localization_backend(backend, math.prod(shape))
+    if backend == "dask":
+        local_sl = da.zeros(
+            shape,
+            chunks=(-1, -1, *[chunksize] * len(sites.shape)),
+            dtype=gicsamps.dtype,
+        )
+    else:
+        local_sl = np.zeros(shape, dtype=gicsamps.dtype)
+
+    # Contributions and fingerprints of each region, kept if they are written too
+    region_sl = []
+    region_fp = []
 
     # Loop through the GIC regions
     for i in range(nregions):
@@ -60,16 +95,18 @@ def emulandice_postprocess_glaciers(
         regionfile = os.path.join(
             fprint_glacier_dir, "fprint_{0}.nc".format(thisRegion)
         )
-        regionfp = da.from_array(
-            AssignFP(regionfile, site_lats, site_lons), chunks=chunksize
-        )
+        regionfp = sites.fingerprint(regionfile, gicsamps.dtype)
+        if backend == "dask":
+            regionfp = da.from_array(regionfp, chunks=chunksize)
 
         # Multiply the fingerprints and the projections and add them to the running total
         # over the regions
-        local_sl += np.multiply.outer(gicsamps[:, i, :], regionfp)
-
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
+        this_sl = np.multiply.outer(gicsamps[:, i, :], regionfp)
+        local_sl += this_sl
+        if output_regions_file is not None:
+            region_sl.append(this_sl)
+        if output_factors_file is not None:
+            region_fp.append(regionfp)
 
     # Create the xarray data structures for the localized projections
     ncvar_attributes = {
@@ -81,35 +118,60 @@ def emulandice_postprocess_glaciers(
         "preprocess_infile": preprocess_infile,
     }
 
-    glac_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                local_sl,
-                {"units": "mm", "missing_value": nc_missing_value},
+    stack = da.stack if backend == "dask" else np.stack
+
+    # Write the global SLR of each component with its fingerprints, from which
+    # open_lslr_factors reconstructs the local SLR
+    if output_factors_file is not None:
+        fingerprints = stack(region_fp)
+        to_netcdf(
+            factors_dataset(
+                np.transpose(gicsamps, (1, 0, 2)),
+                fingerprints,
+                [f"region_{i + 1}" for i in range(nregions)],
+                sites,
+                targyears,
+                sample_ids,
+                ncvar_attributes,
             ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
-        attrs=ncvar_attributes,
-    )
+            output_factors_file,
+            encoding=factors_encoding(fingerprints.shape, chunksize),
+        )
 
-    glac_out.to_netcdf(
-        output_lslr_file,
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
+    glac_out = lslr_dataset(local_sl, sites, targyears, sample_ids, ncvar_attributes)
+    local_slr = {"glaciers": glac_out}
+    glac_encoding = sites.encoding(local_sl.shape, chunksize)
+    if output_regions_file is None:
+        if output_lslr_file is not None:
+            to_netcdf(glac_out, output_lslr_file, encoding=glac_encoding)
+        return local_slr
+
+    # Regional contributions in one file, one region per chunk
+    local_slr["regions"] = lslr_dataset(
+        stack(region_sl),
+        sites,
+        targyears,
+        sample_ids,
+        ncvar_attributes,
+        regions=np.arange(1, nregions + 1),
     )
+    writes = [
+        to_netcdf(
+            local_slr["regions"],
+            output_regions_file,
+            encoding=regions_encoding(glac_encoding, (nregions, *local_sl.shape)),
+            compute=False,
+        )
+    ]
+    if output_lslr_file is not None:
+        writes.append(
+            to_netcdf(glac_out, output_lslr_file, encoding=glac_encoding, compute=False)
+        )
+
+    # Write both files in one pass, so each region is localized once
+    dask.compute(*writes)
+
+    return local_slr
 
 
 if __name__ == "__main__":
@@ -1,83 +1,80 @@
 from pathlib import Path
 import numpy as np
-import os
 import sys
 import argparse
-import re
 from scipy.stats import norm
 
-from emulandice.r_helper import run_emulandice
-from emulandice.io import WriteNetCDF
+from emulandice.emulator import predict_projections
+from emulandice.r_helper import GLACIER_TREND_YEARS, prediction_years, run_emulandice
+from emulandice.io import (
+    GSLR_ENCODING,
+    ProjectionReader,
+    WriteNetCDF,
+    gslr_dataset,
+    regions_dataset,
+    regions_encoding,
+    to_netcdf,
+)
 
 
 # For glaciers, there are 19 regions
-def ExtractProjections(emulandice_file):
-    # Initialize
-    ice_sources = []
-    regions = []
-    years = []
-    samples = []
-    sles = []
-
-    # Open the emulandice_file for reading
+def ExtractProjections(emulandice_file, dtype="float64"):
+    reader = ProjectionReader("Glaciers")
     with open(emulandice_file, "r") as f:
-        # Skip the header line
-        _ = f.readline()
-
-        # Load the rest of the data
-        for line in f:
-            lp = re.split(",", line)
-            ice_sources.append(lp[0])
-            regions.append(lp[1])
-            years.append(int(lp[2]))
-            samples.append(int(lp[3]))
-            sles.append(float(lp[7]))
-
-    # Convert to numpy arrays
-    ice_sources = np.array(ice_sources)
-    regions = np.array(regions)
-    years = np.array(years)
-    samples = np.array(samples)
-    sles = np.array(sles)
-
-    # Extract the unique target years, samples, and regions
-    targyears = np.unique(years)
-    unique_samples = np.unique(samples)
-    unique_regions = np.unique(regions)
-
-    # Initialize the return data structure
-    ret_data = np.full(
-        (len(unique_regions), len(unique_samples), len(targyears)), np.nan
-    )
-
-    # Pre-compile the regular expression that extracts region number
-    region_regex = re.compile("^region_(\d+)$")
-
-    # Loop over all the entries
-    for i in np.arange(len(sles)):
-        # This sample
-        this_icesource = ice_sources[i]
-        this_region = regions[i]
-        this_year = years[i]
-        this_sample = samples[i]
-        this_sle = sles[i]
-
-        # Skip this entry if it's not for AIS
-        if this_icesource != "Glaciers":
-            continue
-
-        # Which index will this entry be filling?
-        year_idx = np.flatnonzero(targyears == this_year)
-        sample_idx = this_sample - 1
+        reader.feed(f.read())
+    return _glacier_samples(reader, dtype)
+
+
+def _glacier_samples(reader, dtype):
+    # Samples of each region, in order of region number, and target years from the
+    # emulandice output. Postprocessing pairs the i-th region with fingerprint i + 1, so
+    # the regions must be numbered from 1 without gaps
+    regions = [f"region_{i + 1}" for i in range(len(reader.regions))]
+    if sorted(reader.regions) != sorted(regions):
+        raise ValueError(
+            f"Expected glacier regions region_1 to region_{len(regions)} in the "
+            f"emulandice output, got {', '.join(sorted(reader.regions))}"
+        )
+    return reader.cube(regions, dtype=dtype)
+
+
+def _add_trends(samples, targyears, baseyear, trend_mean, trend_sd, nsamps):
+    # Add the glacier trends to `samples` (regions, samples, years) in place, shared among
+    # the regions by their melt over the first projection decade, GLACIER_TREND_YEARS.
+    # Full runs start with that decade, and runs for target years always predict it, so
+    # both add the same trends whatever other years they predict. Samples hold one block
+    # of `nsamps` per realization, and every realization of a sample shares its trend
+    trend_idx = [np.flatnonzero(targyears == year) for year in GLACIER_TREND_YEARS]
+    if any(len(idx) == 0 for idx in trend_idx):
+        raise ValueError(
+            f"Glacier projections need the years {GLACIER_TREND_YEARS} for their trends"
+        )
+    syear_idx, eyear_idx = (int(idx[0]) for idx in trend_idx)
 
-        region_rematch = region_regex.match(this_region)
-        region_idx = int(region_rematch.group(1)) - 1
+    # Find the ratio of melt over the first decade of projection years
+    region_melt = []
+    total_melt = 0.0
+    for x in np.arange(samples.shape[0]):
+        this_melt = np.nanmean(samples[x, :, eyear_idx]) - np.nanmean(
+            samples[x, :, syear_idx]
+        )
+        total_melt += this_melt
+        region_melt.append(this_melt)
+    region_melt = np.array(region_melt)
+    melt_ratio = region_melt / total_melt
 
-        # Put the data into the return data structure
-        ret_data[region_idx, sample_idx, year_idx] = this_sle * 10.0  # Convert cm to mm
+    # Generate samples for trends correlated among ice sources
+    # Note: Keep seed hard-coded and matched with AIS and GrIS module within emulandice module set
+    rng = np.random.default_rng(8071)
+    trend_q = np.tile(rng.random(nsamps), samples.shape[1] // nsamps)
+    glac_trend = norm.ppf(trend_q, trend_mean, trend_sd) * (
+        targyears[syear_idx] - baseyear
+    )
 
-    # Done
-    return (ret_data, targyears)
+    # Apply the trends for the baseline adjustment
+    for x in np.arange(samples.shape[0]):
+        this_trend = glac_trend * melt_ratio[x]
+        samples[x, :, :] += this_trend[:, np.newaxis]
 
 
 def emulandice_project_glaciers(
@@ -85,67 +82,75 @@ def emulandice_project_glaciers(
     preprocess_data: dict,
     fit_data: dict,
     output_dir,
-    output_gslr_file: str,
+    output_gslr_file: str | None,
     output_glacier_dir: str | None = None,
+    output_regions_file: str | None = None,
     icesource="Glaciers",
+    dtype="float64",
+    predictor="r",
+    response_table_file=None,
+    output_report_file=None,
+    realizations=1,
 ):
     preprocess_infile = preprocess_data["infile"]
     baseyear = preprocess_data["baseyear"]
     scenario = preprocess_data["scenario"]
     nsamps = preprocess_data["nsamps"]
+    target_years = preprocess_data.get("target_years")
 
     trend_mean = fit_data["trend_mean"]
     trend_sd = fit_data["trend_sd"]
 
-    # Run the module using the FACTS forcing data
+    # Run the module using the FACTS forcing data, parsing R's sample projections as
+    # they are written
 
     emulandice_dataset = preprocess_data["facts_data_file"]
-    run_emulandice(
+    reader = ProjectionReader(icesource)
+    progress = run_emulandice(
         emulandice_dataset=emulandice_dataset,
         nsamps=nsamps,
         icesource=icesource,
         outdir=output_dir,
+        export_emulators=predictor in ("numpy", "table"),
+        output_moments=predictor == "moments",
+        on_projections=reader.feed if predictor == "r" else None,
+        years=prediction_years(icesource, target_years) if target_years else None,
     )
+    if output_report_file is not None:
+        progress.write_report(output_report_file)
+
+    # Get the output from the emulandice run, or sample it from exported emulators or moments
+    if predictor != "r":
+        region_samples, targyears = predict_projections(
+            output_dir,
+            icesource,
+            dtype=dtype,
+            predictor=predictor,
+            table_file=response_table_file,
+            realizations=realizations,
+        )
+        samples = np.stack(
+            [region_samples[f"region_{i + 1}"] for i in range(len(region_samples))]
+        )
+    else:
+        samples, targyears = _glacier_samples(reader, dtype)
 
-    # Get the output from the emulandice run
-    emulandice_file = os.path.join(output_dir, "projections_FAIR_FACTS.csv")
-    samples, targyears = ExtractProjections(emulandice_file)
-
-    # Make sure we get the number of samples we expected
-    if nsamps != samples.shape[1]:
+    # Make sure we get the number of samples we expected, for each realization
+    if realizations * nsamps != samples.shape[1]:
         raise Exception(
             "Number of SLC projections does not match number of temperature trajectories: {} != {}".format(
-                samples.shape[1], nsamps
+                samples.shape[1], realizations * nsamps
             )
         )
 
-    # Find the ratio of melt over the first decade of projection years
-    syear_idx = 0
-    eyear_idx = np.max(np.flatnonzero(targyears <= (targyears[syear_idx] + 10)))
-
-    region_melt = []
-    total_melt = 0.0
-    for x in np.arange(samples.shape[0]):
-        this_melt = np.nanmean(samples[x, :, eyear_idx]) - np.nanmean(
-            samples[x, :, syear_idx]
-        )
-        total_melt += this_melt
-        region_melt.append(this_melt)
-    region_melt = np.array(region_melt)
-    melt_ratio = region_melt / total_melt
-
-    # Generate samples for trends correlated among ice sources
-    # Note: Keep seed hard-coded and matched with AIS and GrIS module within emulandice module set
-    rng = np.random.default_rng(8071)
-    trend_q = rng.random(nsamps)
-    glac_trend = norm.ppf(trend_q, trend_mean, trend_sd) * (
-        targyears[syear_idx] - baseyear
-    )
+    # Add the baseline trends, before dropping the years predicted only for them
+    _add_trends(samples, targyears, baseyear, trend_mean, trend_sd, nsamps)
 
-    # Apply the trends for the baseline adjustment
-    for x in np.arange(samples.shape[0]):
-        this_trend = glac_trend * melt_ratio[x]
-        samples[x, :, :] += this_trend[:, np.newaxis]
+    # Keep only the target years, dropping the years predicted for the trends
+    if target_years:
+        keep = np.isin(targyears, target_years)
+        samples = samples[:, :, keep]
+        targyears = targyears[keep]
 
     # Save the global projections to a pickle
     output = {
@@ -156,18 +161,39 @@ def emulandice_project_glaciers(
         "preprocess_infile": preprocess_infile,
     }
 
-    # Write the global projections to netcdf files
+    # Keep the global projections as a dataset, and write them to netcdf if given a file
     gic_global_slr = np.sum(samples, axis=0)
-    WriteNetCDF(
-        gic_global_slr,
-        targyears,
-        baseyear,
-        scenario,
-        nsamps,
-        pipeline_id,
-        nc_filename=output_gslr_file,
-        nc_description="Global SLR contribution from glaciers using the emulandice module",
+    nc_description = "Global SLR contribution from glaciers using the emulandice module"
+    if output_gslr_file is not None:
+        WriteNetCDF(
+            gic_global_slr,
+            targyears,
+            baseyear,
+            scenario,
+            realizations * nsamps,
+            pipeline_id,
+            nc_filename=output_gslr_file,
+            nc_description=nc_description,
+        )
+    output["gslr"] = {
+        "glaciers": gslr_dataset(
+            gic_global_slr, targyears, baseyear, scenario, pipeline_id, nc_description
+        )
+    }
+
+    # All regions in one dataset, with a region dimension
+    regions_description = (
+        "Global SLR contribution from each glacier region using the emulandice module"
+    )
+    output["gslr"]["regions"] = regions_dataset(
+        samples, targyears, baseyear, scenario, pipeline_id, regions_description
     )
+    if output_regions_file is not None:
+        to_netcdf(
+            output["gslr"]["regions"],
+            output_regions_file,
+            encoding=regions_encoding(GSLR_ENCODING, samples.shape),
+        )
 
     if output_glacier_dir is not None:
         p = Path(output_glacier_dir)
@@ -182,7 +208,7 @@ def emulandice_project_glaciers(
                 targyears,
                 baseyear,
                 scenario,
-                nsamps,
+                realizations * nsamps,
                 pipeline_id,
                 nc_filename=str(out_file),
                 nc_description=f"Global SLR contribution from glaciers (glac{idx}) using the emulandice module",
@@ -1,15 +1,20 @@
 import numpy as np
 import os
 import sys
+import csv
 import fnmatch
 import argparse
 import shutil
 from netCDF4 import Dataset
+import xarray as xr
+
+from emulandice.io import netcdf_lock
+from emulandice.r_helper import forcing_years
 
 
 def GetSamples(ncfile, years, baseyear):
     # Load the nc file
-    with Dataset(ncfile, "r") as nc:
+    with netcdf_lock(), Dataset(ncfile, "r") as nc:
         # Extract the variables
         ncyears = nc.variables["years"][...]
         samples = np.squeeze(nc.variables["surface_temperature"][...])
@@ -29,7 +34,111 @@ def GetSamples(ncfile, years, baseyear):
     return (samples, scenario)
 
 
-def WriteToCSV(outfile, samples, mode="w"):
+def StreamSamples(ncfile, years, baseyear, blocksize=1000):
+    """
+    Yield baseyear-referenced temperature samples in blocks of at most `blocksize` samples.
+
+    Only the baseyear and the requested years are read from disk, so peak memory is set by
+    the block size rather than by the ensemble size. Yields (first sample index, block) pairs
+    where each block has shape (samples in block, years).
+    """
+    # The file is only locked while it is read, not while the caller uses a block
+    with netcdf_lock():
+        nc = Dataset(ncfile, "r")
+    try:
+        with netcdf_lock():
+            ncyears = nc.variables["years"][...]
+            gsat = nc.variables["surface_temperature"]
+            nsamps = gsat.shape[0]
+            ndim = gsat.ndim
+            years_axis = gsat.dimensions.index("years")
+
+        # Indices of the baseyear and the years to extract along the years dimension
+        baseyear_idx = np.flatnonzero(ncyears == baseyear)
+        year_idx = np.flatnonzero(np.isin(ncyears, years))
+        read_idx = np.union1d(baseyear_idx, year_idx)
+        ref_pos = np.searchsorted(read_idx, baseyear_idx)
+        year_pos = np.searchsorted(read_idx, year_idx)
+
+        # Read the years of interest for one block of samples at a time
+        for start in range(0, nsamps, blocksize):
+            stop = min(start + blocksize, nsamps)
+            index = [slice(None)] * ndim
+            index[0] = slice(start, stop)
+            index[years_axis] = read_idx
+            with netcdf_lock():
+                block = gsat[tuple(index)]
+
+            # Squeeze out the location dimension (should be global temperature trajectories)
+            block = np.moveaxis(block, years_axis, 1).reshape(
+                stop - start, len(read_idx)
+            )
+
+            yield (start, block[:, year_pos] - block[:, ref_pos])
+    finally:
+        with netcdf_lock():
+            nc.close()
+
+
+def ArraySamples(gsat, years, baseyear, blocksize=1000):
+    """
+    Yield baseyear-referenced temperature samples from a DataArray, like StreamSamples.
+
+    `gsat` has "samples" and "years" dimensions, and any others must have length 1. Only
+    one block of samples is loaded at a time, so dask-backed samples are never loaded
+    whole.
+    """
+    gsat = gsat.squeeze([d for d in gsat.dims if d not in ("samples", "years")])
+    ncyears = gsat["years"].values
+    nsamps = gsat.sizes["samples"]
+
+    # Indices of the baseyear and the years to extract along the years dimension
+    baseyear_idx = np.flatnonzero(ncyears == baseyear)
+    year_idx = np.flatnonzero(np.isin(ncyears, years))
+    read_idx = np.union1d(baseyear_idx, year_idx)
+    ref_pos = np.searchsorted(read_idx, baseyear_idx)
+    year_pos = np.searchsorted(read_idx, year_idx)
+
+    for start in range(0, nsamps, blocksize):
+        stop = min(start + blocksize, nsamps)
+        block = (
+            gsat.isel(samples=slice(start, stop), years=read_idx)
+            .transpose("samples", "years")
+            .values
+        )
+        yield (start, block[:, year_pos] - block[:, ref_pos])
+
+
+def GetSampleInfo(ncfile):
+    with netcdf_lock(), Dataset(ncfile, "r") as nc:
+        return (nc.getncattr("Scenario"), nc.variables["surface_temperature"].shape[0])
+
+
+def WriteHead(headfile, outfile, years=None):
+    """
+    Copy the calibration forcing in `headfile` to `outfile`, keeping only `years` if given.
+
+    Year columns are named like "y2050"; the columns before them are always kept.
+    """
+    if years is None:
+        shutil.copyfile(headfile, outfile)
+        return
+
+    keep_years = {f"y{year}" for year in years}
+    with open(headfile, newline="") as fin, open(outfile, "w", newline="") as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout, lineterminator="\n")
+        header = next(reader)
+        columns = [
+            i
+            for i, name in enumerate(header)
+            if not name.startswith("y") or name in keep_years
+        ]
+        for row in [header, *reader]:
+            writer.writerow([row[i] for i in columns])
+
+
+def WriteToCSV(outfile, samples, mode="w", start=0):
     # Open the csv file
     with open(outfile, mode) as f:
         # Loop through the samples
@@ -38,7 +147,12 @@ def WriteToCSV(outfile, samples, mode="w"):
             out_string = ",".join(
                 [
                     str(x)
-                    for x in ["FAIR", "FAIR_{}".format(i + 1), "FACTS", *samples[i, :]]
+                    for x in [
+                        "FAIR",
+                        "FAIR_{}".format(start + i + 1),
+                        "FACTS",
+                        *samples[i, :],
+                    ]
                 ]
             )
 
@@ -50,7 +164,15 @@ def WriteToCSV(outfile, samples, mode="w"):
     return None
 
 
-def emulandice_preprocess(infile, baseyear, pipeline_id, headfile, outfile) -> dict:
+def emulandice_preprocess(
+    infile,
+    baseyear,
+    pipeline_id,
+    headfile,
+    outfile,
+    blocksize=1000,
+    target_years=None,
+) -> dict:
     # If no input file was passed, look for one produced by a pre-projection workflow
     if infile is None:
         indir = os.path.dirname(__file__)
@@ -61,18 +183,20 @@ def emulandice_preprocess(infile, baseyear, pipeline_id, headfile, outfile) -> d
             raise Exception("Unable to find a usable input file")
         infile = files[0]
 
-    # Years
-    years = np.arange(2015, 2101)
-
-    # Get the samples
-    samps, scenario = GetSamples(infile, years, baseyear)
+    # Years of the forcing, only those R needs for the target years if given
+    if not target_years:
+        years = np.arange(2015, 2101)
+        head_years = None
+    else:
+        years = head_years = forcing_years(target_years)
 
     # How many samples are we running?
-    nsamps = samps.shape[0]
+    scenario, nsamps = GetSampleInfo(infile)
 
-    # Append these samples to the output file
-    shutil.copyfile(headfile, outfile)
-    WriteToCSV(outfile, samps, mode="a")
+    # Stream the samples onto the end of the output file, one block at a time
+    WriteHead(headfile, outfile, head_years)
+    for start, samps in StreamSamples(infile, years, baseyear, blocksize=blocksize):
+        WriteToCSV(outfile, samps, mode="a", start=start)
 
     # Save the preprocessed data to a pickle
     output = {
@@ -81,10 +205,58 @@ def emulandice_preprocess(infile, baseyear, pipeline_id, headfile, outfile) -> d
         "infile": infile,
         "facts_data_file": str(outfile),
         "nsamps": nsamps,
+        "target_years": target_years,
     }
     return output
 
 
+def emulandice_preprocess_gsat(
+    gsat,
+    baseyear,
+    pipeline_id,
+    headfile,
+    outfile,
+    scenario=None,
+    blocksize=1000,
+    target_years=None,
+) -> dict:
+    """
+    Preprocess GSAT samples held in memory, like emulandice_preprocess does a file.
+
+    `gsat` is an xarray Dataset with a "surface_temperature" variable, laid out like the
+    input file, or that DataArray itself. The scenario defaults to its "Scenario"
+    attribute.
+    """
+    if isinstance(gsat, xr.Dataset):
+        scenario = gsat.attrs.get("Scenario") if scenario is None else scenario
+        gsat = gsat["surface_temperature"]
+    if scenario is None:
+        scenario = gsat.attrs.get("Scenario")
+    if scenario is None:
+        raise ValueError("GSAT samples have no Scenario attribute; give the scenario")
+
+    # Years of the forcing, only those R needs for the target years if given
+    if not target_years:
+        years = np.arange(2015, 2101)
+        head_years = None
+    else:
+        years = head_years = forcing_years(target_years)
+
+    # Stream the samples onto the end of the output file, one block at a time
+    WriteHead(headfile, outfile, head_years)
+    for start, samps in ArraySamples(gsat, years, baseyear, blocksize=blocksize):
+        WriteToCSV(outfile, samps, mode="a", start=start)
+
+    return {
+        "scenario": scenario,
+        "baseyear": baseyear,
+        "infile": gsat.encoding.get("source", "in-memory GSAT samples"),
+        "facts_data_file": str(outfile),
+        "nsamps": gsat.sizes["samples"],
+        "target_years": target_years,
+    }
+
+
 if __name__ == "__main__":
     # Initialize the argument parser
     parser = argparse.ArgumentParser(
@@ -0,0 +1,621 @@
+"""NumPy predictor for RobustGaSP emulators exported by the emulandice R package."""
+
+import csv
+import hashlib
+import itertools
+import logging
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+from scipy.interpolate import RegularGridInterpolator
+from scipy.linalg import solve_triangular
+
+from emulandice.io import netcdf_lock
+
+logger = logging.getLogger(__name__)
+
+PREDICTORS = ("r", "numpy", "table", "moments")
+
+KERNELS = ("pow_exp", "matern_3_2", "matern_5_2")
+
+# Columns of the exported prior inputs, in file order.
+PRIOR_INPUTS = ("temp", "melt", "collapse", "melt0")
+
+# Matches set.seed() in the R package's main().
+EMULATOR_SEED = 2020
+
+# Response table grid points for continuous inputs. Switches (collapse, melt0) are
+# tabulated at their sampled values.
+TABLE_POINTS = {"temp": 201, "melt": 41}
+
+# Largest difference (cm) between table interpolation and full prediction, at the
+# prior inputs, before a warning is logged.
+TABLE_TOLERANCE = 0.05
+
+
+@dataclass
+class GaSPEmulator:
+    """
+    Fitted RobustGaSP emulator with a constant plus linear trend and an estimated nugget.
+
+    Holds what `RobustGaSP::predict` uses: the scaled design and response, inverse range
+    (`beta`) and roughness (`alpha`) parameters, nugget, trend coefficients (`theta`),
+    variance, and the lower Cholesky factors of the correlation matrix plus nugget (`chol`)
+    and of the trend cross product X'R^-1X (`chol_trend`). `centre` and `scale` are the
+    input scaling applied in R before fitting.
+    """
+
+    inputs: tuple[str, ...]
+    kernel: str
+    centre: np.ndarray
+    scale: np.ndarray
+    beta: np.ndarray
+    alpha: np.ndarray
+    design: np.ndarray
+    output: np.ndarray
+    theta: np.ndarray
+    chol: np.ndarray
+    chol_trend: np.ndarray
+    nugget: float
+    sigma2: float
+    method: str = "post_mode"
+    cap: float = np.nan
+
+    def __post_init__(self):
+        if self.kernel not in KERNELS:
+            raise ValueError(
+                f"kernel must be one of {', '.join(KERNELS)}, got {self.kernel!r}"
+            )
+
+    @cached_property
+    def _trend(self) -> np.ndarray:
+        return _with_intercept(self.design)
+
+    @cached_property
+    def _chol_trend_design(self) -> np.ndarray:
+        # L^-1 X
+        return solve_triangular(self.chol, self._trend, lower=True)
+
+    @cached_property
+    def _weights(self) -> np.ndarray:
+        # R^-1 (y - X theta)
+        resid = self.output - self._trend @ self.theta
+        return solve_triangular(
+            self.chol.T,
+            solve_triangular(self.chol, resid, lower=True),
+            lower=False,
+        )
+
+    def correlation(self, x: np.ndarray) -> np.ndarray:
+        """Correlation between scaled inputs `x` (samples, inputs) and the design."""
+        r = np.ones((x.shape[0], self.design.shape[0]))
+        for k in range(self.design.shape[1]):
+            d = np.abs(x[:, k, np.newaxis] - self.design[np.newaxis, :, k])
+            r *= _kernel(d * self.beta[k], self.alpha[k], self.kernel)
+        return r
+
+    def predict(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Predict mean and standard deviation at unscaled inputs `x` (samples, inputs).
+
+        Columns of `x` follow `inputs`. Matches `RobustGaSP::predict` with its defaults,
+        including the nugget in the predictive variance and, for posterior mode
+        estimates, the Student-t variance inflation.
+        """
+        z = (np.asarray(x, dtype="float64") - self.centre) / self.scale
+        xt = _with_intercept(z)
+        r = self.correlation(z)
+
+        mean = xt @ self.theta + r @ self._weights
+
+        v = solve_triangular(self.chol, r.T, lower=True)
+        w = solve_triangular(
+            self.chol_trend, xt.T - self._chol_trend_design.T @ v, lower=True
+        )
+        c = 1.0 + self.nugget - np.sum(v**2, axis=0) + np.sum(w**2, axis=0)
+        var = np.abs(c) * self.sigma2
+
+        if self.method == "post_mode":
+            n, q = self._trend.shape
+            var *= (n - q) / (n - q - 2)
+
+        return mean, np.sqrt(var)
+
+    def sample(self, x: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """
+        Draw one projection per row of `x` from the emulator uncertainty.
+
+        As in R, the mean is capped before sampling and the samples again after it, for
+        emulators with a cap (glaciers).
+        """
+        return _sample(*self.predict(x), self.cap, rng)
+
+
+@dataclass
+class ResponseTable:
+    """
+    Emulator mean and standard deviation tabulated on a regular grid of its inputs.
+
+    `grid` has the unscaled grid values of each input, in `inputs` order. Inputs with a
+    single grid value are held fixed and are not interpolated.
+    """
+
+    inputs: tuple[str, ...]
+    grid: tuple[np.ndarray, ...]
+    mean: np.ndarray
+    sd: np.ndarray
+    cap: float = np.nan
+
+    @cached_property
+    def _interpolator(self) -> RegularGridInterpolator:
+        varying = [len(g) > 1 for g in self.grid]
+        shape = [len(g) for g, v in zip(self.grid, varying) if v]
+        values = np.stack([self.mean, self.sd], axis=-1).reshape(shape + [2])
+        # Linear extrapolation past the grid edges, like the emulator's linear trend
+        return RegularGridInterpolator(
+            [g for g, v in zip(self.grid, varying) if v],
+            values,
+            bounds_error=False,
+            fill_value=None,
+        )
+
+    def covers(self, x: np.ndarray) -> bool:
+        """Whether all unscaled inputs `x` (samples, inputs) are within the grid."""
+        x = np.asarray(x)
+        return all(
+            np.all((x[:, k] >= g[0]) & (x[:, k] <= g[-1]))
+            for k, g in enumerate(self.grid)
+        )
+
+    def predict(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Interpolate mean and standard deviation at unscaled inputs `x` (samples, inputs)."""
+        varying = [len(g) > 1 for g in self.grid]
+        out = self._interpolator(np.asarray(x)[:, varying])
+        return out[:, 0], np.maximum(out[:, 1], 0.0)
+
+    def sample(self, x: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """Draw one projection per row of `x`, like `GaSPEmulator.sample`."""
+        return _sample(*self.predict(x), self.cap, rng)
+
+
+def tabulate(
+    emulator: GaSPEmulator,
+    x: np.ndarray,
+    points: dict[str, int] = TABLE_POINTS,
+    blocksize: int = 4096,
+) -> ResponseTable:
+    """
+    Tabulate an emulator over the range of its design and of the inputs `x`.
+
+    Continuous inputs get `points` evenly spaced values. Other inputs are tabulated at
+    the distinct values in `x`, so constant switches are held fixed.
+    """
+    design = emulator.design * emulator.scale + emulator.centre
+    grid = []
+    for k, name in enumerate(emulator.inputs):
+        if name in points:
+            values = np.concatenate([design[:, k], x[:, k]])
+            grid.append(np.linspace(values.min(), values.max(), points[name]))
+        else:
+            grid.append(np.unique(x[:, k]))
+
+    mesh = np.stack(np.meshgrid(*grid, indexing="ij"), axis=-1)
+    mesh = mesh.reshape(-1, len(grid))
+    mean = np.empty(len(mesh))
+    sd = np.empty(len(mesh))
+    for start in range(0, len(mesh), blocksize):
+        stop = start + blocksize
+        mean[start:stop], sd[start:stop] = emulator.predict(mesh[start:stop])
+
+    shape = [len(g) for g in grid]
+    return ResponseTable(
+        inputs=emulator.inputs,
+        grid=tuple(grid),
+        mean=mean.reshape(shape),
+        sd=sd.reshape(shape),
+        cap=emulator.cap,
+    )
+
+
+def table_error(
+    table: ResponseTable, emulator: GaSPEmulator, x: np.ndarray
+) -> tuple[float, float]:
+    """Largest absolute difference in mean and sd between a table and full prediction at `x`."""
+    table_mean, table_sd = table.predict(x)
+    mean, sd = emulator.predict(x)
+    return float(np.max(np.abs(table_mean - mean))), float(
+        np.max(np.abs(table_sd - sd))
+    )
+
+
+def _sample(
+    mean: np.ndarray, sd: np.ndarray, cap: float, rng: np.random.Generator
+) -> np.ndarray:
+    # As in R, cap the mean before sampling and the samples again after it
+    if not np.isnan(cap):
+        mean = np.minimum(mean, cap)
+    slr = rng.normal(mean, sd)
+    if not np.isnan(cap):
+        slr = np.minimum(slr, cap)
+    return slr
+
+
+def _with_intercept(x: np.ndarray) -> np.ndarray:
+    return np.column_stack([np.ones(x.shape[0]), x])
+
+
+def _kernel(bd: np.ndarray, alpha: float, kernel: str) -> np.ndarray:
+    # One-dimensional correlation at scaled distance beta * d.
+    if kernel == "pow_exp":
+        return np.exp(-(bd**alpha))
+    if kernel == "matern_3_2":
+        s = np.sqrt(3.0) * bd
+        return (1.0 + s) * np.exp(-s)
+    s = np.sqrt(5.0) * bd
+    return (1.0 + s + s**2 / 3.0) * np.exp(-s)
+
+
+def read_emulator(path: str | Path, row: dict) -> GaSPEmulator:
+    """Read one exported emulator file, given its row of the export index."""
+    fields = np.loadtxt(path, delimiter=",", skiprows=1, usecols=0, dtype=str, ndmin=1)
+    values = np.loadtxt(path, delimiter=",", skiprows=1, usecols=(1, 2, 3), ndmin=2)
+
+    def field(name):
+        sel = fields == name
+        i = values[sel, 0].astype(int) - 1
+        j = values[sel, 1].astype(int) - 1
+        out = np.zeros((i.max() + 1, j.max() + 1))
+        out[i, j] = values[sel, 2]
+        return out
+
+    return GaSPEmulator(
+        inputs=tuple(row["inputs"].split(";")),
+        kernel=row["kernel"],
+        centre=field("centre")[:, 0],
+        scale=field("scale")[:, 0],
+        beta=field("beta")[:, 0],
+        alpha=field("alpha")[:, 0],
+        design=field("design"),
+        output=field("output")[:, 0],
+        theta=field("theta")[:, 0],
+        chol=field("L"),
+        chol_trend=field("LX"),
+        nugget=float(row["nugget"]),
+        sigma2=float(row["sigma2_hat"]),
+        method=row["method"],
+        cap=float(row["cap"]),
+    )
+
+
+def export_digest(export_dir: str | Path) -> str:
+    """SHA-256 digest of an export directory's index and the emulator files it lists."""
+    export_dir = Path(export_dir)
+    digest = hashlib.sha256((export_dir / "index.csv").read_bytes())
+    with open(export_dir / "index.csv", newline="") as f:
+        for row in csv.DictReader(f):
+            digest.update((export_dir / row["file"]).read_bytes())
+    return digest.hexdigest()
+
+
+def read_emulators(export_dir: str | Path) -> dict[tuple[str, str, int], GaSPEmulator]:
+    """Read all emulators in an export directory, keyed by (ice source, region, year)."""
+    export_dir = Path(export_dir)
+    emulators = {}
+    with open(export_dir / "index.csv", newline="") as f:
+        for row in csv.DictReader(f):
+            key = (row["ice_source"], row["region"], int(row["year"]))
+            emulators[key] = read_emulator(export_dir / row["file"], row)
+    return emulators
+
+
+def read_prior(
+    export_dir: str | Path, scenario: str = "FACTS", temp_prior: str = "FAIR"
+) -> dict[tuple[str, str, int], np.ndarray]:
+    """
+    Read exported prior inputs, keyed by (ice source, region, year).
+
+    Each value is a (samples, len(PRIOR_INPUTS)) array, NaN for inputs an emulator
+    does not use.
+    """
+    path = Path(export_dir) / f"prior_{temp_prior}_{scenario}.csv"
+    labels = np.loadtxt(
+        path, delimiter=",", skiprows=1, usecols=(0, 1), dtype=str, ndmin=2
+    )
+    values = np.loadtxt(path, delimiter=",", skiprows=1, usecols=range(2, 8), ndmin=2)
+
+    # Rows come in one block of samples per emulator
+    starts = np.flatnonzero(
+        np.any(labels[1:] != labels[:-1], axis=1) | (values[1:, 0] != values[:-1, 0])
+    )
+    starts = np.concatenate([[0], starts + 1, [len(values)]])
+
+    prior = {}
+    for start, stop in itertools.pairwise(starts):
+        key = (str(labels[start, 0]), str(labels[start, 1]), int(values[start, 0]))
+        prior[key] = values[start:stop, 2:]
+    return prior
+
+
+def build_response_tables(
+    export_dir: str | Path, icesource: str, scenario: str = "FACTS", prior=None
+) -> dict[tuple[str, str, int], ResponseTable]:
+    """
+    Tabulate the exported emulators of one ice source, keyed by (ice source, region, year).
+
+    Each table is checked against full prediction at the exported prior inputs, and a
+    warning is logged if they differ by more than TABLE_TOLERANCE cm. `prior` is read
+    from the export unless given.
+    """
+    emulators = read_emulators(export_dir)
+    if prior is None:
+        prior = read_prior(export_dir, scenario=scenario)
+
+    tables = {}
+    for key, em in emulators.items():
+        if key[0] != icesource:
+            continue
+        x = prior[key][:, [PRIOR_INPUTS.index(name) for name in em.inputs]]
+        tables[key] = tabulate(em, x)
+        mean_err, sd_err = table_error(tables[key], em, x)
+        logger.debug(
+            "Response table %s: max mean error %.2g cm, max sd error %.2g cm",
+            "_".join(map(str, key)),
+            mean_err,
+            sd_err,
+        )
+        if max(mean_err, sd_err) > TABLE_TOLERANCE:
+            logger.warning(
+                "Response table %s differs from full prediction by up to %.2g cm",
+                "_".join(map(str, key)),
+                max(mean_err, sd_err),
+            )
+    return tables
+
+
+def write_response_tables(
+    tables: dict[tuple[str, str, int], ResponseTable],
+    path: str | Path,
+    digest: str | None = None,
+) -> None:
+    """
+    Write response tables to a netCDF file, one group per table.
+
+    `digest` is the `export_digest` of the emulators the tables were built from.
+    """
+    with netcdf_lock(), Dataset(path, "w", format="NETCDF4") as rootgrp:
+        rootgrp.description = "emulandice emulator response tables"
+        if digest is not None:
+            rootgrp.emulator_export = digest
+        for (icesource, region, year), table in tables.items():
+            grp = rootgrp.createGroup(f"{icesource}_{region}_{year}")
+            grp.ice_source = icesource
+            grp.region = region
+            grp.year = year
+            grp.cap = table.cap
+            for name, values in zip(table.inputs, table.grid):
+                grp.createDimension(name, len(values))
+                grp.createVariable(name, "f8", (name,))[:] = values
+            for name in ("mean", "sd"):
+                var = grp.createVariable(name, "f8", table.inputs, zlib=True)
+                var.units = "cm"
+                var[:] = getattr(table, name)
+
+
+def read_response_tables(
+    path: str | Path,
+) -> dict[tuple[str, str, int], ResponseTable]:
+    """Read response tables written by `write_response_tables`."""
+    return _read_response_tables(path)[0]
+
+
+def _read_response_tables(path):
+    # Tables and the digest of the emulators they were built from, None if not stored
+    tables = {}
+    with netcdf_lock(), Dataset(path, "r") as rootgrp:
+        digest = getattr(rootgrp, "emulator_export", None)
+        for grp in rootgrp.groups.values():
+            inputs = grp.variables["mean"].dimensions
+            key = (grp.ice_source, grp.region, int(grp.year))
+            tables[key] = ResponseTable(
+                inputs=tuple(inputs),
+                grid=tuple(grp.variables[name][:].filled() for name in inputs),
+                mean=grp.variables["mean"][:].filled(),
+                sd=grp.variables["sd"][:].filled(),
+                cap=float(grp.cap),
+            )
+    return tables, digest
+
+
+def load_response_tables(
+    export_dir: str | Path,
+    icesource: str,
+    scenario: str = "FACTS",
+    table_file: str | Path | None = None,
+    prior=None,
+) -> dict[tuple[str, str, int], ResponseTable]:
+    """
+    Response tables of the emulators of one ice source exported to `export_dir`.
+
+    Tables in `table_file` are reused if they were built from the same export, by
+    `export_digest`, and their grids cover its prior inputs, as the tables extrapolate
+    linearly past them. Otherwise they are built from the export, and written to
+    `table_file` if one is given.
+    """
+    digest = export_digest(export_dir)
+    if prior is None:
+        prior = read_prior(export_dir, scenario=scenario)
+
+    if table_file is not None and Path(table_file).exists():
+        tables, table_digest = _read_response_tables(table_file)
+        stale = _stale_tables(tables, table_digest, digest, prior, icesource)
+        if stale is None:
+            return tables
+        logger.info("Rebuilding the response tables in %s: %s", table_file, stale)
+
+    tables = build_response_tables(export_dir, icesource, scenario, prior=prior)
+    if table_file is not None:
+        write_response_tables(tables, table_file, digest)
+    return tables
+
+
+def _stale_tables(tables, table_digest, digest, prior, icesource):
+    # Why tables read from a file cannot be used for this export and prior, or None
+    if table_digest != digest:
+        return "they were built from other emulators"
+    for key in prior:
+        if key[0] != icesource:
+            continue
+        name = "_".join(map(str, key))
+        if key not in tables:
+            return f"they have no table for {name}"
+        x = prior[key][:, [PRIOR_INPUTS.index(i) for i in tables[key].inputs]]
+        if not tables[key].covers(x):
+            return f"the inputs of {name} are outside its table"
+    return None
+
+
+def read_moments(
+    outdir: str | Path, scenario: str = "FACTS", temp_prior: str = "FAIR"
+) -> dict[tuple[str, str, int], tuple[np.ndarray, np.ndarray, float]]:
+    """
+    Read emulator moments written by the R package's main(output_moments = TRUE).
+
+    Returns the mean and sd (cm) per sample and the glacier cap (NaN if none), keyed by
+    (ice source, region, year).
+    """
+    stem = Path(outdir) / f"moments_{temp_prior}_{scenario}"
+    values = np.fromfile(stem.with_suffix(".bin"), dtype="<f8")
+
+    moments = {}
+    offset = 0
+    with open(stem.with_suffix(".csv"), newline="") as f:
+        for row in csv.DictReader(f):
+            n = int(row["nsamps"])
+            block = values[offset : offset + 2 * n]
+            key = (row["ice_source"], row["region"], int(row["year"]))
+            moments[key] = (block[:n], block[n:], float(row["cap"]))
+            offset += 2 * n
+    if offset != len(values):
+        raise ValueError(f"{stem}.bin does not match its index")
+    return moments
+
+
+def sample_moments(
+    outdir: str | Path,
+    icesource: str,
+    scenario: str = "FACTS",
+    seed: int = EMULATOR_SEED,
+    dtype: str = "float64",
+    realizations: int = 1,
+) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    Sample sea-level projections from emulator moments of one ice source.
+
+    Returns a dict of (realizations * samples, years) arrays in mm, keyed by region, and
+    the target years. Realization r of forcing sample i is row r * samples + i, so one
+    realization gives the same layout as the R projections CSV.
+    """
+    moments = read_moments(outdir, scenario=scenario)
+    rng = np.random.default_rng(seed)
+
+    keys = [k for k in moments if k[0] == icesource]
+    if not keys:
+        raise ValueError(f"No emulator moments for {icesource!r} in {outdir}")
+    targyears = np.unique([k[2] for k in keys])
+
+    projections = {}
+    for key in keys:
+        _, region, year = key
+        mean, sd, cap = moments[key]
+        if region not in projections:
+            projections[region] = np.full(
+                (realizations * len(mean), len(targyears)), np.nan, dtype=dtype
+            )
+        slr = _sample(np.tile(mean, realizations), np.tile(sd, realizations), cap, rng)
+        # Convert cm to mm
+        year_idx = np.flatnonzero(targyears == year)[0]
+        projections[region][:, year_idx] = slr * 10.0
+
+    return projections, targyears
+
+
+def check_realizations(predictor: str, realizations: int):
+    """Raise ValueError unless `predictor` can draw `realizations` projections per sample."""
+    if realizations < 1:
+        raise ValueError(f"realizations must be at least 1, got {realizations}")
+    if realizations > 1 and predictor != "moments":
+        raise ValueError("Several realizations per sample need the 'moments' predictor")
+
+
+def predict_projections(
+    outdir: str | Path,
+    icesource: str,
+    scenario: str = "FACTS",
+    seed: int = EMULATOR_SEED,
+    dtype: str = "float64",
+    predictor: str = "numpy",
+    table_file: str | Path | None = None,
+    realizations: int = 1,
+) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    Sample sea-level projections for one ice source from the R output in `outdir`.
+
+    Returns a dict of (samples, years) arrays in mm, keyed by region, and the target
+    years. Like the R projections CSV, one draw per sample from the emulator
+    uncertainty; the random stream differs from R's, so samples agree with R in
+    distribution rather than value.
+
+    The "numpy" predictor predicts each exported emulator in full. The "table"
+    predictor interpolates response tables instead, from `load_response_tables`.
+    The "moments" predictor samples emulator means and sds predicted by R, drawing
+    `realizations` projections per sample as laid out by `sample_moments`.
+    """
+    check_realizations(predictor, realizations)
+    if predictor == "moments":
+        return sample_moments(
+            outdir,
+            icesource,
+            scenario,
+            seed=seed,
+            dtype=dtype,
+            realizations=realizations,
+        )
+    if predictor not in ("numpy", "table"):
+        raise ValueError(
+            f"predictor must be 'numpy', 'table' or 'moments', got {predictor!r}"
+        )
+
+    export_dir = Path(outdir) / "emulators"
+
+    prior = read_prior(export_dir, scenario=scenario)
+    if predictor == "table":
+        emulators = load_response_tables(
+            export_dir, icesource, scenario, table_file=table_file, prior=prior
+        )
+    else:
+        emulators = read_emulators(export_dir)
+    rng = np.random.default_rng(seed)
+
+    # Tables read from a file may hold more years than R exported prior inputs for
+    keys = [k for k in emulators if k[0] == icesource and k in prior]
+    if not keys:
+        raise ValueError(f"No exported emulators for {icesource!r} in {export_dir}")
+    targyears = np.unique([k[2] for k in keys])
+
+    projections = {}
+    for key in keys:
+        _, region, year = key
+        em = emulators[key]
+        x = prior[key][:, [PRIOR_INPUTS.index(name) for name in em.inputs]]
+        if region not in projections:
+            projections[region] = np.full(
+                (x.shape[0], len(targyears)), np.nan, dtype=dtype
+            )
+        # Convert cm to mm
+        year_idx = np.flatnonzero(targyears == year)[0]
+        projections[region][:, year_idx] = em.sample(x, rng) * 10.0
+
+    return projections, targyears
@@ -0,0 +1,124 @@
+"""Execution backends and resource limits for localization and the R subprocess."""
+
+import contextlib
+import logging
+import os
+
+import dask
+from dask.utils import parse_bytes
+
+logger = logging.getLogger(__name__)
+
+SCHEDULERS = ("synchronous", "threads", "processes", "distributed")
+
+# Localized outputs with up to this many values are computed in memory with NumPy rather
+# than as a chunked dask graph. Below it, building and scheduling the graph costs more
+# than the arithmetic; see benchmarks/localization_backend.py.
+NUMPY_BACKEND_MAX_ELEMENTS = 2_000_000
+
+# Thread pools used by R's linear algebra libraries.
+R_THREAD_ENVVARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+@contextlib.contextmanager
+def execution_backend(
+    scheduler: str = "threads",
+    num_workers: int | None = None,
+    memory_limit: str | None = None,
+):
+    """
+    Run the enclosed stages with the given dask scheduler, worker count and memory limit.
+
+    The scheduler and limits apply to every dask computation in the block, including
+    localization and writing the output files. `num_workers` is the number of tasks run at
+    once (all cores if None). It also caps the threads used by R subprocesses started in
+    the block, and `memory_limit` (e.g. "8GB") caps their vector heap through `R_MAX_VSIZE`.
+
+    "processes" runs one single-threaded worker process per worker, and "distributed" splits
+    the workers over a few multi-threaded processes. Both use a local dask.distributed
+    cluster, because netCDF output cannot be written from dask's plain multiprocessing
+    scheduler, and both share `memory_limit` evenly between worker processes. The
+    "synchronous" and "threads" schedulers cannot enforce a memory limit.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(
+            f"scheduler must be one of {', '.join(SCHEDULERS)}, got {scheduler!r}"
+        )
+
+    env = {}
+    if num_workers is not None:
+        env.update({k: str(num_workers) for k in R_THREAD_ENVVARS})
+    if memory_limit is not None:
+        memory_limit = parse_bytes(memory_limit)
+        env["R_MAX_VSIZE"] = str(memory_limit)
+        if scheduler in ("synchronous", "threads"):
+            logger.warning(
+                "Memory limit is only applied to R with the %s scheduler", scheduler
+            )
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(_patched_environ(env))
+
+        if scheduler in ("processes", "distributed"):
+            # Imported here so distributed is only needed when it is asked for.
+            from dask.distributed import Client, LocalCluster
+            from distributed.deploy.utils import nprocesses_nthreads
+
+            nworkers = num_workers or os.cpu_count()
+            if scheduler == "processes":
+                nprocs, nthreads = nworkers, 1
+            else:
+                nprocs, nthreads = nprocesses_nthreads(nworkers)
+
+            cluster = stack.enter_context(
+                LocalCluster(
+                    n_workers=nprocs,
+                    threads_per_worker=nthreads,
+                    memory_limit=(
+                        memory_limit // nprocs if memory_limit is not None else "auto"
+                    ),
+                )
+            )
+            stack.enter_context(Client(cluster))
+            logger.info(
+                "Started local dask cluster with %s processes of %s threads",
+                nprocs,
+                nthreads,
+            )
+        else:
+            stack.enter_context(
+                dask.config.set(scheduler=scheduler, num_workers=num_workers)
+            )
+            logger.debug("Using dask %s scheduler", scheduler)
+
+        yield
+
+
+def localization_backend(backend: str, nelements: int) -> str:
+    """
+    Resolve the array backend used to localize an output of `nelements` values.
+
+    `backend` is "numpy", "dask" or "auto". "auto" picks NumPy for outputs of up to
+    NUMPY_BACKEND_MAX_ELEMENTS values and dask for anything larger.
+    """
+    if backend not in ("auto", "numpy", "dask"):
+        raise ValueError(f"backend must be auto, numpy or dask, got {backend!r}")
+    if backend == "auto":
+        backend = "numpy" if nelements <= NUMPY_BACKEND_MAX_ELEMENTS else "dask"
+    logger.debug("Localizing %s values with %s", nelements, backend)
+    return backend
+
+
+@contextlib.contextmanager
+def _patched_environ(env: dict):
+    """Temporarily set environment variables, restoring their previous values on exit."""
+    previous = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for k, v in previous.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
@@ -0,0 +1,186 @@
+"""
+Fingerprint packs: every fingerprint grid in one uncompressed, memory-mapped file.
+
+`pack_fingerprints` stacks the grids of the fingerprint netCDF files into a single HDF5
+dataset stored contiguously, with latitudes in ascending order, together with an index of
+the file names, the glacier IceID to FPID map and, if any grid has masked points, their
+mask. `FingerprintPack` maps that dataset into memory, so postprocessing opens one file
+and reads only the grids, and the latitude rows of those grids, that its sites need.
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+from emulandice.io import netcdf_lock
+from emulandice.ReadFingerprint import ReadFingerprint
+
+# Names of the ice sheet fingerprints in the FACTS data, used to find them in a pack when
+# their options are not given. Glacier fingerprints are named by the map in the pack.
+PACKED_NAMES = {
+    "fprint_wais_file": "fprint_wais.nc",
+    "fprint_eais_file": "fprint_eais.nc",
+    "fprint_gis_file": "fprint_gis.nc",
+    "fprint_glacier_dir": "",
+    "fprint_map_file": None,
+}
+
+
+class FingerprintPack:
+    """Fingerprint grids of a pack, looked up by the base name of their netCDF file."""
+
+    def __init__(self, pack_file):
+        self.pack_file = str(pack_file)
+        with netcdf_lock(), h5py.File(self.pack_file, "r") as f:
+            fp = f["fp"]
+            offset = fp.id.get_offset()
+            if offset is None:
+                raise ValueError(f"{self.pack_file} is not a fingerprint pack")
+            self.names = [name.decode() for name in f["names"][:]]
+            self.lats = f["lat"][:]
+            self.lons = f["lon"][:]
+            self.glacier_ice_ids = f["glacier_ice_id"][:]
+            self.glacier_fpids = [fpid.decode() for fpid in f["glacier_fpid"][:]]
+            self._fp = np.memmap(
+                self.pack_file, dtype=fp.dtype, mode="r", offset=offset, shape=fp.shape
+            )
+            self._mask = None
+            if "mask" in f:
+                mask = f["mask"]
+                self._mask = np.memmap(
+                    self.pack_file,
+                    dtype=mask.dtype,
+                    mode="r",
+                    offset=mask.id.get_offset(),
+                    shape=mask.shape,
+                )
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    def __contains__(self, fp_file) -> bool:
+        return os.path.basename(fp_file) in self._index
+
+    def read(self, fp_file, qlats=None, masked=False):
+        """
+        Grid of `fp_file` with its lats and lons, like ReadFingerprint.
+
+        With site latitudes `qlats`, only the band of rows around them is returned, which
+        interpolates to the same values at those sites. With `masked`, the grid is returned
+        as a masked array, masked where the netCDF file was.
+        """
+        name = os.path.basename(fp_file)
+        if name not in self._index:
+            raise KeyError(f"{name} is not in fingerprint pack {self.pack_file}")
+        start, stop = 0, len(self.lats)
+        if qlats is not None and len(qlats) > 0:
+            start = np.searchsorted(self.lats, np.min(qlats), side="right") - 1
+            stop = np.searchsorted(self.lats, np.max(qlats), side="left") + 1
+            start = min(max(start, 0), len(self.lats) - 2)
+            stop = min(max(stop, start + 2), len(self.lats))
+        rows = slice(start, stop)
+        fp = self._fp[self._index[name], rows]
+        if masked:
+            mask = False if self._mask is None else self._mask[self._index[name], rows]
+            fp = np.ma.masked_array(fp, mask)
+        return fp, self.lats[rows], self.lons
+
+    def check(self, fingerprint_files):
+        """Raise FileNotFoundError naming the fingerprints missing from the pack."""
+        missing = [f for f in fingerprint_files if f not in self]
+        if missing:
+            raise FileNotFoundError(
+                f"Fingerprints not in pack {self.pack_file}: {', '.join(map(str, missing))}"
+            )
+
+
+def open_pack(pack_file) -> FingerprintPack | None:
+    """Open the fingerprint pack `pack_file`, or return None if it is not given."""
+    return None if pack_file is None else FingerprintPack(pack_file)
+
+
+def pack_fingerprints(output_file, fingerprint_files, fprint_map_file=None):
+    """
+    Write the grids of `fingerprint_files` and the glacier map `fprint_map_file` to a pack.
+
+    All grids must share one lat/lon grid. They are stored uncompressed and contiguously,
+    keeping the values under any masked points, so interpolating from the pack gives the
+    same fingerprints as interpolating from the netCDF files. Masks are stored alongside
+    if any grid has masked points.
+    """
+    fingerprint_files = [str(f) for f in fingerprint_files]
+    names = [os.path.basename(f) for f in fingerprint_files]
+    if len(set(names)) != len(names):
+        raise ValueError("Fingerprint files must have distinct names")
+
+    ice_ids, fpids = np.array([], dtype="i8"), []
+    if fprint_map_file is not None:
+        ice_ids, fpids = read_glacier_map(fprint_map_file)
+
+    lats = lons = None
+    with h5py.File(output_file, "w") as f:
+        for i, fp_file in enumerate(fingerprint_files):
+            fp, fp_lats, fp_lons = ReadFingerprint(fp_file)
+            mask = np.ma.getmaskarray(fp)
+            fp, fp_lats, fp_lons = (np.ma.getdata(x) for x in (fp, fp_lats, fp_lons))
+            lat_sort = np.argsort(fp_lats)
+            if lats is None:
+                lats, lons = fp_lats[lat_sort], fp_lons
+                f.create_dataset("lat", data=lats)
+                f.create_dataset("lon", data=lons)
+                data = f.create_dataset(
+                    "fp", shape=(len(names), *fp.shape), dtype=fp.dtype
+                )
+            elif not (
+                np.array_equal(fp_lats[lat_sort], lats)
+                and np.array_equal(fp_lons, lons)
+            ):
+                raise ValueError(
+                    f"{fp_file} is not on the grid of {fingerprint_files[0]}"
+                )
+            data[i] = fp[lat_sort]
+            if mask.any():
+                if "mask" not in f:
+                    f.create_dataset("mask", shape=data.shape, dtype=bool)
+                f["mask"][i] = mask[lat_sort]
+
+        f.create_dataset("names", data=np.array(names, dtype="S"))
+        f.create_dataset("glacier_ice_id", data=np.asarray(ice_ids, dtype="i8"))
+        f.create_dataset("glacier_fpid", data=np.array(fpids, dtype="S"))
+
+
+def read_glacier_map(fprint_map_file=None, pack_file=None):
+    """IceIDs and FPIDs of the glacier regions, from the map file or else from the pack."""
+    if fprint_map_file is None:
+        if pack_file is None:
+            raise ValueError("Give a fingerprint map file or a fingerprint pack")
+        pack = FingerprintPack(pack_file)
+        if len(pack.glacier_ice_ids) == 0:
+            raise ValueError(f"Fingerprint pack {pack_file} has no glacier map")
+        return pack.glacier_ice_ids, np.array(pack.glacier_fpids)
+    fpmap_data = np.genfromtxt(
+        fprint_map_file,
+        dtype=None,
+        names=True,
+        delimiter=",",
+    )
+    return fpmap_data["IceID"], fpmap_data["FPID"]
+
+
+def fingerprint_options(pack_file, **options) -> dict:
+    """
+    Fingerprint options of a command, with unset ones named as in a pack.
+
+    Without a pack every option must be given; raises ValueError naming those that are not.
+    """
+    if pack_file is None:
+        missing = [name for name, value in options.items() if value is None]
+        if missing:
+            raise ValueError(
+                f"{', '.join('--' + name.replace('_', '-') for name in missing)} "
+                "must be given without --fingerprint-pack"
+            )
+        return options
+    return {
+        name: PACKED_NAMES[name] if value is None else value
+        for name, value in options.items()
+    }
@@ -1,9 +1,38 @@
 """Common storage and IO logic"""
 
+import threading
 import time
+from contextlib import contextmanager
 
 from netCDF4 import Dataset
 import numpy as np
+import xarray as xr
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+
+# The netCDF and HDF5 libraries are not thread-safe, and xarray only locks its reads and
+# its writes of array data, so files read on one thread, like fingerprints loaded in the
+# background, and written on another are opened and laid out one at a time
+_FILE_LOCK = threading.RLock()
+
+
+@contextmanager
+def netcdf_lock():
+    """Hold the locks for reading or writing a netCDF or HDF5 file with netCDF4 or h5py."""
+    with _FILE_LOCK, NETCDF4_PYTHON_LOCK:
+        yield
+
+
+def to_netcdf(ds: xr.Dataset, path, compute: bool = True, **kwargs):
+    """
+    Write `ds` to `path` like `Dataset.to_netcdf`, alongside files used by other threads.
+
+    The file and its variables are created under the file lock, and dask-backed data is
+    then computed and written chunk by chunk under xarray's lock, so other files can be
+    read and written in between. With `compute=False`, returns the delayed write.
+    """
+    with _FILE_LOCK:
+        write = ds.to_netcdf(path, compute=False, **kwargs)
+    return write.compute() if compute else write
 
 
 def WriteNetCDF(
@@ -16,43 +45,349 @@ def WriteNetCDF(
     nc_filename: str,
     nc_description: str,
 ):
-    rootgrp = Dataset(nc_filename, "w", format="NETCDF4")
-
-    # Define Dimensions
-    _ = rootgrp.createDimension("years", len(targyears))
-    _ = rootgrp.createDimension("samples", nsamps)
-    _ = rootgrp.createDimension("locations", 1)
-
-    # Populate dimension variables
-    year_var = rootgrp.createVariable("years", "i4", ("years",))
-    samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
-    loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
-    lat_var = rootgrp.createVariable("lat", "f4", ("locations",))
-    lon_var = rootgrp.createVariable("lon", "f4", ("locations",))
-
-    # Create a data variable
-    samps = rootgrp.createVariable(
-        "sea_level_change",
-        "f4",
-        ("samples", "years", "locations"),
-        zlib=True,
-        complevel=4,
-    )
+    with netcdf_lock():
+        rootgrp = Dataset(nc_filename, "w", format="NETCDF4")
+
+        # Define Dimensions
+        _ = rootgrp.createDimension("years", len(targyears))
+        _ = rootgrp.createDimension("samples", nsamps)
+        _ = rootgrp.createDimension("locations", 1)
 
-    # Assign attributes
-    rootgrp.description = nc_description
-    rootgrp.history = "Created " + time.ctime(time.time())
-    rootgrp.source = "FACTS: {0}. ".format(pipeline_id)
-    rootgrp.baseyear = baseyear
-    rootgrp.scenario = scenario
-    samps.units = "mm"
-
-    # Put the data into the netcdf variables
-    year_var[:] = targyears
-    samp_var[:] = np.arange(nsamps)
-    samps[:, :, :] = slr[:, :, np.newaxis]
-    lat_var[:] = np.inf
-    lon_var[:] = np.inf
-    loc_var[:] = -1
+        # Populate dimension variables
+        year_var = rootgrp.createVariable("years", "i4", ("years",))
+        samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
+        loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
+        lat_var = rootgrp.createVariable("lat", "f4", ("locations",))
+        lon_var = rootgrp.createVariable("lon", "f4", ("locations",))
+
+        # Create a data variable
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            "f4",
+            ("samples", "years", "locations"),
+            zlib=True,
+            complevel=4,
+        )
+
+        # Assign attributes
+        rootgrp.description = nc_description
+        rootgrp.history = "Created " + time.ctime(time.time())
+        rootgrp.source = "FACTS: {0}. ".format(pipeline_id)
+        rootgrp.baseyear = baseyear
+        rootgrp.scenario = scenario
+        samps.units = "mm"
+
+        # Put the data into the netcdf variables
+        year_var[:] = targyears
+        samp_var[:] = np.arange(nsamps)
+        samps[:, :, :] = slr[:, :, np.newaxis]
+        lat_var[:] = np.inf
+        lon_var[:] = np.inf
+        loc_var[:] = -1
+        rootgrp.close()
 
     return None
+
+
+def gslr_dataset(
+    slr, targyears, baseyear, scenario, pipeline_id, description: str
+) -> xr.Dataset:
+    """Dataset of global sea-level change `slr` (samples, years) in mm, laid out like WriteNetCDF."""
+    return xr.Dataset(
+        {
+            "sea_level_change": (
+                ("samples", "years", "locations"),
+                slr[:, :, np.newaxis],
+                {"units": "mm"},
+            ),
+            "lat": (("locations",), np.array([np.inf], dtype="f4")),
+            "lon": (("locations",), np.array([np.inf], dtype="f4")),
+        },
+        coords={
+            "years": np.asarray(targyears, dtype="i4"),
+            "samples": np.arange(slr.shape[0]),
+            "locations": np.array([-1]),
+        },
+        attrs={
+            "description": description,
+            "history": "Created " + time.ctime(time.time()),
+            "source": f"FACTS: {pipeline_id}. ",
+            "baseyear": baseyear,
+            "scenario": scenario,
+        },
+    )
+
+
+# netCDF encoding of global sea-level change, as WriteNetCDF writes it
+GSLR_ENCODING = {"sea_level_change": {"dtype": "f4", "zlib": True, "complevel": 4}}
+
+
+# Localized sea-level change is stored in chunks of up to this many values (4 MB as float32)
+LSLR_CHUNK_VALUES = 1_000_000
+
+
+def lslr_encoding(shape: tuple, chunksize: int) -> dict:
+    """
+    netCDF encoding for localized sea-level change of `shape` (samples, years, locations).
+
+    Each chunk holds `chunksize` locations and every year, plus as many samples as fit in
+    LSLR_CHUNK_VALUES. Files localized for consecutive blocks of locations share this chunk
+    layout, so they can be concatenated by copying compressed chunks.
+    """
+    nsamps, nyears, nsites = shape
+    nlocs = max(1, min(chunksize, nsites))
+    nsamps_chunk = max(1, min(nsamps, LSLR_CHUNK_VALUES // (nyears * nlocs)))
+    return {
+        "sea_level_change": {
+            "dtype": "f4",
+            "zlib": True,
+            "complevel": 4,
+            "_FillValue": np.nan,
+            "chunksizes": (nsamps_chunk, nyears, nlocs),
+        }
+    }
+
+
+def grid_encoding(shape: tuple) -> dict:
+    """
+    netCDF encoding for localized sea-level change on a grid of `shape` (samples, years, lat, lon).
+
+    Each chunk holds maps of one year, whole or in bands of latitude rows, for as many
+    samples as fit in LSLR_CHUNK_VALUES, so reading a map touches few chunks.
+    """
+    nsamps, _, nlat, nlon = shape
+    nlat_chunk = max(1, min(nlat, LSLR_CHUNK_VALUES // nlon))
+    nsamps_chunk = max(1, min(nsamps, LSLR_CHUNK_VALUES // (nlat_chunk * nlon)))
+    return {
+        "sea_level_change": {
+            "dtype": "f4",
+            "zlib": True,
+            "complevel": 4,
+            "_FillValue": np.nan,
+            "chunksizes": (nsamps_chunk, 1, nlat_chunk, nlon),
+        }
+    }
+
+
+def lslr_dataset(
+    local_sl, sites, targyears, sample_ids, attrs: dict, regions=None
+) -> xr.Dataset:
+    """
+    Dataset of localized sea-level change in mm at `sites`, a Sites, Grid or Regions.
+
+    The values are (samples, years, locations) at sites or regions or (samples, years, lat,
+    lon) on a grid. With `regions`, they have a leading region dimension with those ids.
+    """
+    region_dims = () if regions is None else ("region",)
+    region_coords = {} if regions is None else {"region": regions}
+    return xr.Dataset(
+        {
+            "sea_level_change": (
+                (*region_dims, "samples", "years", *sites.dims),
+                local_sl,
+                {"units": "mm", "missing_value": np.nan},
+            ),
+            **sites.data_vars,
+        },
+        coords={
+            **region_coords,
+            "years": targyears,
+            **sites.coords,
+            "samples": sample_ids,
+        },
+        attrs=attrs,
+    )
+
+
+def regions_dataset(
+    slr, targyears, baseyear, scenario, pipeline_id, description: str
+) -> xr.Dataset:
+    """
+    Dataset of global sea-level change `slr` of each glacier region, (region, samples, years) in mm.
+
+    Regions are numbered from 1, as the per-region files of `--output-glacier-dir` are.
+    """
+    return xr.Dataset(
+        {
+            "sea_level_change": (
+                ("region", "samples", "years"),
+                slr,
+                {"units": "mm"},
+            ),
+        },
+        coords={
+            "region": np.arange(1, slr.shape[0] + 1),
+            "years": np.asarray(targyears, dtype="i4"),
+            "samples": np.arange(slr.shape[1]),
+        },
+        attrs={
+            "description": description,
+            "history": "Created " + time.ctime(time.time()),
+            "source": f"FACTS: {pipeline_id}. ",
+            "baseyear": baseyear,
+            "scenario": scenario,
+        },
+    )
+
+
+def regions_encoding(encoding: dict, shape: tuple) -> dict:
+    """
+    `encoding` of sea-level change of `shape` with a leading region dimension.
+
+    Each chunk holds one region, shaped as `encoding` chunks a single region, or the
+    whole region if `encoding` sets no chunk sizes, so reading a region touches only its
+    own chunks.
+    """
+    var = dict(encoding["sea_level_change"])
+    var["chunksizes"] = (1, *var.get("chunksizes", shape[1:]))
+    return {"sea_level_change": var}
+
+
+def factors_dataset(
+    component_sl, fingerprints, components, sites, targyears, sample_ids, attrs: dict
+) -> xr.Dataset:
+    """
+    Dataset of localized sea-level change at `sites` stored as its factors.
+
+    `component_sl` is the global sea-level change of each of `components`, (component,
+    samples, years) in mm, and `fingerprints` their fingerprints at the sites, (component,
+    locations) or (component, lat, lon). Local sea-level change is their product summed
+    over the components, which `open_lslr_factors` reconstructs.
+    """
+    return xr.Dataset(
+        {
+            "component_sea_level_change": (
+                ("component", "samples", "years"),
+                component_sl,
+                {"units": "mm", "missing_value": np.nan},
+            ),
+            "fingerprint": (
+                ("component", *sites.dims),
+                fingerprints,
+                {"missing_value": np.nan},
+            ),
+            **sites.data_vars,
+        },
+        coords={
+            "component": np.asarray(components, dtype=str),
+            "years": targyears,
+            **sites.coords,
+            "samples": sample_ids,
+        },
+        attrs=attrs,
+    )
+
+
+def factors_encoding(fingerprint_shape: tuple, chunksize: int) -> dict:
+    """
+    netCDF encoding for factorized sea-level change with fingerprints of `fingerprint_shape`.
+
+    Both factors keep the precision they were computed in, so reconstructed values match
+    those localized in full. Fingerprints of every component are stored in chunks of
+    `chunksize` locations, or of bands of grid rows, so reading a block of sites touches
+    only its chunks.
+    """
+    ncomponents, *site_shape = fingerprint_shape
+    if len(site_shape) == 1:
+        site_chunks = (max(1, min(chunksize, site_shape[0])),)
+    else:
+        nlat, nlon = site_shape
+        site_chunks = (
+            max(1, min(nlat, LSLR_CHUNK_VALUES // (ncomponents * nlon))),
+            nlon,
+        )
+    compressed = {"zlib": True, "complevel": 4, "_FillValue": np.nan}
+    return {
+        "component_sea_level_change": compressed,
+        "fingerprint": compressed | {"chunksizes": (ncomponents, *site_chunks)},
+    }
+
+
+def open_lslr_factors(path, components=None) -> xr.Dataset:
+    """
+    Open factorized local sea-level change from `path`, reconstructing it on demand.
+
+    Returns a Dataset laid out like the local SLR files, with a dask-backed
+    "sea_level_change" that is only computed for the samples, years and sites selected from
+    it. `components`, like ["eais"], sums only those; all components are summed by default.
+    """
+    # The global SLR of the components is small, so read it whole; fingerprints are read
+    # by their chunks of locations
+    factors = xr.open_dataset(
+        path, chunks={"component": -1, "samples": -1, "years": -1}
+    )
+    if components is not None:
+        factors = factors.sel(component=list(components))
+    # Summed without skipping NaN, so masked grid cells stay NaN as in the full output
+    local_sl = (factors["component_sea_level_change"] * factors["fingerprint"]).sum(
+        "component", skipna=False
+    )
+    return factors.drop_vars(
+        ["component_sea_level_change", "fingerprint", "component"]
+    ).assign(sea_level_change=local_sl.assign_attrs(units="mm", missing_value=np.nan))
+
+
+class ProjectionReader:
+    """
+    Collects emulandice sample projections of one ice source from the CSV that R writes.
+
+    Text can be fed in any number of pieces, including while R is still appending to the
+    file: only complete lines are parsed and the rest is kept for the next piece. Rows are
+    kept by region as they arrive, and `cube` arranges them by sample and year, in mm.
+    """
+
+    def __init__(self, icesource: str):
+        self.icesource = icesource
+        self.nrows = 0
+        self._rest = ""
+        self._header = True
+        self._rows = {}
+
+    @property
+    def regions(self) -> list[str]:
+        return list(self._rows)
+
+    def feed(self, text: str):
+        lines = (self._rest + text).split("\n")
+        self._rest = lines.pop()
+        if self._header and lines:
+            lines = lines[1:]
+            self._header = False
+
+        # Columns are ice_source,region,year,sample,GSAT,melt,collapse,SLE
+        fields = [line.split(",") for line in lines]
+        fields = [f for f in fields if f[0] == self.icesource]
+        for region in {f[1] for f in fields}:
+            rows = [f for f in fields if f[1] == region]
+            self._rows.setdefault(region, []).append(
+                (
+                    np.array([int(f[2]) for f in rows]),
+                    np.array([int(f[3]) for f in rows]),
+                    np.array([float(f[7]) for f in rows]),
+                )
+            )
+        self.nrows += len(fields)
+
+    def cube(self, regions: list[str] | None = None, dtype="float64"):
+        """
+        Return projections as an array of (regions, samples, years) in mm, and the years.
+
+        Regions default to all regions read, in the order they arrived. Entries missing from
+        the CSV are NaN.
+        """
+        if regions is None:
+            regions = self.regions
+        blocks = [
+            (i, *block)
+            for i, region in enumerate(regions)
+            for block in self._rows.get(region, [])
+        ]
+        region_idx = np.concatenate([np.full(len(b[1]), b[0]) for b in blocks])
+        years, samples, sles = (np.concatenate(c) for c in list(zip(*blocks))[1:])
+
+        targyears = np.unique(years)
+        data = np.full(
+            (len(regions), len(np.unique(samples)), len(targyears)), np.nan, dtype=dtype
+        )
+        data[region_idx, samples - 1, np.searchsorted(targyears, years)] = sles * 10.0
+        return data, targyears
@@ -0,0 +1,403 @@
+"""
+Run the stages of the ice source pipelines as one dependency graph.
+
+Each ice source runs as four stages: loading its sites and fingerprints, preprocessing the
+temperature trajectories, projecting with the R emulator and localizing the projections.
+Every stage carries a resource tag, "r" for stages that run R, "cpu" for NumPy and dask work
+and "io" for reading inputs, and each resource has a number of slots. `run_stages` starts
+any stage whose dependencies have finished while its resource has a free slot, so one
+source can be localized while R is still emulating another.
+"""
+
+import logging
+import tempfile
+import time
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+from emulandice.emulandice_AIS_fit import emulandice_fit_AIS
+from emulandice.emulandice_AIS_postprocess import emulandice_postprocess_AIS
+from emulandice.emulandice_AIS_project import emulandice_project_AIS
+from emulandice.emulandice_glaciers_fit import emulandice_fit_glaciers
+from emulandice.emulandice_glaciers_postprocess import emulandice_postprocess_glaciers
+from emulandice.emulandice_glaciers_project import emulandice_project_glaciers
+from emulandice.emulandice_GrIS_fit import emulandice_fit_GrIS
+from emulandice.emulandice_GrIS_postprocess import emulandice_postprocess_GrIS
+from emulandice.emulandice_GrIS_project import emulandice_project_GrIS
+from emulandice.emulandice_preprocess import emulandice_preprocess
+from emulandice.emulator import check_realizations
+from emulandice.execution import execution_backend
+from emulandice.fingerprints import fingerprint_options
+from emulandice.sites import (
+    check_fingerprints,
+    check_paths,
+    glacier_fingerprint_files,
+    load_locations,
+)
+
+logger = logging.getLogger(__name__)
+
+# Output parameters of each ice source command, written by the projection stage (global
+# SLR and the run report) and by the postprocess stage (local)
+GSLR_OUTPUTS = {
+    "ais": (
+        "output_gslr_file",
+        "output_gslr_eais_file",
+        "output_gslr_wais_file",
+        "output_gslr_pen_file",
+        "output_report_file",
+    ),
+    "gris": ("output_gslr_file", "output_report_file"),
+    "glaciers": (
+        "output_gslr_file",
+        "output_glacier_dir",
+        "output_gslr_regions_file",
+        "output_report_file",
+    ),
+}
+LSLR_OUTPUTS = {
+    "ais": (
+        "output_lslr_file",
+        "output_lslr_eais_file",
+        "output_lslr_wais_file",
+        "output_lslr_factors_file",
+    ),
+    "gris": ("output_lslr_file", "output_lslr_factors_file"),
+    "glaciers": (
+        "output_lslr_file",
+        "output_lslr_regions_file",
+        "output_lslr_factors_file",
+    ),
+}
+ICE_SOURCES = tuple(GSLR_OUTPUTS)
+
+# Fingerprint parameters of each ice source command, which may be left unset with a pack
+FINGERPRINT_OPTIONS = {
+    "ais": ("fprint_wais_file", "fprint_eais_file"),
+    "gris": ("fprint_gis_file",),
+    "glaciers": ("fprint_glacier_dir", "fprint_map_file"),
+}
+
+# Resources that stages are tagged with, and the slots each has by default. One R slot
+# keeps a single R process, with its BLAS threads, on the cores at a time.
+RESOURCES = ("r", "cpu", "io")
+DEFAULT_SLOTS = {"r": 1, "cpu": 1, "io": 1}
+
+
+@dataclass
+class Stage:
+    """A named step of a pipeline, called with the results of its dependencies in order."""
+
+    name: str
+    resource: str
+    func: Callable
+    deps: tuple[str, ...] = ()
+
+
+def run_stages(stages: list[Stage], slots: dict | None = None) -> dict:
+    """
+    Run `stages` concurrently as their dependencies finish, within `slots` per resource.
+
+    Stages that are ready at the same time start in the order given. If a stage fails, no
+    more stages are started, the running ones are left to finish and the error is raised.
+    Returns the result of every stage by name.
+    """
+    slots = DEFAULT_SLOTS | (slots or {})
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+    for stage in stages:
+        if stage.resource not in RESOURCES:
+            raise ValueError(
+                f"Stage {stage.name} has resource {stage.resource!r}, "
+                f"not one of {', '.join(RESOURCES)}"
+            )
+        if slots[stage.resource] < 1:
+            raise ValueError(f"{stage.resource} needs at least 1 slot")
+        unknown = set(stage.deps) - set(names)
+        if unknown:
+            raise ValueError(
+                f"Stage {stage.name} depends on unknown stages {', '.join(sorted(unknown))}"
+            )
+
+    pending = list(stages)
+    running = {}
+    busy = dict.fromkeys(RESOURCES, 0)
+    results = {}
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sum(slots.values())) as pool:
+        while pending or running:
+            for stage in list(pending):
+                if busy[stage.resource] < slots[stage.resource] and all(
+                    dep in results for dep in stage.deps
+                ):
+                    pending.remove(stage)
+                    busy[stage.resource] += 1
+                    logger.info("Starting stage %s", stage.name)
+                    running[
+                        pool.submit(stage.func, *(results[dep] for dep in stage.deps))
+                    ] = stage
+            if not running:
+                raise ValueError(
+                    f"Stages {', '.join(s.name for s in pending)} depend on each other"
+                )
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                busy[stage.resource] -= 1
+                if future.exception() is not None:
+                    logger.error(
+                        "Stage %s failed, waiting for %d running stages",
+                        stage.name,
+                        len(running),
+                    )
+                    pending.clear()
+                    wait(running)
+                    raise future.exception()
+                results[stage.name] = future.result()
+                logger.info(
+                    "Stage %s done at %.1f s", stage.name, time.perf_counter() - t0
+                )
+    return results
+
+
+def fingerprint_params(ice_source: str, params: dict) -> dict:
+    """Command parameters `params` with unset fingerprint options named as in the pack."""
+    options = {name: params[name] for name in FINGERPRINT_OPTIONS[ice_source]}
+    return params | fingerprint_options(params.get("fingerprint_pack"), **options)
+
+
+def fingerprint_files(ice_source: str, params: dict) -> list[str]:
+    """Fingerprint files localized by `ice_source` with command parameters `params`."""
+    if ice_source == "ais":
+        return [params["fprint_wais_file"], params["fprint_eais_file"]]
+    if ice_source == "gris":
+        return [params["fprint_gis_file"]]
+    if params["fprint_map_file"] is not None:
+        check_paths([params["fprint_map_file"]])
+    return glacier_fingerprint_files(
+        params["fprint_map_file"],
+        params["fprint_glacier_dir"],
+        params.get("fingerprint_pack"),
+    )
+
+
+def check_source(ice_source: str, params: dict):
+    """Check the input files and output directories of one ice source run."""
+    if not params.get("grid") and params["location_file"] is None:
+        raise ValueError("A location file is needed unless localizing on the grid")
+    if params.get("grid") and params.get("region_weights_file") is not None:
+        raise ValueError("Region averages cannot be localized on the grid")
+    check_realizations(params["predictor"], params["realizations"])
+    check_fingerprints(
+        fingerprint_files(ice_source, params), params.get("fingerprint_pack")
+    )
+    check_paths(
+        [
+            params["input_data_file"],
+            params["forcing_head_path"],
+            params["location_file"],
+            params.get("region_weights_file"),
+        ],
+        [
+            params.get(name)
+            for name in GSLR_OUTPUTS[ice_source] + LSLR_OUTPUTS[ice_source]
+        ],
+    )
+
+
+def preprocess(params: dict, tmpdir: Path) -> dict:
+    """Preprocess the temperature trajectories into the R forcing file in `tmpdir`."""
+    return emulandice_preprocess(
+        params["input_data_file"],
+        params["baseyear"],
+        params["pipeline_id"],
+        headfile=params["forcing_head_path"],
+        outfile=tmpdir / "facts_climate_forcing.csv",
+        target_years=params.get("target_years"),
+    )
+
+
+def project(
+    ice_source: str, params: dict, preprocessed: dict, gslr: dict, tmpdir: Path
+) -> dict:
+    """Fit and project the full ensemble with R output in `tmpdir`, writing global SLR to `gslr`."""
+    r_output_dir = tmpdir / "results"
+    r_output_dir.mkdir(parents=True, exist_ok=True)
+    pipeline_id = params["pipeline_id"]
+    project_args = {
+        "preprocess_data": preprocessed,
+        "output_dir": str(r_output_dir),
+        "output_gslr_file": gslr["output_gslr_file"],
+        "dtype": params["precision"],
+        "predictor": params["predictor"],
+        "response_table_file": params["response_table_file"],
+        "realizations": params["realizations"],
+        "output_report_file": gslr["output_report_file"],
+    }
+
+    if ice_source == "ais":
+        return emulandice_project_AIS(
+            pipeline_id,
+            fit_data=emulandice_fit_AIS(pipeline_id),
+            output_eais_file=gslr["output_gslr_eais_file"],
+            output_wais_file=gslr["output_gslr_wais_file"],
+            output_pen_file=gslr["output_gslr_pen_file"],
+            **project_args,
+        )
+    if ice_source == "gris":
+        return emulandice_project_GrIS(
+            pipeline_id=pipeline_id,
+            fit_data=emulandice_fit_GrIS(pipeline_id),
+            **project_args,
+        )
+    return emulandice_project_glaciers(
+        pipeline_id=pipeline_id,
+        fit_data=emulandice_fit_glaciers(pipeline_id),
+        output_glacier_dir=gslr["output_glacier_dir"],
+        output_regions_file=gslr["output_gslr_regions_file"],
+        **project_args,
+    )
+
+
+def postprocess(
+    ice_source: str,
+    params: dict,
+    projected: dict,
+    lslr: dict,
+    samples: slice = slice(None),
+    locations: slice = slice(None),
+    sites=None,
+    backend: str = "auto",
+) -> dict:
+    """
+    Localize one block of samples and locations, writing local SLR to the files in `lslr`.
+
+    Returns the local SLR datasets by component, lazy ones with the "dask" `backend`.
+    """
+    postprocess_args = {
+        "my_data": projected,
+        "locationfile": params["location_file"],
+        "chunksize": params["chunksize"],
+        "pipeline_id": params["pipeline_id"],
+        "output_lslr_file": lslr["output_lslr_file"],
+        "output_factors_file": lslr["output_lslr_factors_file"],
+        "samples": samples,
+        "locations": locations,
+        "sites": sites,
+        "fingerprint_pack": params.get("fingerprint_pack"),
+        "backend": backend,
+    }
+
+    if ice_source == "ais":
+        return emulandice_postprocess_AIS(
+            fprint_wais_file=params["fprint_wais_file"],
+            fprint_eais_file=params["fprint_eais_file"],
+            output_eais_file=lslr["output_lslr_eais_file"],
+            output_wais_file=lslr["output_lslr_wais_file"],
+            **postprocess_args,
+        )
+    if ice_source == "gris":
+        return emulandice_postprocess_GrIS(
+            fprint_gis_file=params["fprint_gis_file"], **postprocess_args
+        )
+    return emulandice_postprocess_glaciers(
+        fprint_map_file=params["fprint_map_file"],
+        fprint_glacier_dir=params["fprint_glacier_dir"],
+        output_regions_file=lslr["output_lslr_regions_file"],
+        **postprocess_args,
+    )
+
+
+def source_stages(ice_source: str, params: dict, tmpdir: Path) -> list[Stage]:
+    """Stages of one ice source run with command parameters `params`, named `source:stage`."""
+    gslr = {name: params.get(name) for name in GSLR_OUTPUTS[ice_source]}
+    lslr = {name: params.get(name) for name in LSLR_OUTPUTS[ice_source]}
+    files = fingerprint_files(ice_source, params)
+    return [
+        Stage(
+            f"{ice_source}:sites",
+            "io",
+            lambda: load_locations(
+                params["location_file"],
+                files,
+                pack_file=params.get("fingerprint_pack"),
+                grid=params.get("grid", False),
+                grid_box=params.get("grid_box"),
+                grid_stride=params.get("grid_stride", 1),
+                region_weights_file=params.get("region_weights_file"),
+            ),
+        ),
+        Stage(f"{ice_source}:preprocess", "cpu", lambda: preprocess(params, tmpdir)),
+        Stage(
+            f"{ice_source}:project",
+            "r",
+            lambda preprocessed: project(
+                ice_source, params, preprocessed, gslr, tmpdir
+            ),
+            (f"{ice_source}:preprocess",),
+        ),
+        Stage(
+            f"{ice_source}:postprocess",
+            "cpu",
+            lambda projected, sites: postprocess(
+                ice_source, params, projected, lslr, sites=sites
+            ),
+            (f"{ice_source}:project", f"{ice_source}:sites"),
+        ),
+    ]
+
+
+def run_pipeline(
+    sources: dict,
+    slots: dict | None = None,
+    scheduler: str = "threads",
+    num_workers: int | None = None,
+    memory_limit: str | None = None,
+):
+    """
+    Run the ice sources in `sources`, mapping each to its command parameters, as one graph.
+
+    Paths are checked for every source before any stage starts. The execution backend
+    applies to all stages, so the per-source scheduler and limits are not used.
+    """
+    for ice_source in sources:
+        if ice_source not in ICE_SOURCES:
+            raise ValueError(
+                f"ice_source must be one of {', '.join(ICE_SOURCES)}, got {ice_source!r}"
+            )
+    sources = {
+        ice_source: fingerprint_params(ice_source, params)
+        for ice_source, params in sources.items()
+    }
+    outputs = []
+    for ice_source, params in sources.items():
+        if params.get("location_shard") is not None:
+            raise ValueError(
+                "Run location shards with the ice source commands, not the pipeline"
+            )
+        check_source(ice_source, params)
+        names = GSLR_OUTPUTS[ice_source] + LSLR_OUTPUTS[ice_source]
+        outputs += [
+            str(Path(params[name]).absolute()) for name in names if params.get(name)
+        ]
+
+    duplicates = sorted({f for f in outputs if outputs.count(f) > 1})
+    if duplicates:
+        raise ValueError(
+            f"Ice sources would overwrite each other's outputs: {', '.join(duplicates)}"
+        )
+
+    with (
+        execution_backend(scheduler, num_workers, memory_limit),
+        tempfile.TemporaryDirectory() as tmpdir,
+    ):
+        stages = []
+        for ice_source, params in sources.items():
+            source_dir = Path(tmpdir) / ice_source
+            source_dir.mkdir()
+            stages += source_stages(ice_source, params, source_dir)
+        run_stages(stages, slots)
@@ -1,12 +1,204 @@
 """Helpers to ease the relationship between R and Python."""
 
+from collections.abc import Callable
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+import json
 import logging
+import os
 import subprocess
 import shlex
+import time
 
 
 logger = logging.getLogger(__name__)
 
+# Sample projections written by emulandice::main() for the FACTS forcing
+PROJECTIONS_FILE = "projections_FAIR_FACTS.csv"
+
+# Progress events written by emulandice::main() as it emulates each region
+EVENTS_FILE = "events.csv"
+
+# Years emulandice::main() can predict
+FIRST_YEAR = 2016
+LAST_YEAR = 2100
+
+# Years R reads from the forcing besides those it predicts: 2015 to reference the
+# anomalies, 2020 for history matching, and 2099 to fill gaps at 2100
+R_FORCING_YEARS = (2015, 2020, 2099, 2100)
+
+# Glacier trends are shared among regions by their melt over the first projection decade
+GLACIER_TREND_YEARS = (2020, 2030)
+
+# Exit status of a main() call in an RSession, written when the call ends
+STATUS_FILE = "status"
+
+# How often the projections and events files are checked for new rows while R runs, in seconds
+FOLLOW_INTERVAL = 0.2
+
+
+class RProgress:
+    """
+    Progress events of an emulandice R run, from the CSV that R appends them to.
+
+    Text can be fed in pieces while R writes, as for `emulandice.io.ProjectionReader`. Each
+    event is relayed to the logger, and the fit, prediction and total seconds and the rows
+    written are collected per region, year and ice source in `regions`.
+    """
+
+    def __init__(self):
+        self.regions = []
+        self._rest = ""
+        self._header = True
+        self._current = None
+
+    def feed(self, text: str):
+        lines = (self._rest + text).split("\n")
+        self._rest = lines.pop()
+        if self._header and lines:
+            lines = lines[1:]
+            self._header = False
+
+        # Columns are time,event,ice_source,region,year,seconds,rows
+        for line in lines:
+            _, event, ice_source, region, year, seconds, rows = line.split(",")
+            seconds, rows = float(seconds), float(rows)
+            if event == "region_start":
+                logger.info("R started %s %s %s", ice_source, region, year)
+                self._current = {
+                    "ice_source": ice_source,
+                    "region": region,
+                    "year": int(year),
+                    "fit_seconds": None,
+                    "predict_seconds": None,
+                    "seconds": None,
+                    "rows": None,
+                }
+                self.regions.append(self._current)
+            elif event in ("fit", "predict"):
+                logger.debug(
+                    "R %s %s %s %s in %.1f s", event, ice_source, region, year, seconds
+                )
+                self._current[f"{event}_seconds"] = seconds
+            elif event == "region_end":
+                logger.info(
+                    "R finished %s %s %s in %.1f s, writing %d rows",
+                    ice_source,
+                    region,
+                    year,
+                    seconds,
+                    rows,
+                )
+                self._current["seconds"] = seconds
+                self._current["rows"] = int(rows)
+
+    def log_summary(self, n: int = 5):
+        """Log the total R time over regions and the `n` regions that took longest."""
+        done = [r for r in self.regions if r["seconds"] is not None]
+        if not done:
+            return
+        slowest = sorted(done, key=lambda r: r["seconds"], reverse=True)[:n]
+        logger.info(
+            "R emulated %d regions in %.1f s; slowest: %s",
+            len(done),
+            sum(r["seconds"] for r in done),
+            ", ".join(
+                f"{r['ice_source']} {r['region']} {r['year']} ({r['seconds']:.1f} s)"
+                for r in slowest
+            ),
+        )
+
+    def write_report(self, report_file):
+        """Write the per-region timings to `report_file` as JSON."""
+        with open(report_file, "w") as f:
+            json.dump({"regions": self.regions}, f, indent=2)
+
+
+class RSession:
+    """
+    A long-running R process with emulandice loaded, running main() calls one at a time.
+
+    Each call passes `reuse_fits`, so emulators fitted by earlier calls to the same training
+    data are reused rather than fitted again. An R error ends the call, not the session.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["R", "-q", "--no-save"], stdin=subprocess.PIPE, text=True
+        )
+        self._send("library(emulandice)")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def _send(self, expr: str):
+        self.process.stdin.write(expr + "\n")
+        self.process.stdin.flush()
+
+    def run(self, main_call: str, status_file: str, followed: dict):
+        """
+        Run `main_call`, an emulandice::main() call, following files like run_emulandice.
+
+        Raises CalledProcessError if the call fails or the session exits.
+        """
+        if os.path.exists(status_file):
+            os.remove(status_file)
+        status_tmp = status_file + ".tmp"
+        self._send(
+            f"tryCatch({{ {main_call}; cat(0, file='{status_tmp}') }}, "
+            f"error = function(err) {{ message(conditionMessage(err)); cat(1, file='{status_tmp}') }}, "
+            f"finally = file.rename('{status_tmp}', '{status_file}'))"
+        )
+        _follow(self.process, followed, done=lambda: os.path.exists(status_file))
+        if not os.path.exists(status_file):
+            raise subprocess.CalledProcessError(self.process.returncode, main_call)
+        with open(status_file) as f:
+            status = int(f.read())
+        if status != 0:
+            raise subprocess.CalledProcessError(status, main_call)
+
+    def close(self):
+        """End the session, letting R finish the call it is running."""
+        if self.alive:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+# Session that run_emulandice runs R in, instead of a new process, set by `r_session`
+_session: ContextVar[RSession | None] = ContextVar("r_session", default=None)
+
+
+@contextmanager
+def r_session(session: RSession):
+    """Run emulandice in `session` rather than a new R process within the block, in this thread."""
+    token = _session.set(session)
+    try:
+        yield session
+    finally:
+        _session.reset(token)
+
+
+def prediction_years(icesource: str, target_years) -> list[int]:
+    """
+    Years R predicts for `icesource` to give projections at `target_years`.
+
+    Glaciers also need the years of the first projection decade for their trends.
+    """
+    years = set(target_years)
+    if not FIRST_YEAR <= min(years) <= max(years) <= LAST_YEAR:
+        raise ValueError(f"Target years must be between {FIRST_YEAR} and {LAST_YEAR}")
+    if icesource == "Glaciers":
+        years.update(GLACIER_TREND_YEARS)
+    return sorted(years)
+
+
+def forcing_years(target_years) -> list[int]:
+    """Years of the forcing R reads to predict any ice source at `target_years`."""
+    return sorted(
+        set(R_FORCING_YEARS).union(prediction_years("Glaciers", target_years))
+    )
+
 
 def run_emulandice(
     *,
@@ -14,26 +206,110 @@ def run_emulandice(
     nsamps: int | str,
     icesource: str,
     outdir: str = "results",
-) -> None:
+    output_profile: str = "facts",
+    export_emulators: bool = False,
+    output_moments: bool = False,
+    on_projections: Callable[[str], None] | None = None,
+    years=None,
+) -> RProgress:
     """
     Runs emulandice as a subprocess via R. Requires `emulandice` to be installed and available to R. R must be available in PATH.
 
+    With the default `output_profile` of "facts", R writes only the sample projections CSV read by the project stages, skipping summaries, diagnostics and density estimates. Use "full" for all of emulandice's outputs.
+
+    With `export_emulators`, R only fits the emulators and writes them with their prior inputs to `outdir`/emulators, for `emulandice.emulator.predict_projections`, instead of predicting.
+
+    With `output_moments`, R writes the emulator mean and sd per sample to binary files in `outdir`, for `emulandice.emulator.sample_moments`, instead of sampling.
+
+    With `on_projections`, the sample projections file is followed while R runs, and each
+    new piece of it is passed to `on_projections` as text, so it can be parsed as R writes
+    it. R appends all samples of one region and year at a time.
+
+    R predicts every decade from 2020 to 2100, or only `years` if given.
+
+    Within `r_session`, main() runs in that session instead of a new R process.
+
     This only runs on POSIX systems.
     """
     # Safety to ensure nsamps can be interpreted as int.
     nsamps = str(int(nsamps))
 
+    # R rewrites these files, so never follow ones left by an earlier run
+    projections_file = os.path.join(outdir, PROJECTIONS_FILE)
+    events_file = os.path.join(outdir, EVENTS_FILE)
+    for path in (projections_file, events_file):
+        if os.path.exists(path):
+            os.remove(path)
+    progress = RProgress()
+    followed = {events_file: progress.feed}
+    if on_projections is not None:
+        followed[projections_file] = on_projections
+
     # Sanitize user inputs.
     emulandice_dataset = shlex.quote(emulandice_dataset)
     nsamps = shlex.quote(nsamps)
     icesource = shlex.quote(icesource)
     outdir = shlex.quote(outdir)
+    events_file = shlex.quote(events_file)
 
-    r_cmd = f"library(emulandice);emulandice::main('decades', dataset='{emulandice_dataset}', N_FACTS={nsamps}, outdir='{outdir}', ice_sources=c('{icesource}'))"
+    # R predicts the decades unless given the years
+    years_arg = ""
+    if years is not None:
+        years_list = ",".join(str(int(y)) for y in years)
+        years_arg = f", years=c({years_list})"
 
-    subprocess.run(
-        ["R", "-q", "--no-save", "-e", r_cmd],
-        shell=False,
-        check=True,
-    )
-    logger.debug("R emulandice subprocess complete")
+    # A long-running session reuses the emulators it has fitted
+    session = _session.get()
+    reuse_arg = "" if session is None else ", reuse_fits=TRUE"
+    if (export_emulators or output_moments) and output_profile != "facts":
+        raise ValueError(
+            "export_emulators and output_moments need the 'facts' output_profile"
+        )
+    if export_emulators and output_moments:
+        raise ValueError("export_emulators and output_moments cannot both be set")
+    if output_profile not in ("full", "facts"):
+        raise ValueError(
+            f"output_profile must be 'full' or 'facts', got {output_profile!r}"
+        )
+
+    main_call = f"emulandice::main('decades', dataset='{emulandice_dataset}', N_FACTS={nsamps}, outdir='{outdir}', ice_sources=c('{icesource}'), batch_predict=TRUE, output_profile='{output_profile}', export_emulators={'TRUE' if export_emulators else 'FALSE'}, output_moments={'TRUE' if output_moments else 'FALSE'}, event_file='{events_file}'{years_arg}{reuse_arg})"
+
+    if session is not None:
+        session.run(main_call, os.path.join(outdir, STATUS_FILE), followed)
+        logger.debug("R emulandice session call complete")
+    else:
+        r_cmd = f"library(emulandice);{main_call}"
+        args = ["R", "-q", "--no-save", "-e", r_cmd]
+        _follow(subprocess.Popen(args, shell=False), followed)
+        logger.debug("R emulandice subprocess complete")
+    progress.log_summary()
+    return progress
+
+
+def _follow(process: subprocess.Popen, followed: dict, done=None):
+    # Pass text appended to each path in `followed` to its callback until `process` exits,
+    # or until `done()` is true for a process that keeps running
+    files = {}
+    try:
+        with ExitStack() as stack:
+            while True:
+                running = process.poll() is None and not (done is not None and done())
+                for path, on_text in followed.items():
+                    if path not in files and os.path.exists(path):
+                        files[path] = stack.enter_context(open(path, "r"))
+                    if path in files:
+                        text = files[path].read()
+                        if text:
+                            on_text(text)
+                if not running:
+                    break
+                time.sleep(FOLLOW_INTERVAL)
+    except BaseException:
+        # Never leave R running after an error or an interrupt
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        raise
+
+    if done is None and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
@@ -0,0 +1,327 @@
+"""
+Serve ice source jobs on a local Unix socket, keeping loaded state warm between jobs.
+
+A job is one ice source command ("ais", "gris" or "glaciers") with its options, given as
+they are to `emulandice all`. The server keeps the sites of each location set it has
+loaded, with the fingerprints interpolated to them, and the fingerprint grids and packs it
+has read, reusing them while their files are unchanged. R runs in long-lived sessions with
+emulandice loaded, one per job slot, which reuse the emulators fitted by earlier jobs. Jobs
+beyond the slots wait for a free session.
+
+Clients send one JSON object per line, like {"command": "ais", "args": "--input-data-file
+gsat.nc ..."}, with "args" a string or a list, and get one JSON line back for each job:
+{"status": "ok", "seconds": 12.3} or {"status": "error", "error": "..."}.
+"""
+
+import json
+import logging
+import os
+import queue
+import shlex
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from emulandice.AssignFP import AssignFP
+from emulandice.execution import execution_backend
+from emulandice.fingerprints import FingerprintPack
+from emulandice.pipeline import (
+    GSLR_OUTPUTS,
+    ICE_SOURCES,
+    LSLR_OUTPUTS,
+    check_source,
+    fingerprint_files,
+    fingerprint_params,
+    postprocess,
+    preprocess,
+    project,
+)
+from emulandice.r_helper import RSession, r_session
+from emulandice.read_locationfile import ReadLocationFile
+from emulandice.ReadFingerprint import ReadFingerprint
+from emulandice.sites import Sites, load_grid, make_regions, read_region_weights
+
+logger = logging.getLogger(__name__)
+
+# Location sets, or grid selections, whose sites and fingerprints are kept in memory. The
+# least recently used is dropped beyond this.
+MAX_SITE_SETS = 8
+
+
+def _stamp(path) -> tuple:
+    # Identify the contents of a file by its path, size and modification time
+    stat = os.stat(path)
+    return (str(Path(path).absolute()), stat.st_size, stat.st_mtime_ns)
+
+
+class FingerprintGrids:
+    """Fingerprint grids read from netCDF files, kept in memory and read like a pack."""
+
+    def __init__(self):
+        self._grids = {}
+        self._lock = threading.Lock()
+
+    def read(self, fp_file, qlats=None, masked=False):
+        """Grid of `fp_file` with its lats and lons, as ReadFingerprint returns them."""
+        stamp = _stamp(fp_file)
+        with self._lock:
+            if self._grids.get(str(fp_file), (None,))[0] != stamp:
+                self._grids[str(fp_file)] = (stamp, ReadFingerprint(fp_file))
+            return self._grids[str(fp_file)][1]
+
+
+class WarmCache:
+    """
+    Sites and grid cells with their fingerprints, kept across jobs.
+
+    Each location set, or grid selection, is keyed by the files it was read from, and each
+    fingerprint on it by its file, so anything whose file has changed is loaded again.
+    """
+
+    def __init__(self, max_site_sets: int = MAX_SITE_SETS):
+        self.max_site_sets = max_site_sets
+        self.grids = FingerprintGrids()
+        self._packs = {}
+        self._site_sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pack(self, pack_file) -> FingerprintPack | None:
+        if pack_file is None:
+            return None
+        stamp = _stamp(pack_file)
+        if self._packs.get(stamp[0], (None,))[0] != stamp:
+            self._packs[stamp[0]] = (stamp, FingerprintPack(pack_file))
+        return self._packs[stamp[0]][1]
+
+    def sites(
+        self,
+        location_file=None,
+        fingerprint_files=(),
+        pack_file=None,
+        grid: bool = False,
+        grid_box=None,
+        grid_stride: int = 1,
+        region_weights_file=None,
+    ):
+        """Sites, grid cells or regions with `fingerprint_files`, like `load_locations`."""
+        with self._lock:
+            pack = self._pack(pack_file)
+            pack_stamp = None if pack_file is None else _stamp(pack_file)
+            if grid:
+                source = pack_stamp or _stamp(fingerprint_files[0])
+                box = None if grid_box is None else tuple(grid_box)
+                key = ("grid", source, box, grid_stride)
+            else:
+                # Regions mask the sites next to masked points, so keep them apart
+                masked = region_weights_file is not None
+                key = ("sites", _stamp(location_file), pack_stamp, masked)
+
+            if key in self._site_sets:
+                self._site_sets.move_to_end(key)
+                sites, stamps = self._site_sets[key]
+            else:
+                stamps = {}
+                if grid:
+                    sites = load_grid(
+                        fingerprint_files, grid_box, grid_stride, pack_file
+                    )
+                    stamps = {
+                        str(f): pack_stamp or _stamp(f) for f in fingerprint_files
+                    }
+                else:
+                    _, ids, lats, lons = ReadLocationFile(location_file)
+                    pack = self.grids if pack is None else pack
+                    sites = Sites(ids, lats, lons, {}, pack, masked)
+                self._site_sets[key] = (sites, stamps)
+                while len(self._site_sets) > self.max_site_sets:
+                    self._site_sets.popitem(last=False)
+
+            # Interpolate the fingerprints not yet on these sites, or whose files changed
+            for f in fingerprint_files:
+                stamp = pack_stamp or _stamp(f)
+                if stamps.get(str(f)) == stamp:
+                    continue
+                if grid:
+                    sites.fingerprints.pop(str(f), None)
+                    sites.fingerprints[str(f)] = sites.fingerprint(f, "f8")
+                else:
+                    sites.fingerprints[str(f)] = AssignFP(
+                        f, sites.lats, sites.lons, pack=sites.pack, masked=sites.masked
+                    )
+                stamps[str(f)] = stamp
+
+        # Regions average the fingerprints of the cached sites, so only the weights are read
+        if region_weights_file is not None:
+            return make_regions(sites, *read_region_weights(region_weights_file))
+        return sites
+
+
+def _run_job(ice_source: str, params: dict, cache: WarmCache, session: RSession):
+    # Run one ice source command with `params`, with sites from `cache` and R in `session`
+    params = fingerprint_params(ice_source, params)
+    if params.get("location_shard") is not None:
+        raise ValueError(
+            "Run location shards with the ice source commands, not a server"
+        )
+    check_source(ice_source, params)
+    gslr = {name: params.get(name) for name in GSLR_OUTPUTS[ice_source]}
+    lslr = {name: params.get(name) for name in LSLR_OUTPUTS[ice_source]}
+
+    # Load any sites and fingerprints not yet cached while R runs
+    with (
+        ThreadPoolExecutor(max_workers=1) as pool,
+        tempfile.TemporaryDirectory() as tmpdir,
+    ):
+        sites = pool.submit(
+            cache.sites,
+            params["location_file"],
+            fingerprint_files(ice_source, params),
+            pack_file=params.get("fingerprint_pack"),
+            grid=params.get("grid", False),
+            grid_box=params.get("grid_box"),
+            grid_stride=params.get("grid_stride", 1),
+            region_weights_file=params.get("region_weights_file"),
+        )
+        tmpdir = Path(tmpdir)
+        with r_session(session):
+            projected = project(
+                ice_source, params, preprocess(params, tmpdir), gslr, tmpdir
+            )
+        postprocess(ice_source, params, projected, lslr, sites=sites.result())
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    # Run each job sent on the connection, replying with one JSON line per job
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                reply = self.server.run_line(line)
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+                self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server running ice source jobs in a pool of R sessions.
+
+    `parse_job(command, args)` turns the command and option list of a job into its command
+    parameters.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path,
+        parse_job: Callable[[str, list], dict],
+        max_jobs: int = 1,
+        cache: WarmCache | None = None,
+    ):
+        super().__init__(str(socket_path), _JobHandler)
+        self.parse_job = parse_job
+        self.cache = WarmCache() if cache is None else cache
+        self.sessions = queue.Queue()
+        for _ in range(max_jobs):
+            self.sessions.put(RSession())
+
+    def run_line(self, line: bytes) -> dict:
+        """Run the job in one JSON line from a client, returning the reply."""
+        t0 = time.perf_counter()
+        try:
+            job = json.loads(line)
+            command = job["command"]
+            if command not in ICE_SOURCES:
+                raise ValueError(
+                    f"command must be one of {', '.join(ICE_SOURCES)}, got {command!r}"
+                )
+            args = job.get("args", [])
+            if isinstance(args, str):
+                args = shlex.split(args)
+            params = self.parse_job(command, list(args))
+
+            if self.sessions.empty():
+                logger.info("Job %s queued until an R session is free", command)
+            session = self.sessions.get()
+            try:
+                logger.info("Starting job %s", command)
+                _run_job(command, params, self.cache, session)
+            finally:
+                if not session.alive:
+                    logger.warning("R session exited, starting a new one")
+                    session = RSession()
+                self.sessions.put(session)
+        except Exception as err:  # noqa: BLE001 - any failure is reported to the client
+            logger.error("Job failed: %s", err)
+            return {"status": "error", "error": str(err) or type(err).__name__}
+
+        seconds = time.perf_counter() - t0
+        logger.info("Job %s done in %.1f s", command, seconds)
+        return {"status": "ok", "seconds": round(seconds, 3)}
+
+    def server_close(self):
+        super().server_close()
+        while not self.sessions.empty():
+            self.sessions.get().close()
+
+
+def _remove_stale_socket(socket_path):
+    # Remove a socket file left by a server that did not exit cleanly, but never steal the
+    # socket of a server that is still listening
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(str(socket_path))
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise FileExistsError(f"A server is already listening on {socket_path}")
+
+
+def serve(
+    socket_path,
+    parse_job: Callable[[str, list], dict],
+    max_jobs: int = 1,
+    scheduler: str = "threads",
+    num_workers: int | None = None,
+    memory_limit: str | None = None,
+):
+    """
+    Serve jobs on the Unix socket `socket_path` until interrupted, `max_jobs` at a time.
+
+    The execution backend applies to every job, so the per-job scheduler and limits are not
+    used; the R sessions are started with its thread and memory limits.
+    """
+    _remove_stale_socket(socket_path)
+    if threading.current_thread() is threading.main_thread():
+        # Close the R sessions and remove the socket when stopped by a service manager too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with (
+        execution_backend(scheduler, num_workers, memory_limit),
+        JobServer(socket_path, parse_job, max_jobs) as server,
+    ):
+        logger.info(
+            "Serving on %s with %d R sessions", socket_path, server.sessions.qsize()
+        )
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def submit(socket_path, command: str, args) -> dict:
+    """Send one job to the server on `socket_path` and wait for its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(socket_path))
+        s.sendall((json.dumps({"command": command, "args": args}) + "\n").encode())
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
@@ -0,0 +1,406 @@
+"""
+Split one emulandice run over batch nodes that share a filesystem.
+
+`plan` writes a manifest to a work directory that splits the samples and locations of a run
+into a grid of shards. Each `run` projects the full ensemble, which is deterministic for the
+same inputs, and localizes only its own block of samples and locations. `merge` then
+concatenates the blocks into the same global and local SLR files as a single-node run. Shards
+coordinate only through files in the work directory, so they need no scheduler service.
+"""
+
+import contextlib
+import json
+import logging
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import pairwise
+from pathlib import Path
+
+import h5py
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset
+
+from emulandice.execution import execution_backend
+from emulandice.io import lslr_encoding, to_netcdf
+from emulandice.pipeline import (
+    GSLR_OUTPUTS,
+    ICE_SOURCES,
+    LSLR_OUTPUTS,
+    check_source,
+    fingerprint_files,
+    fingerprint_params,
+    postprocess,
+    preprocess,
+    project,
+)
+from emulandice.read_locationfile import ReadLocationFile
+from emulandice.sites import load_sites
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+
+
+def split(n: int, nblocks: int, align: int = 1) -> list[tuple[int, int]]:
+    """
+    Split range(n) into `nblocks` contiguous (start, stop) blocks of near-equal size.
+
+    Blocks start at multiples of `align`, so they hold whole chunks of `align` values.
+    """
+    nunits = -(-n // align)
+    if not 1 <= nblocks <= nunits:
+        raise ValueError(
+            f"Cannot split {n} values into {nblocks} blocks of at least {align}"
+        )
+    edges = [min(n, align * (nunits * i // nblocks)) for i in range(nblocks + 1)]
+    return list(pairwise(edges))
+
+
+def location_blocks(nsites: int, nshards: int, chunksize: int) -> list[tuple[int, int]]:
+    """
+    Split `nsites` locations into `nshards` (start, stop) blocks.
+
+    Blocks hold whole chunks of `chunksize` locations when there are enough of them, so their
+    local SLR files can be concatenated by copying compressed chunks.
+    """
+    if nshards * chunksize > nsites + chunksize - 1:
+        logger.warning(
+            "Splitting %d locations into %d shards gives blocks smaller than the "
+            "chunksize of %d, so merging them recompresses the local SLR",
+            nsites,
+            nshards,
+            chunksize,
+        )
+        return split(nsites, nshards)
+    return split(nsites, nshards, align=chunksize)
+
+
+def location_slice(
+    location_file: str, chunksize: int, index: int, nshards: int
+) -> slice:
+    """Locations of shard `index` of `nshards` of the sites in `location_file`."""
+    nsites = len(ReadLocationFile(location_file)[1])
+    return slice(*location_blocks(nsites, nshards, chunksize)[index])
+
+
+def plan(
+    workdir: str,
+    ice_source: str,
+    params: dict,
+    sample_shards: int = 1,
+    location_shards: int = 1,
+) -> dict:
+    """
+    Write the manifest splitting a run of `ice_source` with command parameters `params`.
+
+    Locations are split into `location_shards` blocks of the location file, aligned on
+    chunks of `--chunksize` locations where possible. The number of samples is only known
+    once projected, so each shard records its block `[k, n]`, the k-th of
+    `sample_shards` blocks of the ensemble. Shards are numbered sample block first.
+    """
+    if ice_source not in ICE_SOURCES:
+        raise ValueError(
+            f"ice_source must be one of {', '.join(ICE_SOURCES)}, got {ice_source!r}"
+        )
+    if sample_shards < 1:
+        raise ValueError("sample_shards must be at least 1")
+    if params.get("location_shard") is not None:
+        raise ValueError(
+            "Plan location shards with location_shards, not location_shard"
+        )
+    if params.get("grid"):
+        raise ValueError("Grid output cannot be sharded")
+    if params.get("region_weights_file") is not None:
+        raise ValueError("Region averages cannot be sharded")
+    if params.get("output_lslr_regions_file") is not None:
+        raise ValueError("Local SLR of each glacier region cannot be sharded")
+    if params.get("output_lslr_factors_file") is not None:
+        raise ValueError("Factorized local SLR cannot be sharded")
+
+    # Fail now rather than on every node once R has run
+    params = fingerprint_params(ice_source, params)
+    check_source(ice_source, params)
+
+    nsites = len(ReadLocationFile(params["location_file"])[1])
+    blocks = location_blocks(nsites, location_shards, params["chunksize"])
+
+    workdir = Path(workdir)
+    manifest_file = workdir / MANIFEST
+    if manifest_file.exists():
+        raise FileExistsError(f"{manifest_file} exists; plan each run in a new workdir")
+
+    shards = []
+    for k in range(sample_shards):
+        for start, stop in blocks:
+            shards.append(
+                {
+                    "index": len(shards),
+                    "samples": [k, sample_shards],
+                    "locations": [start, stop],
+                }
+            )
+    manifest = {
+        "ice_source": ice_source,
+        "params": params,
+        "sample_shards": sample_shards,
+        "location_shards": location_shards,
+        "shards": shards,
+    }
+
+    workdir.mkdir(parents=True, exist_ok=True)
+    manifest_file.write_text(json.dumps(manifest, indent=2))
+    logger.info("Planned %d shards in %s", len(shards), workdir)
+    return manifest
+
+
+def read_manifest(workdir: str) -> dict:
+    """Read the manifest written by `plan`."""
+    return json.loads((Path(workdir) / MANIFEST).read_text())
+
+
+def shard_dir(workdir: str, index: int) -> Path:
+    """Directory holding the local SLR files of shard `index`."""
+    return Path(workdir) / "shards" / str(index)
+
+
+def _outputs(params: dict, names: tuple, directory: Path) -> dict:
+    # Redirect the given output parameters into `directory`, keeping unset ones unset
+    return {
+        name: None
+        if params.get(name) is None
+        else str(directory / (name + Path(params[name]).suffix))
+        for name in names
+    }
+
+
+def _num_samples(ice_source: str, projected: dict) -> int:
+    if ice_source == "ais":
+        return projected["waissamps"].shape[0]
+    if ice_source == "gris":
+        return projected["gissamps"].shape[0]
+    return projected["gic_samps"].shape[1]
+
+
+def run(workdir: str, index: int):
+    """
+    Run shard `index` of the manifest in `workdir`.
+
+    Shard 0 also writes the global SLR outputs. A shard that has finished leaves a `done`
+    file and is skipped when run again, so failed shards can simply be resubmitted.
+    """
+    manifest = read_manifest(workdir)
+    if not 0 <= index < len(manifest["shards"]):
+        raise ValueError(
+            f"index must be between 0 and {len(manifest['shards']) - 1}, got {index}"
+        )
+    ice_source = manifest["ice_source"]
+    params = manifest["params"]
+    shard = manifest["shards"][index]
+
+    out_dir = shard_dir(workdir, index)
+    done = out_dir / "done"
+    if done.exists():
+        logger.info("Shard %d is already done", index)
+        return
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Load the sites and fingerprints while R runs
+    with (
+        execution_backend(
+            params["scheduler"], params["num_workers"], params["memory_limit"]
+        ),
+        ThreadPoolExecutor(max_workers=1) as pool,
+    ):
+        sites = pool.submit(
+            load_sites,
+            params["location_file"],
+            fingerprint_files(ice_source, params),
+            pack_file=params.get("fingerprint_pack"),
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            gslr_dir = Path(workdir) / "global" if index == 0 else tmpdir / "global"
+            gslr_dir.mkdir(parents=True, exist_ok=True)
+            gslr = _outputs(params, GSLR_OUTPUTS[ice_source], gslr_dir)
+
+            projected = project(
+                ice_source, params, preprocess(params, tmpdir), gslr, tmpdir
+            )
+
+        k, nblocks = shard["samples"]
+        start, stop = split(_num_samples(ice_source, projected), nblocks)[k]
+        lslr = _outputs(params, LSLR_OUTPUTS[ice_source], out_dir)
+        postprocess(
+            ice_source,
+            params,
+            projected,
+            lslr,
+            samples=slice(start, stop),
+            locations=slice(*shard["locations"]),
+            sites=sites.result(),
+        )
+
+    done.touch()
+    logger.info("Shard %d done", index)
+
+
+def merge(workdir: str):
+    """
+    Assemble the outputs of all shards in `workdir` at the paths given to `plan`.
+
+    Local SLR blocks are concatenated over samples and locations and written with the
+    encoding of the postprocess stages. Raises RuntimeError if any shard has not finished.
+    """
+    manifest = read_manifest(workdir)
+    ice_source = manifest["ice_source"]
+    params = manifest["params"]
+    shards = manifest["shards"]
+
+    missing = [
+        s["index"]
+        for s in shards
+        if not (shard_dir(workdir, s["index"]) / "done").exists()
+    ]
+    if missing:
+        raise RuntimeError(
+            f"Shards {', '.join(map(str, missing))} have not finished in {workdir}"
+        )
+
+    gslr = _outputs(params, GSLR_OUTPUTS[ice_source], Path(workdir) / "global")
+    for name, path in gslr.items():
+        if path is None:
+            continue
+        if Path(path).is_dir():
+            shutil.copytree(path, params[name], dirs_exist_ok=True)
+        else:
+            shutil.copyfile(path, params[name])
+
+    # Shards are numbered sample block first, so they fill the grid row by row
+    nlocation = manifest["location_shards"]
+    for name in LSLR_OUTPUTS[ice_source]:
+        if params.get(name) is None:
+            continue
+        files = [
+            _outputs(params, (name,), shard_dir(workdir, s["index"]))[name]
+            for s in shards
+        ]
+        if manifest["sample_shards"] == 1:
+            concat_locations(files, params[name], params["chunksize"])
+        else:
+            blocks = [xr.open_dataset(f, chunks={}) for f in files]
+            grid = [blocks[i : i + nlocation] for i in range(0, len(blocks), nlocation)]
+            merged = xr.combine_nested(
+                grid,
+                concat_dim=["samples", "locations"],
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+                combine_attrs="override",
+            )
+            to_netcdf(
+                merged,
+                params[name],
+                encoding=lslr_encoding(
+                    merged["sea_level_change"].shape, params["chunksize"]
+                ),
+            )
+            for block in blocks:
+                block.close()
+        logger.info("Merged %d shards into %s", len(shards), params[name])
+
+
+def _same_storage(a: h5py.Dataset, b: h5py.Dataset) -> bool:
+    # Whether raw chunks of `a` can be stored as chunks of `b`
+    return (a.dtype, a.chunks, a.compression, a.compression_opts, a.shuffle) == (
+        b.dtype,
+        b.chunks,
+        b.compression,
+        b.compression_opts,
+        b.shuffle,
+    ) and not (a.fletcher32 or b.fletcher32 or a.scaleoffset or b.scaleoffset)
+
+
+def concat_locations(files: list[str], output_file: str, chunksize: int | None = None):
+    """
+    Concatenate local SLR files for consecutive blocks of locations, in order, into one file.
+
+    Chunks of sea-level change that fall whole inside the output, with the same chunk shape
+    and compression, are copied still compressed. That covers every chunk of blocks written
+    with the same `--chunksize` and starting at multiples of it, as `location_blocks` plans.
+    Other chunks are decompressed and rewritten. The output is chunked like a single-node run
+    with `chunksize`, or like the first file if None. Global attributes come from the first
+    file.
+    """
+    with contextlib.ExitStack() as stack:
+        sources = [stack.enter_context(Dataset(f)) for f in files]
+        for src in sources:
+            src.set_auto_maskandscale(False)
+        first = sources[0]
+        nsites = [len(src.dimensions["locations"]) for src in sources]
+
+        # Lay out the output like the first file, without writing sea-level change
+        with Dataset(output_file, "w", format="NETCDF4") as dst:
+            dst.setncatts(first.__dict__)
+            for name, dim in first.dimensions.items():
+                dst.createDimension(
+                    name, sum(nsites) if name == "locations" else len(dim)
+                )
+            for name, var in first.variables.items():
+                filters = var.filters()
+                chunking = var.chunking()
+                if name == "sea_level_change" and chunksize is not None:
+                    shape = (*var.shape[:2], sum(nsites))
+                    chunking = lslr_encoding(shape, chunksize)[name]["chunksizes"]
+                out = dst.createVariable(
+                    name,
+                    var.dtype,
+                    var.dimensions,
+                    zlib=filters["zlib"],
+                    complevel=filters["complevel"],
+                    shuffle=filters["shuffle"],
+                    contiguous=chunking == "contiguous",
+                    chunksizes=None if chunking == "contiguous" else chunking,
+                    fill_value=getattr(var, "_FillValue", None),
+                )
+                out.set_auto_maskandscale(False)
+                out.setncatts(
+                    {k: v for k, v in var.__dict__.items() if k != "_FillValue"}
+                )
+                if name == "sea_level_change":
+                    continue
+                if "locations" in var.dimensions:
+                    out[:] = np.concatenate([src.variables[name][:] for src in sources])
+                else:
+                    out[:] = var[:]
+
+    ncopied = 0
+    with h5py.File(output_file, "r+") as dst:
+        out = dst["sea_level_change"]
+        offset = 0
+        for f, n in zip(files, nsites):
+            with h5py.File(f, "r") as src:
+                block = src["sea_level_change"]
+                if block.shape[:2] != out.shape[:2]:
+                    raise ValueError(
+                        f"{f} has different samples or years to {files[0]}"
+                    )
+                nlocs = out.chunks[2]
+                direct = offset % nlocs == 0 and _same_storage(block, out)
+                for chunk in block.iter_chunks():
+                    loc = chunk[2]
+                    target = chunk[:2] + (slice(loc.start + offset, loc.stop + offset),)
+                    if direct and loc.stop - loc.start == nlocs:
+                        mask, data = block.id.read_direct_chunk(
+                            tuple(s.start for s in chunk)
+                        )
+                        out.id.write_direct_chunk(
+                            tuple(s.start for s in target), data, mask
+                        )
+                        ncopied += 1
+                    else:
+                        out[target] = block[chunk]
+            offset += n
+
+    logger.debug("Copied %d compressed chunks into %s", ncopied, output_file)
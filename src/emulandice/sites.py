@@ -0,0 +1,407 @@
+"""
+Site locations and the fingerprints interpolated to them for the postprocess stages.
+
+A Grid stands in for the sites when localizing on the cells of the fingerprint grid, with
+the fingerprint values used as they are, and Regions when localizing weighted averages of
+sites, with the fingerprints averaged the same way.
+
+The CLI loads these on a background thread while R emulates the projections, so
+postprocessing finds them ready and bad input or output paths are reported up front.
+"""
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from emulandice.AssignFP import AssignFP
+from emulandice.fingerprints import FingerprintPack, open_pack, read_glacier_map
+from emulandice.io import grid_encoding, lslr_encoding
+from emulandice.read_locationfile import ReadLocationFile
+from emulandice.ReadFingerprint import ReadFingerprint
+
+
+@dataclass
+class Sites:
+    """
+    Site ids, lats and lons from a location file, and fingerprints keyed by file.
+
+    Fingerprints not yet loaded are interpolated from `pack` if given, or else from their
+    netCDF files. With `masked`, sites interpolated from masked points are NaN.
+    """
+
+    ids: np.ndarray
+    lats: np.ndarray
+    lons: np.ndarray
+    fingerprints: dict
+    pack: FingerprintPack | None = None
+    masked: bool = False
+
+    dims = ("locations",)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.ids),)
+
+    @property
+    def coords(self) -> dict:
+        return {"locations": self.ids}
+
+    @property
+    def data_vars(self) -> dict:
+        return {"lat": (("locations"), self.lats), "lon": (("locations"), self.lons)}
+
+    def encoding(self, shape: tuple, chunksize: int) -> dict:
+        return lslr_encoding(shape, chunksize)
+
+    def __getitem__(self, locations: slice) -> "Sites":
+        return Sites(
+            self.ids[locations],
+            self.lats[locations],
+            self.lons[locations],
+            {k: v[locations] for k, v in self.fingerprints.items()},
+            self.pack,
+            self.masked,
+        )
+
+    def fingerprint(self, fp_file, dtype) -> np.ndarray:
+        """Fingerprint coefficients from `fp_file` at the sites, interpolating if not loaded."""
+        fp = self.fingerprints.get(str(fp_file))
+        if fp is None:
+            fp = AssignFP(
+                fp_file, self.lats, self.lons, pack=self.pack, masked=self.masked
+            )
+        return fp.astype(dtype)
+
+
+def load_sites(
+    locationfile,
+    fingerprint_files=(),
+    locations: slice = slice(None),
+    pack_file=None,
+):
+    """
+    Read the sites in `locationfile` and interpolate `fingerprint_files` to them.
+
+    With `pack_file`, the fingerprints are read from that pack instead of their files.
+    """
+    _, ids, lats, lons = ReadLocationFile(locationfile)
+    return make_sites(
+        lats[locations], lons[locations], ids[locations], fingerprint_files, pack_file
+    )
+
+
+def make_sites(
+    lats, lons, ids=None, fingerprint_files=(), pack_file=None, masked: bool = False
+):
+    """
+    Sites at `lats` and `lons` with `fingerprint_files` interpolated to them.
+
+    Site ids default to 0, 1, 2, ... With `pack_file`, the fingerprints are read from that
+    pack instead of their files. With `masked`, sites interpolated from masked points are
+    NaN.
+    """
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    if lats.ndim != 1 or lats.shape != lons.shape:
+        raise ValueError("lats and lons must be 1-d arrays of the same length")
+    ids = np.arange(len(lats)) if ids is None else np.asarray(ids)
+    if ids.shape != lats.shape:
+        raise ValueError("ids must have one entry per site")
+    pack = open_pack(pack_file)
+    fingerprints = {
+        str(f): AssignFP(f, lats, lons, pack=pack, masked=masked)
+        for f in fingerprint_files
+    }
+    return Sites(ids, lats, lons, fingerprints, pack, masked)
+
+
+@dataclass
+class Grid:
+    """
+    Cells of the fingerprint grid, and fingerprint values on them keyed by file.
+
+    `rows` and `cols` index the fingerprint grid with latitudes ascending. Fingerprints not
+    yet loaded are read from `pack` if given, or else from their netCDF files. Masked
+    points are NaN.
+    """
+
+    lats: np.ndarray
+    lons: np.ndarray
+    rows: np.ndarray
+    cols: np.ndarray
+    fingerprints: dict
+    pack: FingerprintPack | None = None
+
+    dims = ("lat", "lon")
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.lats), len(self.lons))
+
+    @property
+    def coords(self) -> dict:
+        return {
+            "lat": ("lat", self.lats, {"units": "degrees_north"}),
+            "lon": ("lon", self.lons, {"units": "degrees_east"}),
+        }
+
+    @property
+    def data_vars(self) -> dict:
+        return {}
+
+    def encoding(self, shape: tuple, chunksize: int) -> dict:
+        return grid_encoding(shape)
+
+    def __getitem__(self, locations: slice) -> "Grid":
+        if locations != slice(None):
+            raise ValueError("Grid output cannot be split into location shards")
+        return self
+
+    def fingerprint(self, fp_file, dtype) -> np.ndarray:
+        """Fingerprint coefficients from `fp_file` on the grid cells."""
+        fp = self.fingerprints.get(str(fp_file))
+        if fp is None:
+            if self.pack is not None:
+                fp, lats, _ = self.pack.read(fp_file, masked=True)
+            else:
+                fp, lats, _ = ReadFingerprint(fp_file)
+                lats = np.ma.getdata(lats)
+                lat_sort = np.argsort(lats)
+                fp, lats = fp[lat_sort], lats[lat_sort]
+            if not np.array_equal(lats[self.rows], self.lats):
+                raise ValueError(
+                    f"{fp_file} is not on the grid of the other fingerprints"
+                )
+            fp = np.ma.filled(fp[np.ix_(self.rows, self.cols)].astype("f8"), np.nan)
+            fp = fp * 1000
+        return fp.astype(dtype)
+
+
+def grid_cells(lats, lons, box=None, stride: int = 1):
+    """
+    Rows and columns of the cells of a lat/lon grid in `box`, taking every `stride`-th.
+
+    `box` is (south, north, west, east) in degrees, and may cross the seam of the grid's
+    longitudes, like (-30, 60) on a 0-360 grid. Columns are ordered eastward from `west`.
+    """
+    south, north, west, east = (-90, 90, 0, 360) if box is None else box
+    if stride < 1:
+        raise ValueError("stride must be at least 1")
+    if west > east:
+        raise ValueError("The west edge of the box must not be east of its east edge")
+    rows = np.flatnonzero((lats >= south) & (lats <= north))[::stride]
+    offset = np.mod(np.asarray(lons) - west, 360)
+    if east - west >= 360:
+        cols = np.argsort(offset, kind="stable")
+    else:
+        cols = np.flatnonzero(offset <= east - west)
+        cols = cols[np.argsort(offset[cols], kind="stable")]
+    cols = cols[::stride]
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError(f"No fingerprint grid cells in the box {box}")
+    return rows, cols
+
+
+def load_grid(fingerprint_files=(), box=None, stride: int = 1, pack_file=None):
+    """
+    Select the fingerprint grid cells in `box`, every `stride`-th, and read `fingerprint_files` on them.
+
+    The grid is that of `pack_file` if given, or else of the first fingerprint file.
+    """
+    pack = open_pack(pack_file)
+    if pack is not None:
+        lats, lons = pack.lats, pack.lons
+    else:
+        _, lats, lons = ReadFingerprint(fingerprint_files[0])
+        lats, lons = np.sort(np.ma.getdata(lats)), np.ma.getdata(lons)
+    rows, cols = grid_cells(lats, lons, box, stride)
+    grid = Grid(lats[rows], lons[cols], rows, cols, {}, pack)
+    grid.fingerprints = {str(f): grid.fingerprint(f, "f8") for f in fingerprint_files}
+    return grid
+
+
+@dataclass
+class Regions:
+    """
+    Regions of sites, each localized as the weighted average of its sites.
+
+    `weights` is a sparse (regions, sites) matrix whose rows sum to 1. Localization is
+    linear in the fingerprints, so localizing the weighted average fingerprint of each
+    region gives the average of the local SLR of its sites, at the cost of one site per
+    region. A region is NaN if any of its sites is NaN, as masked `sites` are next to a
+    masked fingerprint point.
+    """
+
+    ids: np.ndarray
+    weights: sparse.csr_array
+    sites: Sites
+
+    dims = ("locations",)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.ids),)
+
+    @property
+    def coords(self) -> dict:
+        return {"locations": self.ids}
+
+    @property
+    def data_vars(self) -> dict:
+        # Each region is placed at the weighted centroid of its sites
+        lats, lons = np.radians(self.sites.lats), np.radians(self.sites.lons)
+        xyz = np.stack(
+            [np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)],
+            axis=1,
+        )
+        x, y, z = (self.weights @ xyz).T
+        return {
+            "lat": (("locations"), np.degrees(np.arctan2(z, np.hypot(x, y)))),
+            "lon": (("locations"), np.degrees(np.arctan2(y, x))),
+        }
+
+    def encoding(self, shape: tuple, chunksize: int) -> dict:
+        return lslr_encoding(shape, chunksize)
+
+    def __getitem__(self, locations: slice) -> "Regions":
+        if locations != slice(None):
+            raise ValueError("Region averages cannot be split into location shards")
+        return self
+
+    def fingerprint(self, fp_file, dtype) -> np.ndarray:
+        """Weighted average fingerprint coefficients from `fp_file` in each region."""
+        return (self.weights @ self.sites.fingerprint(fp_file, "f8")).astype(dtype)
+
+
+def read_region_weights(region_weights_file):
+    """
+    Region ids, location ids and weights of the rows of a region weights file.
+
+    The file is a CSV with a header naming its "region" and "location" columns, and an
+    optional "weight" column; sites without weights are weighted equally.
+    """
+    data = np.atleast_1d(
+        np.genfromtxt(region_weights_file, dtype=None, names=True, delimiter=",")
+    )
+    names = data.dtype.names or ()
+    if not {"region", "location"} <= set(names):
+        raise ValueError(f"{region_weights_file} must have region and location columns")
+    weights = data["weight"] if "weight" in names else np.ones(len(data))
+    return data["region"], data["location"], np.asarray(weights, dtype="f8")
+
+
+def make_regions(sites: Sites, region_ids, site_ids, weights) -> Regions:
+    """
+    Regions of `sites`, with site `site_ids[i]` in region `region_ids[i]` with `weights[i]`.
+
+    Weights are normalized to sum to 1 in each region, and the weights of a site listed
+    more than once in a region are added. Regions are ordered by id.
+    """
+    weights = np.asarray(weights, dtype="f8")
+    unknown = np.setdiff1d(site_ids, sites.ids)
+    if len(unknown) > 0:
+        raise ValueError(
+            f"Region weights name locations not among the sites: {unknown[:10].tolist()}"
+        )
+    if not np.all(weights >= 0):
+        raise ValueError("Region weights must not be negative")
+
+    ids, rows = np.unique(region_ids, return_inverse=True)
+    index = {site_id: i for i, site_id in enumerate(sites.ids)}
+    cols = np.array([index[site_id] for site_id in site_ids], dtype=int)
+    matrix = sparse.csr_array((weights, (rows, cols)), shape=(len(ids), len(sites.ids)))
+    totals = matrix.sum(axis=1)
+    if not np.all(totals > 0):
+        raise ValueError(f"Regions {ids[totals <= 0].tolist()} have no weight")
+    return Regions(ids, (sparse.diags_array(1 / totals) @ matrix).tocsr(), sites)
+
+
+def load_regions(
+    location_file, region_weights_file, fingerprint_files=(), pack_file=None
+) -> Regions:
+    """
+    Read the regions of `region_weights_file` over the sites of `location_file`.
+
+    `fingerprint_files` are only interpolated to the sites that are in a region, and
+    sites next to masked fingerprint points are NaN, so their regions are too.
+    """
+    region_ids, site_ids, weights = read_region_weights(region_weights_file)
+    _, ids, lats, lons = ReadLocationFile(location_file)
+    members = np.isin(ids, site_ids)
+    sites = make_sites(
+        lats[members],
+        lons[members],
+        ids[members],
+        fingerprint_files,
+        pack_file,
+        masked=True,
+    )
+    return make_regions(sites, region_ids, site_ids, weights)
+
+
+def load_locations(
+    location_file=None,
+    fingerprint_files=(),
+    pack_file=None,
+    grid: bool = False,
+    grid_box=None,
+    grid_stride: int = 1,
+    region_weights_file=None,
+):
+    """
+    Load what to localize on with its fingerprints.
+
+    These are the sites of `location_file`, or with `grid` the cells of the fingerprint grid
+    selected by `grid_box` and `grid_stride`, or with `region_weights_file` the regions of
+    the sites it weights.
+    """
+    if grid:
+        return load_grid(fingerprint_files, grid_box, grid_stride, pack_file)
+    if region_weights_file is not None:
+        return load_regions(
+            location_file, region_weights_file, fingerprint_files, pack_file
+        )
+    return load_sites(location_file, fingerprint_files, pack_file=pack_file)
+
+
+def glacier_fingerprint_files(
+    fprint_map_file, fprint_glacier_dir, pack_file=None
+) -> list[str]:
+    """Fingerprint files of the glacier regions, in region order."""
+    ice_ids, fpids = read_glacier_map(fprint_map_file, pack_file)
+    order = np.argsort(ice_ids)
+    return [
+        os.path.join(fprint_glacier_dir, f"fprint_{region}.nc")
+        for region in fpids[order]
+    ]
+
+
+def check_paths(input_files=(), output_files=()):
+    """
+    Check that input files exist and that the directories of output files are writable.
+
+    Raises FileNotFoundError or PermissionError naming the first bad path. Unset (None)
+    paths are skipped.
+    """
+    for f in input_files:
+        if f is not None and not Path(f).is_file():
+            raise FileNotFoundError(f"Input file not found: {f}")
+    for f in output_files:
+        if f is None:
+            continue
+        parent = Path(f).absolute().parent
+        if not parent.is_dir():
+            raise FileNotFoundError(f"Output directory not found: {parent}")
+        if not os.access(parent, os.W_OK):
+            raise PermissionError(f"Output directory not writable: {parent}")
+
+
+def check_fingerprints(fingerprint_files, pack_file=None):
+    """Check that the fingerprint files exist, or are in `pack_file` if given."""
+    if pack_file is None:
+        check_paths(fingerprint_files)
+    else:
+        check_paths([pack_file])
+        FingerprintPack(pack_file).check(fingerprint_files)